@@ -33,28 +33,3307 @@ Created on: Tue Oct 1, 2024
 __VERSION__ = "1.30"
 import os
 import sys
+import re
+import pty
+import csv
+import json
+import mmap
+import stat
 import time
+import math
+import bisect
+import ctypes
+import random
+import atexit
+import signal
+import socket
+import struct
 import argparse
-import pynvml as nv
+import tempfile
+import threading
+import statistics
+import subprocess
+import socketserver
+from array import array
+from collections import deque, namedtuple
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pynvml
+nv = pynvml  # The NVML backend everything talks to, --simulate swaps it for SimulatedNvml
+INPUT_POLL_MS = 50  # How often the monitor checks for key presses and new samples while idle
+SPARK_COLUMN = 52  # Where the history sparklines start on the monitor
+SPARK_WIDTH = 24
+STATS_COLUMN = SPARK_COLUMN + SPARK_WIDTH + 2  # Where the --sample-buffers stats go, right of the sparklines
+DEFAULT_SOCKET = os.path.join(os.getenv("XDG_RUNTIME_DIR") or "/tmp", "blissnvidiatool.sock")
+#  How much a metric has to move between two samples for --adaptive to sample at the fastest rate, in its own units
+ADAPTIVE_THRESHOLDS = {"power_usage": 5, "core_clock": 50, "mem_clock": 100, "gpu_util": 5, "mem_util": 5, "temperature": 2}
+
+
+def host_port(value):
+    """
+    Argparse type for HOST:PORT values, also accepts [::1]:PORT for IPv6
+    """
+    host, _, port = value.rpartition(":")
+    if not host or not port.isdigit() or not 0 < int(port) < 65536:
+        raise argparse.ArgumentTypeError(f"expected HOST:PORT, got {value!r}")
+    return host.strip("[]"), int(port)
+
+
+def positive_int(value):
+    """
+    Argparse type for whole numbers above zero
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a whole number, got {value!r}") from None
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"expected a number above 0, got {value!r}")
+    return number
+
+
+def int_list(value):
+    """
+    Argparse type for comma separated lists of integers like 1,2,4,8
+    """
+    try:
+        return [int(item) for item in value.split(",") if item.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected comma separated integers, got {value!r}") from None
+
+
+def gpu_selection(value):
+    """
+    Argparse type for GPU selections like 1, 0,2, 0-3, 0,4-7 or all. Returns a sorted list of indices, or None for all
+    """
+    if value.strip().lower() == "all":
+        return None
+    selected = set()
+    try:
+        for item in filter(None, (item.strip() for item in value.split(","))):
+            first, _, last = item.partition("-")
+            selected.update(range(int(first), int(last or first) + 1))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected indices, ranges like 0-3 or all, got {value!r}") from None
+    if not selected:
+        raise argparse.ArgumentTypeError(f"no GPUs selected by {value!r}")
+    return sorted(selected)
+
+
+def threshold_list(value):
+    """
+    Argparse type for per metric thresholds like power_usage=10,gpu_util=3. Returns the defaults with those replaced
+    """
+    thresholds = dict(ADAPTIVE_THRESHOLDS)
+    try:
+        for metric, threshold in (item.split("=") for item in value.split(",") if item.strip()):
+            if metric.strip() not in ADAPTIVE_THRESHOLDS:
+                raise argparse.ArgumentTypeError(f"unknown metric {metric!r}, pick from {', '.join(ADAPTIVE_THRESHOLDS)}")
+            thresholds[metric.strip()] = float(threshold)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected METRIC=THRESHOLD pairs like power_usage=10,gpu_util=3, got {value!r}") from None
+    return thresholds
+
+
+def fan_curve(value):
+    """
+    Argparse type for fan curves given as TEMP:SPEED points like 40:30,60:50,80:100. Returns a sorted list of tuples
+    """
+    try:
+        points = sorted((int(temp), int(speed)) for temp, speed in (point.split(":") for point in value.split(",")))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected TEMP:SPEED points like 40:30,60:50,80:100, got {value!r}") from None
+    if len({temp for temp, _ in points}) != len(points):
+        raise argparse.ArgumentTypeError("every temperature can only appear once in a fan curve")
+    if any(not 101 > speed > 29 for _, speed in points):
+        raise argparse.ArgumentTypeError("fan curve speeds have to be between 30 and 100")
+    return points
+
+
 parser = argparse.ArgumentParser(description="Blissful Nvidia Tool")
-parser.add_argument("--gpu-number", type=int, default=0, help="Specify the GPU index (default: 0)")
+parser.add_argument("--gpu-number", type=gpu_selection, default=[0], help="Specify the GPU index, a list and/or range like 0,2,4-7 or all. Offline operations run on every selected GPU at once, the monitor shows the first (default: 0)")
 parser.add_argument("--refresh-rate", type=int, default=1000, help="Specify how often to refresh the monitor, in milliseconds. Default is 1000")
+parser.add_argument("--adaptive", action='store_true', help="Sample between --min-refresh-rate and --max-refresh-rate depending on how fast the GPU's metrics are changing instead of at a fixed --refresh-rate")
+parser.add_argument("--min-refresh-rate", type=int, default=100, help="Fastest --adaptive sampling interval, in milliseconds. Default is 100")
+parser.add_argument("--max-refresh-rate", type=int, default=5000, help="Slowest --adaptive sampling interval, in milliseconds. Default is 5000")
+parser.add_argument("--adaptive-thresholds", type=threshold_list, default=ADAPTIVE_THRESHOLDS, metavar="METRIC=VALUE,...",
+                    help=f"How much each metric has to change between samples for --adaptive to speed up. Default is {','.join(f'{metric}={value}' for metric, value in ADAPTIVE_THRESHOLDS.items())}")
+parser.add_argument("--sample-buffers", action='store_true', help="Also drain the driver's own high resolution samples of power, utilization and clocks and show their min/avg/max/p99 between two refreshes. With --headless they are summarized on exit, --stream doesn't support it")
+parser.add_argument("--stats-window", type=int, default=60, help="How many samples the rolling min/mean/max on the monitor covers. Default is 60")
+parser.add_argument("--history-length", type=positive_int, default=3600, help="How many samples of history to keep per metric for the sparklines. Default is 3600")
+parser.add_argument("--overview", action='store_true', help="Start the monitor on the overview of all GPUs")
 parser.add_argument("--reactive-color", action='store_true', help="Uses color to indicate the intensity of values")
 parser.add_argument("--no-color", action='store_true', help="Disable the use of any color at all")
+parser.add_argument("--serve-metrics", type=host_port, metavar="HOST:PORT", help="Run headless and serve Prometheus/OpenMetrics for all GPUs at http://HOST:PORT/metrics")
+parser.add_argument("--stream", choices=["json", "csv"], help="Print one record per sample per GPU as JSON lines or CSV instead of running the monitor")
+parser.add_argument("--stream-fields", metavar="FIELD,...", help="Only read and print these fields with --stream, so only their NVML queries are made. Default is all of them")
+parser.add_argument("--stream-output", metavar="FILE", help="Append the --stream records to FILE instead of printing them")
+parser.add_argument("--stream-count", type=int, metavar="N", help="Stop --stream after N samples per GPU")
+parser.add_argument("--record", metavar="FILE", help="Append every sample the monitor takes to FILE so it can be replayed later")
+parser.add_argument("--replay", metavar="FILE", help="Replay a recording made with --record in the monitor, no GPU needed")
+parser.add_argument("--replay-speed", type=float, default=1.0, help="Playback speed for --replay. Default is 1")
+parser.add_argument("--replay-start", type=float, default=0, help="Start --replay this many seconds into the recording")
+parser.add_argument("--simulate", type=int, metavar="N", help="Run against N simulated GPUs instead of the real driver, for testing and benchmarking")
+parser.add_argument("--simulate-latency", type=float, default=0, metavar="MS", help="Add this much latency to every simulated NVML call, in milliseconds")
+parser.add_argument("--simulate-error-rate", type=float, default=0, metavar="RATE", help="Chance (0-1) of any simulated NVML call failing with an NVMLError")
+parser.add_argument("--simulate-unsupported", default="", metavar="FUNCTIONS", help="Comma separated NVML functions the simulated GPUs report as not supported")
+parser.add_argument("--daemon", action='store_true', help="Run headless as a daemon that keeps NVML open and takes commands on --socket")
+parser.add_argument("--socket", nargs="?", const=DEFAULT_SOCKET, metavar="PATH", help=f"Send the --set-* and --status commands to the daemon on this socket instead of talking to the driver. Default is {DEFAULT_SOCKET}")
+parser.add_argument("--status", action='store_true', help="Print the current state of the GPU as JSON")
+parser.add_argument("--profile-dir", metavar="DIR", help="Directory to keep the profile store in. Default is the directory of this script")
+parser.add_argument("--cache-capabilities", action='store_true', help="Remember which queries each GPU doesn't support in capabilities.json in the --profile-dir, so later runs on the same driver skip them right away")
+parser.add_argument("--benchmark", action='store_true', help="Benchmark the monitor and offline operations against simulated GPUs and print the results as JSON")
+parser.add_argument("--benchmark-gpus", type=int_list, default=[1, 2, 4, 8], metavar="N,N,...", help="GPU counts to benchmark the monitor at. Default is 1,2,4,8")
+parser.add_argument("--benchmark-refresh-rates", type=int_list, default=[100, 1000], metavar="MS,MS,...", help="Refresh rates to benchmark the monitor at. Default is 100,1000")
+parser.add_argument("--benchmark-duration", type=float, default=3, help="How long to run the monitor for each benchmark, in seconds. Default is 3")
+parser.add_argument("--benchmark-runs", type=int, default=5, help="How many times to run each offline operation for the benchmark. Default is 5")
+parser.add_argument("--benchmark-output", metavar="FILE", help="Write the benchmark results to FILE instead of stdout")
+parser.add_argument("--benchmark-stats", help=argparse.SUPPRESS)  # Where a child of --benchmark reports back
+parser.add_argument("--fan-curve", type=fan_curve, metavar="TEMP:SPEED,...", help="Needs root. Drive the fans of the selected GPUs from a temperature curve like 40:30,60:50,80:100 while the monitor or --headless runs, they go back to automatic control on exit")
+parser.add_argument("--fan-hysteresis", type=int, default=3, help="How many °C the temperature has to drop before the fan curve slows the fans down. Default is 3")
+parser.add_argument("--fan-ramp", type=float, default=10, help="How many percent per second the fan curve may change the fan speed by. Default is 10")
+parser.add_argument("--power-budget", type=float, metavar="WATTS", help="Needs root. Share a total power budget between the selected GPUs (use --gpu-number all for the whole node) while the monitor or --headless runs, moving headroom to the busy ones. The original limits are restored on exit")
+parser.add_argument("--headless", action='store_true', help="Run the --fan-curve and --power-budget controllers without the monitor until interrupted, logging clock, power source and Xid events of the selected GPUs and why their clocks are held back, with a summary on exit")
+parser.add_argument("--no-events", action='store_true', help="Don't watch for clock, power source and Xid events")
+parser.add_argument("--tune", metavar="COMMAND", help="Needs root. Run the shell COMMAND at every point of a grid of the --tune-* settings below and print the perf-per-watt frontier, the original settings are restored afterward")
+parser.add_argument("--tune-core-offsets", type=int_list, metavar="MHZ,...", help="Core clock offsets to try with --tune. Default is the current one")
+parser.add_argument("--tune-mem-offsets", type=int_list, metavar="MHZ,...", help="Memory clock offsets to try with --tune. Default is the current one")
+parser.add_argument("--tune-power-limits", type=int_list, metavar="WATTS,...", help="Power limits to try with --tune. Default is the current one")
+parser.add_argument("--tune-metric", metavar="REGEX", help="Regex whose first group is the workload's throughput in its output, like \"([0-9.]+) it/s\". Without it throughput is runs per second")
+parser.add_argument("--tune-runs", type=int, default=1, help="How many times to run the workload at each point, the median counts. Default is 1")
+parser.add_argument("--tune-output", metavar="FILE", help="Also write every measured point and the frontier to FILE as JSON")
+parser.add_argument("--tune-save-profile", metavar="NAME", help="Save the point with the best perf-per-watt as a profile")
 parser.add_argument("--interactive", action='store_true', help="This and those below need root/superuser. Enable interactive mode for monitor. Type \"h\" for help")
 parser.add_argument("--set-clocks", nargs=2, type=int, help="Needs root. Set core and memory clock offsets (in MHz) respectively. Example: --set-clocks -150 500")
 parser.add_argument("--set-power-limit", type=int, help="Set the power limit (in watts). Example: --set-power-limit 300")
 parser.add_argument("--set-custom-fan", type=int, help="Set a custom fan percentage. !BE CAREFUL! as this changes the fan control policy to manual!!! Only values 30-100 are accepted. ")
-parser.add_argument("--set-profile", type=int, help="Apply one of the custom profiles you've created.")
+parser.add_argument("--set-profile", metavar="NAME", help="Apply one of the custom profiles you've created. The monitor saves its profiles as 1-4")
+parser.add_argument("--save-profile", metavar="NAME", help="Save the current settings as a profile, after applying any of the other options given")
+parser.add_argument("--delete-profile", metavar="NAME", help="Delete a saved profile")
+parser.add_argument("--list-profiles", action='store_true', help="Print the saved profiles as JSON")
 parser.add_argument("--set-max-fan", action='store_true', help="Set all fans to maximum speed")
 parser.add_argument("--set-auto-fan", action='store_true', help="Reset fan control to automatic mode")
 
 
-def add_sign(offset):
+def add_sign(offset):
+    """
+    Helper function to add a + sign to positive numbers and output them back
+    """
+    return f"+{offset}" if offset > 0 else offset
+
+
+Sample = namedtuple("Sample", ["timestamp", "monotonic", "core_offset", "mem_offset", "fan_policy", "fan_speed", "temperature",
+                               "power_usage", "power_limit", "gpu_util", "mem_util", "mem_used", "mem_total",
+                               "core_clock", "mem_clock", "nvml_calls", "clock_reasons", "energy"])
+DeviceInfo = namedtuple("DeviceInfo", ["index", "name", "max_core_clock", "max_mem_clock", "default_power_limit", "min_power_limit",
+                                       "max_power_limit", "num_fans", "mem_bus_width", "bar1_total", "compute_capability",
+                                       "max_pcie_gen", "max_pcie_width", "uuid"])
+GpuEvent = namedtuple("GpuEvent", ["timestamp", "monotonic", "index", "kind", "data"])
+#  Events the event watcher registers for, as (NVML event type, kind). Older bindings may not know all of them
+WATCHED_EVENTS = [(getattr(nv, event_type), kind) for event_type, kind in
+                  [("nvmlEventTypeClock", "clock"), ("nvmlEventTypePowerSourceChange", "power_source"), ("nvmlEventTypeXidCriticalError", "xid")]
+                  if hasattr(nv, event_type)]
+#  Reasons the driver holds the clocks back that the session accounting tracks, as (name, label, NVML bitmask).
+#  Newer bindings call these clock event reasons, the masks are the same as the throttle reasons they replace
+CLOCK_REASONS = [(name, label, getattr(nv, f"nvmlClocksThrottleReason{reason}")) for name, label, reason in
+                 [("idle", "Idle", "GpuIdle"), ("power_cap", "Power cap", "SwPowerCap"), ("sw_thermal", "SW thermal", "SwThermalSlowdown"),
+                  ("hw_slowdown", "HW slowdown", "HwSlowdown"), ("hw_thermal", "HW thermal", "HwThermalSlowdown"),
+                  ("hw_power_brake", "HW power brake", "HwPowerBrakeSlowdown"), ("sync_boost", "Sync boost", "SyncBoost")]
+                 if hasattr(nv, f"nvmlClocksThrottleReason{reason}")]
+_device_info_cache = {}
+_device_info_lock = threading.Lock()
+#  Metrics read_sample can get from one batched nvmlDeviceGetFieldValues request, as (sample field, field id, scope id).
+#  NVML has no field ids for temperature, clocks, utilization, fans or memory so those always need their own call.
+BATCH_FIELDS = [(name, getattr(nv, field_id), nv.NVML_POWER_SCOPE_GPU) for name, field_id in
+                [("power_usage", "NVML_FI_DEV_POWER_AVERAGE"), ("power_limit", "NVML_FI_DEV_POWER_CURRENT_LIMIT"),
+                 ("energy", "NVML_FI_DEV_TOTAL_ENERGY_CONSUMPTION")]
+                if hasattr(nv, field_id)]
+_FIELD_VALUE_MEMBERS = {getattr(nv, value_type): member for value_type, member in
+                        [("NVML_VALUE_TYPE_DOUBLE", "dVal"), ("NVML_VALUE_TYPE_UNSIGNED_INT", "uiVal"),
+                         ("NVML_VALUE_TYPE_UNSIGNED_LONG", "ulVal"), ("NVML_VALUE_TYPE_UNSIGNED_LONG_LONG", "ullVal"),
+                         ("NVML_VALUE_TYPE_SIGNED_LONG_LONG", "sllVal"), ("NVML_VALUE_TYPE_SIGNED_INT", "siVal"),
+                         ("NVML_VALUE_TYPE_UNSIGNED_SHORT", "usVal")] if hasattr(nv, value_type)}
+_field_batch_supported = {}
+#  Sample buffers the driver keeps and --sample-buffers drains, as (Sample field, sampling type, scale to Sample units)
+SAMPLE_BUFFERS = [(name, getattr(nv, sampling_type), scale) for name, sampling_type, scale in
+                  [("power_usage", "NVML_TOTAL_POWER_SAMPLES", 0.001), ("gpu_util", "NVML_GPU_UTILIZATION_SAMPLES", 1),
+                   ("mem_util", "NVML_MEMORY_UTILIZATION_SAMPLES", 1), ("core_clock", "NVML_PROCESSOR_CLK_SAMPLES", 1),
+                   ("mem_clock", "NVML_MEMORY_CLK_SAMPLES", 1)] if hasattr(nv, sampling_type)]
+BufferStats = namedtuple("BufferStats", ["count", "min", "avg", "max", "p99"])
+
+
+class CountingNvml:
+    """
+    Thin proxy around the NVML bindings that counts the driver calls made from each thread, so a sampler
+    can tell how many round trips into libnvidia-ml a single sample cost
+    """
+    def __init__(self, backend):
+        self._backend = backend
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        attr = getattr(self._backend, name)
+        if name.startswith("nvml") and callable(attr):
+            local = self._local
+
+            def counted(*call_args, **call_kwargs):
+                local.calls = getattr(local, "calls", 0) + 1
+                return attr(*call_args, **call_kwargs)
+            self.__dict__[name] = counted  # Only resolve each function once
+            return counted
+        return attr
+
+    def thread_calls(self):
+        """
+        Returns how many NVML calls the current thread has made so far
+        """
+        return getattr(self._local, "calls", 0)
+
+
+def _query_or_none(function, *query_args):
+    """
+    Helper function to run an NVML query that some GPUs/drivers don't support, returns None if it fails
+    """
+    try:
+        return function(*query_args)
+    except nv.NVMLError:
+        return None
+
+
+def replacement_mode(path):
+    """
+    Helper function to get the permissions a file written to replace path should have: those of the file that is there,
+    or what a new file gets under the umask if there is none. Temporary files are always created private
+    """
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+def _decode(value):
+    """
+    Older bindings hand out strings as bytes, newer ones as str
+    """
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def get_device_info(index, gpu):
+    """
+    Returns the DeviceInfo of values that don't change during a session for a GPU, querying the driver only
+    the first time it's asked for a given index. Takes in the GPU index and handle
+    """
+    with _device_info_lock:
+        info = _device_info_cache.get(index)
+    if info is not None:
+        return info
+    power_constraints = _query_or_none(nv.nvmlDeviceGetPowerManagementLimitConstraints, gpu)
+    bar1 = _query_or_none(nv.nvmlDeviceGetBAR1MemoryInfo, gpu)
+    info = DeviceInfo(index=index,
+                      name=nv.nvmlDeviceGetName(gpu),
+                      max_core_clock=nv.nvmlDeviceGetMaxClockInfo(gpu, nv.NVML_CLOCK_GRAPHICS),
+                      max_mem_clock=nv.nvmlDeviceGetMaxClockInfo(gpu, nv.NVML_CLOCK_MEM),
+                      default_power_limit=nv.nvmlDeviceGetPowerManagementDefaultLimit(gpu) / 1000,
+                      min_power_limit=power_constraints[0] / 1000 if power_constraints else None,
+                      max_power_limit=power_constraints[1] / 1000 if power_constraints else None,
+                      num_fans=_query_or_none(nv.nvmlDeviceGetNumFans, gpu) or 0,
+                      mem_bus_width=_query_or_none(nv.nvmlDeviceGetMemoryBusWidth, gpu),
+                      bar1_total=bar1.bar1Total if bar1 is not None else None,
+                      compute_capability=_query_or_none(nv.nvmlDeviceGetCudaComputeCapability, gpu),
+                      max_pcie_gen=_query_or_none(nv.nvmlDeviceGetMaxPcieLinkGeneration, gpu),
+                      max_pcie_width=_query_or_none(nv.nvmlDeviceGetMaxPcieLinkWidth, gpu),
+                      uuid=_decode(_query_or_none(nv.nvmlDeviceGetUUID, gpu)))
+    with _device_info_lock:
+        _device_info_cache[index] = info
+    return info
+
+
+def invalidate_device_info(index=None):
+    """
+    Drops the cached DeviceInfo for one GPU index, or for all of them if no index is given
+    """
+    with _device_info_lock:
+        if index is None:
+            _device_info_cache.clear()
+        else:
+            _device_info_cache.pop(index, None)
+
+
+class SimulatedNvml:
+    """
+    Simulated NVML backend. A backend is anything that looks like the pynvml module to this tool: the nvml* functions
+    we call plus NVML's constants and error classes. pynvml itself is the real backend, this one models a set of GPUs
+    with fans, power limits, clock offsets and processes so the monitor, offline setters and profiles can run (and be
+    benchmarked) on machines without an Nvidia GPU. Load follows a deterministic curve over time. Every call can be
+    given a fixed latency, a random chance of failing and functions can be marked as unsupported.
+    """
+    def __init__(self, gpu_count, latency=0.0, error_rate=0.0, unsupported=(), seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.unsupported = set(unsupported)
+        self._random = random.Random(seed)
+        self._seed = seed
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._wall_start = time.time()
+        self._handles = [SimpleNamespace(index=index) for index in range(gpu_count)]
+        self._devices = []
+        for index in range(gpu_count):
+            max_power = 300000 + 50000 * (index % 3)
+            self._devices.append({"index": index,
+                                  "name": f"Simulated GeForce RTX {4060 + 10 * (index % 4)}",
+                                  "uuid": f"GPU-{seed:08x}-0000-4000-8000-{index:012x}",
+                                  "max_core_clock": 2500 + 50 * index,
+                                  "max_mem_clock": 10501,
+                                  "default_power_limit": max_power - 50000,
+                                  "min_power_limit": 100000,
+                                  "max_power_limit": max_power,
+                                  "power_limit": max_power - 50000,
+                                  "core_offset": 0,
+                                  "mem_offset": 0,
+                                  "fan_policy": [pynvml.NVML_FAN_POLICY_TEMPERATURE_CONTINOUS_SW] * 2,
+                                  "fan_speed": [30, 30],
+                                  "persistence": 0,
+                                  "energy": 3600000 * 10 * (index + 1),  # mJ, as if the driver had been up a while
+                                  "energy_elapsed": 0.0,
+                                  "mem_total": (8 + 4 * (index % 3)) * 1024**3})
+
+    def __getattr__(self, name):
+        if name.startswith("nvml"):
+            raise AttributeError(f"The simulated backend doesn't implement {name}")
+        return getattr(pynvml, name)  # Constants and error classes come straight from pynvml
+
+    def _call(self, name, handle=None):
+        """
+        Applies the simulated latency and failures to a call, returns the device state for the handle if one is given
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        if name in self.unsupported:
+            raise pynvml.NVMLError(pynvml.NVML_ERROR_NOT_SUPPORTED)
+        if self.error_rate:
+            with self._lock:
+                failed = self._random.random() < self.error_rate
+            if failed:
+                raise pynvml.NVMLError(pynvml.NVML_ERROR_UNKNOWN)
+        return self._devices[handle.index] if handle is not None else None
+
+    def _load(self, device, elapsed=None):
+        """
+        Returns the workload of a GPU elapsed seconds into the simulation (default now) as a fraction between 0 and 1,
+        a slow wave with a little jitter on top
+        """
+        if elapsed is None:
+            elapsed = time.monotonic() - self._start
+        index = device["index"]
+        jitter = random.Random(f"{self._seed}-{index}-{int(elapsed * 10)}").uniform(-0.05, 0.05)
+        return min(1.0, max(0.0, 0.5 + 0.45 * math.sin(elapsed / (6 + index) + index) + jitter))
+
+    def _power(self, device, elapsed=None):
+        """
+        Returns the power draw in mW the load asks for, capped at the power limit
+        """
+        return min(25000 + self._load(device, elapsed) * (device["max_power_limit"] - 25000), device["power_limit"])
+
+    def _fan(self, device, fan):
+        """
+        Returns the speed of a fan, automatic fans follow the heat coming off the card
+        """
+        if device["fan_policy"][fan] == pynvml.NVML_FAN_POLICY_MANUAL:
+            return device["fan_speed"][fan]
+        return int(min(100, max(30, 30 + 70 * (self._power(device) / device["max_power_limit"] - 0.3) / 0.7)))
+
+    def _temperature(self, device):
+        """
+        Returns the temperature the current power draw and fan speed settle at
+        """
+        heat = self._power(device) / device["max_power_limit"]
+        return int(32 + 60 * heat * (1.25 - self._fan(device, 0) / 200))
+
+    def _clock(self, device, clock_type, elapsed=None):
+        """
+        Returns the clock, the core clock drops when the power limit holds the card back
+        """
+        load = self._load(device, elapsed)
+        if clock_type == pynvml.NVML_CLOCK_MEM:
+            return int(device["max_mem_clock"] + device["mem_offset"] / 2 if load > 0.1 else 405)
+        demand = 25000 + load * (device["max_power_limit"] - 25000)
+        headroom = min(1.0, device["power_limit"] / demand)
+        boost = 210 + (device["max_core_clock"] - 210) * min(1.0, load * 1.5) * headroom
+        return int(max(210, boost + device["core_offset"]))
+
+    def nvmlInit(self):
+        """
+        Pretends to load the driver
+        """
+        self._call("nvmlInit")
+
+    def nvmlShutdown(self):
+        """
+        Pretends to unload the driver
+        """
+        self._call("nvmlShutdown")
+
+    def nvmlSystemGetDriverVersion(self):
+        """
+        Returns a fixed driver version
+        """
+        self._call("nvmlSystemGetDriverVersion")
+        return "555.42.02"
+
+    def nvmlSystemGetNVMLVersion(self):
+        """
+        Returns the NVML version matching the driver version
+        """
+        self._call("nvmlSystemGetNVMLVersion")
+        return "12.555.42.02"
+
+    def nvmlSystemGetCudaDriverVersion_v2(self):
+        """
+        Returns the CUDA version the driver supports, as 1000 * major + 10 * minor
+        """
+        self._call("nvmlSystemGetCudaDriverVersion_v2")
+        return 12050
+
+    def nvmlDeviceGetCount(self):
+        """
+        Returns the number of simulated GPUs
+        """
+        self._call("nvmlDeviceGetCount")
+        return len(self._devices)
+
+    def nvmlDeviceGetHandleByIndex(self, index):
+        """
+        Returns the handle of a simulated GPU, an invalid argument error for an index that doesn't exist
+        """
+        self._call("nvmlDeviceGetHandleByIndex")
+        if not 0 <= index < len(self._handles):
+            raise pynvml.NVMLError(pynvml.NVML_ERROR_INVALID_ARGUMENT)
+        return self._handles[index]
+
+    def nvmlDeviceGetName(self, handle):
+        """
+        Returns the name of a GPU
+        """
+        return self._call("nvmlDeviceGetName", handle)["name"]
+
+    def nvmlDeviceGetUUID(self, handle):
+        """
+        Returns the UUID of a GPU, stable for a given seed
+        """
+        return self._call("nvmlDeviceGetUUID", handle)["uuid"]
+
+    def nvmlDeviceGetMaxClockInfo(self, handle, clock_type):
+        """
+        Returns the highest core or memory clock of a GPU in MHz
+        """
+        device = self._call("nvmlDeviceGetMaxClockInfo", handle)
+        return device["max_mem_clock"] if clock_type == pynvml.NVML_CLOCK_MEM else device["max_core_clock"]
+
+    def nvmlDeviceGetClockInfo(self, handle, clock_type):
+        """
+        Returns the current core or memory clock of a GPU in MHz
+        """
+        return self._clock(self._call("nvmlDeviceGetClockInfo", handle), clock_type)
+
+    def nvmlDeviceGetPowerManagementDefaultLimit(self, handle):
+        """
+        Returns the default power limit of a GPU in mW
+        """
+        return self._call("nvmlDeviceGetPowerManagementDefaultLimit", handle)["default_power_limit"]
+
+    def nvmlDeviceGetPowerManagementLimitConstraints(self, handle):
+        """
+        Returns the [min, max] power limits of a GPU in mW
+        """
+        device = self._call("nvmlDeviceGetPowerManagementLimitConstraints", handle)
+        return [device["min_power_limit"], device["max_power_limit"]]
+
+    def nvmlDeviceGetPowerManagementLimit(self, handle):
+        """
+        Returns the current power limit of a GPU in mW
+        """
+        return self._call("nvmlDeviceGetPowerManagementLimit", handle)["power_limit"]
+
+    def nvmlDeviceGetPowerUsage(self, handle):
+        """
+        Returns the power draw of a GPU in mW
+        """
+        return int(self._power(self._call("nvmlDeviceGetPowerUsage", handle)))
+
+    def nvmlDeviceGetFieldValues(self, handle, field_ids):
+        """
+        Answers the power draw, power limit and energy field ids, anything else comes back as not supported
+        """
+        device = self._call("nvmlDeviceGetFieldValues", handle)
+        values = (pynvml.c_nvmlFieldValue_t * len(field_ids))()
+        for value, (field_id, scope_id) in zip(values, field_ids):
+            value.fieldId = field_id
+            value.scopeId = scope_id
+            value.timestamp = int(time.time() * 1000000)
+            value.valueType = pynvml.NVML_VALUE_TYPE_UNSIGNED_INT
+            if field_id in (getattr(pynvml, "NVML_FI_DEV_POWER_AVERAGE", None), getattr(pynvml, "NVML_FI_DEV_POWER_INSTANT", None)):
+                value.value.uiVal = int(self._power(device))
+            elif field_id == getattr(pynvml, "NVML_FI_DEV_POWER_CURRENT_LIMIT", None):
+                value.value.uiVal = device["power_limit"]
+            elif field_id == getattr(pynvml, "NVML_FI_DEV_TOTAL_ENERGY_CONSUMPTION", None) and "nvmlDeviceGetTotalEnergyConsumption" not in self.unsupported:
+                value.valueType = pynvml.NVML_VALUE_TYPE_UNSIGNED_LONG_LONG
+                value.value.ullVal = self._energy(device)
+            else:
+                value.nvmlReturn = pynvml.NVML_ERROR_NOT_SUPPORTED
+        return values
+
+    def nvmlDeviceGetTemperature(self, handle, _sensor):
+        """
+        Returns the core temperature of a GPU, there is only the one sensor
+        """
+        return self._temperature(self._call("nvmlDeviceGetTemperature", handle))
+
+    def nvmlDeviceGetUtilizationRates(self, handle):
+        """
+        Returns the core and memory controller utilization, both following the load
+        """
+        load = self._load(self._call("nvmlDeviceGetUtilizationRates", handle))
+        return pynvml.c_nvmlUtilization_t(gpu=int(load * 100), memory=int(load * 60))
+
+    def nvmlDeviceGetMemoryInfo(self, handle, _version=None):
+        """
+        Returns the VRAM of a GPU, how much is used follows the load
+        """
+        device = self._call("nvmlDeviceGetMemoryInfo", handle)
+        used = int(device["mem_total"] * (0.05 + 0.6 * self._load(device)))
+        return pynvml.c_nvmlMemory_t(total=device["mem_total"], free=device["mem_total"] - used, used=used)
+
+    def nvmlDeviceGetGpcClkVfOffset(self, handle):
+        """
+        Returns the core clock offset of a GPU in MHz
+        """
+        return self._call("nvmlDeviceGetGpcClkVfOffset", handle)["core_offset"]
+
+    def nvmlDeviceGetMemClkVfOffset(self, handle):
+        """
+        Returns the memory clock offset of a GPU in MHz, the way NVML counts it
+        """
+        return self._call("nvmlDeviceGetMemClkVfOffset", handle)["mem_offset"]
+
+    def nvmlDeviceSetGpcClkVfOffset(self, handle, offset):
+        """
+        Sets the core clock offset of a GPU, within the range a real card would accept
+        """
+        device = self._call("nvmlDeviceSetGpcClkVfOffset", handle)
+        if not -1000 <= offset <= 1000:
+            raise pynvml.NVMLError(pynvml.NVML_ERROR_INVALID_ARGUMENT)
+        with self._lock:
+            device["core_offset"] = offset
+
+    def nvmlDeviceSetMemClkVfOffset(self, handle, offset):
+        """
+        Sets the memory clock offset of a GPU, within the range a real card would accept
+        """
+        device = self._call("nvmlDeviceSetMemClkVfOffset", handle)
+        if not -2000 <= offset <= 6000:
+            raise pynvml.NVMLError(pynvml.NVML_ERROR_INVALID_ARGUMENT)
+        with self._lock:
+            device["mem_offset"] = offset
+
+    def nvmlDeviceSetPowerManagementLimit(self, handle, limit):
+        """
+        Sets the power limit of a GPU in mW, within its constraints
+        """
+        device = self._call("nvmlDeviceSetPowerManagementLimit", handle)
+        if not device["min_power_limit"] <= limit <= device["max_power_limit"]:
+            raise pynvml.NVMLError(pynvml.NVML_ERROR_INVALID_ARGUMENT)
+        with self._lock:
+            device["power_limit"] = limit
+
+    def nvmlDeviceSetPersistenceMode(self, handle, mode):
+        """
+        Sets the persistence mode of a GPU
+        """
+        device = self._call("nvmlDeviceSetPersistenceMode", handle)
+        with self._lock:
+            device["persistence"] = mode
+
+    def nvmlDeviceGetNumFans(self, handle):
+        """
+        Returns the number of fans of a GPU
+        """
+        return len(self._call("nvmlDeviceGetNumFans", handle)["fan_policy"])
+
+    def nvmlDeviceGetFanSpeed(self, handle):
+        """
+        Returns the speed of the first fan of a GPU in percent
+        """
+        return self._fan(self._call("nvmlDeviceGetFanSpeed", handle), 0)
+
+    def nvmlDeviceGetFanSpeed_v2(self, handle, fan):
+        """
+        Returns the speed of one fan of a GPU in percent
+        """
+        return self._fan(self._call("nvmlDeviceGetFanSpeed_v2", handle), fan)
+
+    def nvmlDeviceGetFanControlPolicy_v2(self, handle, fan, fan_control_policy=None):
+        """
+        Returns the control policy of a fan, or writes it through a ctypes pointer like the real binding
+        """
+        policy = self._call("nvmlDeviceGetFanControlPolicy_v2", handle)["fan_policy"][fan]
+        if fan_control_policy is None:
+            return policy
+        fan_control_policy.contents.value = policy
+        return pynvml.NVML_SUCCESS
+
+    def nvmlDeviceSetFanControlPolicy(self, handle, fan, policy):
+        """
+        Sets the control policy of a fan
+        """
+        device = self._call("nvmlDeviceSetFanControlPolicy", handle)
+        with self._lock:
+            device["fan_policy"][fan] = policy
+
+    def nvmlDeviceSetFanSpeed_v2(self, handle, fan, speed):
+        """
+        Sets the speed of a fan, which has to be under manual control
+        """
+        device = self._call("nvmlDeviceSetFanSpeed_v2", handle)
+        if device["fan_policy"][fan] != pynvml.NVML_FAN_POLICY_MANUAL or not 0 <= speed <= 100:
+            raise pynvml.NVMLError(pynvml.NVML_ERROR_INVALID_ARGUMENT)
+        with self._lock:
+            device["fan_speed"][fan] = speed
+
+    def nvmlDeviceSetDefaultFanSpeed_v2(self, handle, fan):
+        """
+        Puts a fan back to its default speed
+        """
+        device = self._call("nvmlDeviceSetDefaultFanSpeed_v2", handle)
+        with self._lock:
+            device["fan_speed"][fan] = 30
+
+    def nvmlDeviceGetMemoryBusWidth(self, handle):
+        """
+        Returns the memory bus width of a GPU in bits
+        """
+        self._call("nvmlDeviceGetMemoryBusWidth", handle)
+        return 128 + 64 * (handle.index % 3)
+
+    def nvmlDeviceGetBAR1MemoryInfo(self, handle):
+        """
+        Returns the BAR1 memory of a GPU, resizable BAR so it's as big as the VRAM
+        """
+        device = self._call("nvmlDeviceGetBAR1MemoryInfo", handle)
+        return pynvml.c_nvmlBAR1Memory_t(bar1Total=device["mem_total"], bar1Free=device["mem_total"], bar1Used=0)
+
+    def nvmlDeviceGetCudaComputeCapability(self, handle):
+        """
+        Returns the compute capability of a GPU as (major, minor)
+        """
+        self._call("nvmlDeviceGetCudaComputeCapability", handle)
+        return (8, 9)
+
+    def nvmlDeviceGetMaxPcieLinkGeneration(self, handle):
+        """
+        Returns the highest PCIe generation of a GPU
+        """
+        self._call("nvmlDeviceGetMaxPcieLinkGeneration", handle)
+        return 4
+
+    def nvmlDeviceGetMaxPcieLinkWidth(self, handle):
+        """
+        Returns the widest PCIe link of a GPU
+        """
+        self._call("nvmlDeviceGetMaxPcieLinkWidth", handle)
+        return 16
+
+    def nvmlDeviceGetCurrPcieLinkGeneration(self, handle):
+        """
+        Returns the current PCIe generation of a GPU
+        """
+        device = self._call("nvmlDeviceGetCurrPcieLinkGeneration", handle)
+        return 4 if self._load(device) > 0.1 else 1  # Links train down when idle
+
+    def nvmlDeviceGetCurrPcieLinkWidth(self, handle):
+        """
+        Returns the current PCIe link width of a GPU
+        """
+        self._call("nvmlDeviceGetCurrPcieLinkWidth", handle)
+        return 16
+
+    def nvmlDeviceGetComputeRunningProcesses_v3(self, handle):
+        """
+        Returns one compute process per GPU, this one, using VRAM that follows the load
+        """
+        device = self._call("nvmlDeviceGetComputeRunningProcesses_v3", handle)
+        #  Use our own PID so process lookups on the simulated process actually resolve
+        return [SimpleNamespace(pid=os.getpid(), usedGpuMemory=int(device["mem_total"] * 0.5 * self._load(device)),
+                                gpuInstanceId=0xFFFFFFFF, computeInstanceId=0xFFFFFFFF)]
+
+    def nvmlDeviceGetGraphicsRunningProcesses_v3(self, handle):
+        """
+        Returns one graphics process per GPU, our parent, using a fixed amount of VRAM
+        """
+        self._call("nvmlDeviceGetGraphicsRunningProcesses_v3", handle)
+        return [SimpleNamespace(pid=os.getppid(), usedGpuMemory=256 * 1024**2, gpuInstanceId=0xFFFFFFFF, computeInstanceId=0xFFFFFFFF)]
+
+    def nvmlDeviceGetSamples(self, handle, sampling_type, last_seen):
+        """
+        Hands out the driver's sample buffer: one reading every 20 ms for the last 10 s, newer than last_seen (in µs)
+        """
+        device = self._call("nvmlDeviceGetSamples", handle)
+        readings = {pynvml.NVML_TOTAL_POWER_SAMPLES: lambda elapsed: self._power(device, elapsed),
+                    pynvml.NVML_GPU_UTILIZATION_SAMPLES: lambda elapsed: self._load(device, elapsed) * 100,
+                    pynvml.NVML_MEMORY_UTILIZATION_SAMPLES: lambda elapsed: self._load(device, elapsed) * 60,
+                    pynvml.NVML_PROCESSOR_CLK_SAMPLES: lambda elapsed: self._clock(device, pynvml.NVML_CLOCK_GRAPHICS, elapsed),
+                    pynvml.NVML_MEMORY_CLK_SAMPLES: lambda elapsed: self._clock(device, pynvml.NVML_CLOCK_MEM, elapsed)}
+        if sampling_type not in readings:
+            raise pynvml.NVMLError(pynvml.NVML_ERROR_NOT_SUPPORTED)
+        now = int(time.time() * 1000000)
+        step = 20000
+        first = max(last_seen + 1, now - 10000000, int(self._wall_start * 1000000))
+        samples = []
+        for timestamp in range(first + (-first % step), now + 1, step):
+            sample = pynvml.c_nvmlSample_t()
+            sample.timeStamp = timestamp
+            sample.sampleValue.uiVal = int(readings[sampling_type](timestamp / 1000000 - self._wall_start))
+            samples.append(sample)
+        if not samples:
+            raise pynvml.NVMLError(pynvml.NVML_ERROR_NOT_FOUND)
+        return pynvml.NVML_VALUE_TYPE_UNSIGNED_INT, samples
+
+    def nvmlDeviceGetProcessUtilization(self, handle, last_seen):
+        """
+        Returns the utilization of both simulated processes, if the driver took a sample since last_seen (in µs)
+        """
+        device = self._call("nvmlDeviceGetProcessUtilization", handle)
+        now = int(time.time() * 1000000)
+        if now - last_seen < 166000:  # The driver takes a sample about every 1/6th of a second
+            raise pynvml.NVMLError(pynvml.NVML_ERROR_NOT_FOUND)
+        load = self._load(device)
+        return [pynvml.c_nvmlProcessUtilizationSample_t(pid=os.getpid(), timeStamp=now, smUtil=int(load * 90), memUtil=int(load * 55)),
+                pynvml.c_nvmlProcessUtilizationSample_t(pid=os.getppid(), timeStamp=now, smUtil=int(load * 10), memUtil=int(load * 5))]
+
+    def nvmlDeviceGetCurrentClocksEventReasons(self, handle):
+        """
+        Idle when there's next to no load, power capped when the load asks for more than the power limit and thermally
+        slowed down once the card runs hot, which takes manual fans set low
+        """
+        device = self._call("nvmlDeviceGetCurrentClocksEventReasons", handle)
+        load = self._load(device)
+        reasons = pynvml.nvmlClocksThrottleReasonNone
+        if load < 0.1:
+            reasons |= pynvml.nvmlClocksThrottleReasonGpuIdle
+        if 25000 + load * (device["max_power_limit"] - 25000) > device["power_limit"]:
+            reasons |= pynvml.nvmlClocksThrottleReasonSwPowerCap
+        if self._temperature(device) >= 85:
+            reasons |= pynvml.nvmlClocksThrottleReasonSwThermalSlowdown
+        return reasons
+
+    def nvmlDeviceGetTotalEnergyConsumption(self, handle):
+        """
+        Returns the total energy used since the simulation started, in mJ
+        """
+        return self._energy(self._call("nvmlDeviceGetTotalEnergyConsumption", handle))
+
+    def _energy(self, device):
+        """
+        Returns the energy counter of a GPU in mJ, integrating the simulated power draw up to now in small steps
+        """
+        with self._lock:
+            now = time.monotonic() - self._start
+            step = max(0.1, (now - device["energy_elapsed"]) / 100)
+            while device["energy_elapsed"] + step <= now:
+                device["energy"] += self._power(device, device["energy_elapsed"]) * step
+                device["energy_elapsed"] += step
+            return int(device["energy"])
+
+    def nvmlDeviceGetIndex(self, handle):
+        """
+        Returns the index of a GPU
+        """
+        return self._call("nvmlDeviceGetIndex", handle)["index"]
+
+    def nvmlDeviceGetPowerSource(self, handle):
+        """
+        Returns the power source of a GPU, always AC
+        """
+        self._call("nvmlDeviceGetPowerSource", handle)
+        return pynvml.NVML_POWER_SOURCE_AC
+
+    def nvmlDeviceGetSupportedEventTypes(self, handle):
+        """
+        Returns the event types a GPU can raise
+        """
+        self._call("nvmlDeviceGetSupportedEventTypes", handle)
+        return pynvml.nvmlEventTypeClock | pynvml.nvmlEventTypeXidCriticalError  # Desktop cards, so no power source changes
+
+    def nvmlEventSetCreate(self):
+        """
+        Returns a new, empty event set
+        """
+        self._call("nvmlEventSetCreate")
+        return SimpleNamespace(masks={}, clocks={})
+
+    def nvmlDeviceRegisterEvents(self, handle, event_types, event_set):
+        """
+        Adds event types of a GPU to an event set, types the GPU can't raise are not supported
+        """
+        self._call("nvmlDeviceRegisterEvents", handle)
+        if event_types & ~self.nvmlDeviceGetSupportedEventTypes(handle):
+            raise pynvml.NVMLError(pynvml.NVML_ERROR_NOT_SUPPORTED)
+        event_set.masks[handle.index] = event_set.masks.get(handle.index, 0) | event_types
+
+    def nvmlEventSetWait_v2(self, event_set, timeout_ms):
+        """
+        Raises a clock event whenever the core clock of a registered GPU moved by 250 MHz or more and, with an error
+        rate set, the odd Xid 79. Polls the simulated state until something happens or the timeout runs out
+        """
+        self._call("nvmlEventSetWait_v2")
+        deadline = time.monotonic() + timeout_ms / 1000
+        while True:
+            for index, mask in list(event_set.masks.items()):
+                event_type, event_data = None, 0
+                if mask & pynvml.nvmlEventTypeClock:
+                    clock = self._clock(self._devices[index], pynvml.NVML_CLOCK_GRAPHICS)
+                    if abs(clock - event_set.clocks.setdefault(index, clock)) >= 250:
+                        event_set.clocks[index] = clock
+                        event_type = pynvml.nvmlEventTypeClock
+                if event_type is None and mask & pynvml.nvmlEventTypeXidCriticalError and self.error_rate:
+                    with self._lock:
+                        fell_off = self._random.random() < self.error_rate / 10
+                    if fell_off:
+                        event_type, event_data = pynvml.nvmlEventTypeXidCriticalError, 79
+                if event_type is not None:
+                    return SimpleNamespace(device=self._handles[index], eventType=event_type, eventData=event_data,
+                                           gpuInstanceId=0xFFFFFFFF, computeInstanceId=0xFFFFFFFF)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise pynvml.NVMLError(pynvml.NVML_ERROR_TIMEOUT)
+            time.sleep(min(0.05, remaining))
+
+    def nvmlEventSetFree(self, event_set):
+        """
+        Releases an event set
+        """
+        self._call("nvmlEventSetFree")
+        event_set.masks.clear()
+
+
+def _field_value(field):
+    """
+    Helper function to pull the number out of an nvmlFieldValue_t based on its value type
+    """
+    return getattr(field.value, _FIELD_VALUE_MEMBERS.get(field.valueType, "ullVal"))
+
+
+def read_batched_fields(index, gpu):
+    """
+    Reads every metric in BATCH_FIELDS with a single nvmlDeviceGetFieldValues call. Returns a dict of the ones the
+    driver could serve, anything missing from it has to be read with its own call. Takes in the GPU index and handle
+    """
+    if not BATCH_FIELDS or _field_batch_supported.get(index) is False:
+        return {}
+    try:
+        values = nv.nvmlDeviceGetFieldValues(gpu, [(field_id, scope_id) for _, field_id, scope_id in BATCH_FIELDS])
+    except (nv.NVMLError_NotSupported, nv.NVMLError_FunctionNotFound):
+        _field_batch_supported[index] = False  # Old driver, don't bother asking again
+        return {}
+    except nv.NVMLError:
+        return {}
+    _field_batch_supported[index] = True
+    return {name: _field_value(value) for (name, _, _), value in zip(BATCH_FIELDS, values) if value.nvmlReturn == nv.NVML_SUCCESS}
+
+
+def read_clock_offsets(gpu):
+    """
+    Returns the (core, memory) clock offsets of a GPU in MHz, the memory one the way GWE and Windows count it
+    """
+    core_offset = nv.nvmlDeviceGetGpcClkVfOffset(gpu)
+    mem_offset = nv.nvmlDeviceGetMemClkVfOffset(gpu) / 2
+    #  If the offset is negative, pynvml may return a value that is munged by truncated overflow
+    #  Since offsets will never legitimately be this large, this should be a safe fix.
+    if core_offset > 100000:
+        core_offset = core_offset - 4294966
+    if mem_offset > 100000:
+        mem_offset = mem_offset - 4294966
+    return core_offset, mem_offset
+
+
+def read_clock_reasons(gpu):
+    """
+    Returns the bitmask of reasons the driver currently holds the clocks of a GPU back for, see CLOCK_REASONS
+    """
+    try:
+        return nv.nvmlDeviceGetCurrentClocksEventReasons(gpu)
+    except (AttributeError, nv.NVMLError_FunctionNotFound):  # Bindings or driver from before the rename
+        return nv.nvmlDeviceGetCurrentClocksThrottleReasons(gpu)
+
+
+def active_clock_reasons(mask):
+    """
+    Returns the names of the CLOCK_REASONS set in a bitmask
+    """
+    return [name for name, _, reason in CLOCK_REASONS if mask & reason]
+
+
+def read_fan_policy(gpu, fan):
+    """
+    Returns the control policy of one fan of a GPU
+    """
+    fan_policy = ctypes.c_uint()
+    nv.nvmlDeviceGetFanControlPolicy_v2(gpu, fan, ctypes.pointer(fan_policy))
+    return fan_policy.value
+
+
+class CapabilityMap:
+    """
+    Remembers which optional NVML queries every GPU can answer, so read_sample doesn't keep paying for the ones it can't.
+    A query that raises NotSupported is never tried on that GPU again, and given a path that is remembered across runs
+    keyed by driver version and GPU UUID. A query that fails or is slow FAILURE_LIMIT times in a row trips a circuit
+    breaker and is skipped for a cooldown, which doubles every time it trips again right after being let through.
+    """
+    FAILURE_LIMIT = 3
+    SLOW_CALL = 0.25  # Seconds, a call taking longer than this counts as a failure even if it answered
+    COOLDOWN = 5
+    MAX_COOLDOWN = 300
+
+    def __init__(self, path=None):
+        self.path = path
+        self.driver_version = None
+        self.unsupported = {}  # {device key: set of query names}
+        self._breakers = {}  # {(device key, query name): [failures in a row, open until, cooldown]}
+        self._lock = threading.Lock()
+
+    def load(self, driver_version):
+        """
+        Picks up what earlier runs found out, if they ran on the same driver version
+        """
+        self.driver_version = driver_version
+        if self.path is None:
+            return
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return  # Missing or damaged, it only costs probing everything once
+        if isinstance(data, dict) and data.get("driver") == driver_version and isinstance(data.get("gpus"), dict):
+            with self._lock:
+                self.unsupported = {key: set(names) for key, names in data["gpus"].items()}
+
+    def _save(self):
+        """
+        Writes the unsupported queries to path, if there is one. Call with the lock held
+        """
+        if self.path is None:
+            return
+        data = {"driver": self.driver_version, "gpus": {key: sorted(names) for key, names in self.unsupported.items()}}
+        try:
+            with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=os.path.dirname(os.path.abspath(self.path)), prefix=".capabilities-", delete=False) as file:
+                os.fchmod(file.fileno(), replacement_mode(self.path))
+                json.dump(data, file, indent=2)
+            os.replace(file.name, self.path)
+        except OSError:
+            pass  # Not being able to cache this is no reason to stop monitoring
+
+    def available(self, key, name):
+        """
+        Returns False if a query is unsupported on a GPU or its circuit breaker is open
+        """
+        with self._lock:
+            breaker = self._breakers.get((key, name))
+            return name not in self.unsupported.get(key, ()) and (breaker is None or breaker[1] <= time.monotonic())
+
+    def skipped(self, key):
+        """
+        Returns the names of the queries currently skipped on a GPU, unsupported or with an open breaker
+        """
+        with self._lock:
+            names = set(self.unsupported.get(key, ())) | {name for (breaker_key, name) in self._breakers if breaker_key == key}
+        return sorted(name for name in names if not self.available(key, name))
+
+    def _failed(self, key, name):
+        with self._lock:
+            breaker = self._breakers.setdefault((key, name), [0, 0, self.COOLDOWN / 2])
+            breaker[0] += 1
+            if breaker[0] >= self.FAILURE_LIMIT:
+                breaker[2] = min(self.MAX_COOLDOWN, breaker[2] * 2)
+                breaker[1] = time.monotonic() + breaker[2]
+                breaker[0] = self.FAILURE_LIMIT - 1  # After the cooldown a single failure trips it again
+
+    def call(self, key, name, function, *query_args, default=None):
+        """
+        Runs an optional query for the GPU with the given key, returns default instead if it is unsupported, failing
+        or its breaker is open. Losing the GPU altogether is still raised
+        """
+        if not self.available(key, name):
+            return default
+        started = time.perf_counter()
+        try:
+            value = function(*query_args)
+        except (nv.NVMLError_NotSupported, nv.NVMLError_FunctionNotFound):
+            with self._lock:
+                self.unsupported.setdefault(key, set()).add(name)
+                self._save()
+            return default
+        except (nv.NVMLError_GpuIsLost, nv.NVMLError_Uninitialized):
+            raise  # That's not about this query, the caller has to deal with it
+        except nv.NVMLError:
+            self._failed(key, name)
+            return default
+        if time.perf_counter() - started > self.SLOW_CALL:
+            self._failed(key, name)
+        else:
+            with self._lock:
+                self._breakers.pop((key, name), None)
+        return value
+
+
+def read_sample(index, gpu):
+    """
+    Reads the current state of a GPU and returns it as an immutable Sample. Takes in the GPU index and handle
+    """
+    monotonic = time.monotonic()
+    timestamp = time.time()
+    calls_before = nv.thread_calls()
+    batched = read_batched_fields(index, gpu)
+    power_usage = batched["power_usage"] if "power_usage" in batched else nv.nvmlDeviceGetPowerUsage(gpu)
+    power_limit = batched["power_limit"] if "power_limit" in batched else nv.nvmlDeviceGetPowerManagementLimit(gpu)
+    #  Passively cooled cards have no fans and older drivers no clock offsets, those read as auto/0 when missing
+    key = profile_key(get_device_info(index, gpu))
+    core_offset, mem_offset = capabilities.call(key, "clock_offsets", read_clock_offsets, gpu, default=(0, 0))
+    fan_policy = capabilities.call(key, "fan_policy", read_fan_policy, gpu, 0, default=nv.NVML_FAN_POLICY_TEMPERATURE_CONTINOUS_SW)
+    fan_speed = capabilities.call(key, "fan_speed", nv.nvmlDeviceGetFanSpeed, gpu, default=0)
+    clock_reasons = capabilities.call(key, "clock_reasons", read_clock_reasons, gpu, default=0)
+    energy = batched["energy"] if "energy" in batched else capabilities.call(key, "energy", nv.nvmlDeviceGetTotalEnergyConsumption, gpu, default=0)  # 0 means unknown
+    temperature = nv.nvmlDeviceGetTemperature(gpu, 0)
+    utilization = nv.nvmlDeviceGetUtilizationRates(gpu)
+    mem_info = nv.nvmlDeviceGetMemoryInfo(gpu)
+    core_clock = nv.nvmlDeviceGetClockInfo(gpu, nv.NVML_CLOCK_GRAPHICS)
+    mem_clock = nv.nvmlDeviceGetClockInfo(gpu, nv.NVML_CLOCK_MEM)
+    return Sample(timestamp=timestamp,
+                  monotonic=monotonic,
+                  core_offset=core_offset,
+                  mem_offset=mem_offset,
+                  fan_policy=fan_policy,
+                  fan_speed=fan_speed,
+                  temperature=temperature,
+                  power_usage=power_usage / 1000,  # Convert mW to W
+                  power_limit=power_limit / 1000,
+                  gpu_util=utilization.gpu,
+                  mem_util=utilization.memory,
+                  mem_used=mem_info.used,
+                  mem_total=mem_info.total,
+                  core_clock=core_clock,
+                  mem_clock=mem_clock,
+                  clock_reasons=clock_reasons,
+                  energy=energy,  # mJ since the driver loaded
+                  nvml_calls=nv.thread_calls() - calls_before)
+
+
+Profile = namedtuple("Profile", ["core_offset", "mem_offset", "power_limit", "fan_policy", "fan_speed"])
+
+
+def summarize(values):
+    """
+    Returns the BufferStats of a list of readings, the p99 by nearest rank
+    """
+    ordered = sorted(values)
+    return BufferStats(count=len(ordered), min=ordered[0], avg=sum(ordered) / len(ordered), max=ordered[-1],
+                       p99=ordered[max(0, math.ceil(len(ordered) * 0.99) - 1)])
+
+
+class SampleBuffers:
+    """
+    Drains the sample buffers the driver fills on its own for power, utilization and clocks. It samples these far more
+    often than we poll, so spikes and dips that fall between two of our reads still show up. The newest timestamp seen
+    is kept per GPU and buffer so every read only gets what is new since the last one.
+    """
+    def __init__(self, window):
+        self.window = window  # How far back the first read of a GPU looks, in seconds
+        self._last_seen = {}  # {(index, sampling type): driver timestamp in µs}
+        self._unsupported = set()
+
+    def read(self, index, gpu):
+        """
+        Returns {Sample field: BufferStats} of what the driver buffered since the last read of a GPU, buffers without
+        anything new are left out. Takes in the GPU index and handle
+        """
+        stats = {}
+        for name, sampling_type, scale in SAMPLE_BUFFERS:
+            key = (index, sampling_type)
+            if key in self._unsupported:
+                continue
+            last_seen = self._last_seen.get(key, int((time.time() - self.window) * 1000000))
+            try:
+                value_type, samples = nv.nvmlDeviceGetSamples(gpu, sampling_type, last_seen)
+            except (nv.NVMLError_NotSupported, nv.NVMLError_FunctionNotFound):
+                self._unsupported.add(key)  # Don't bother asking again
+                continue
+            except nv.NVMLError:
+                continue  # NotFound just means nothing new, anything else the regular sample will report
+            samples = [sample for sample in samples if sample.timeStamp > last_seen]
+            if not samples:
+                continue
+            self._last_seen[key] = max(sample.timeStamp for sample in samples)
+            member = _FIELD_VALUE_MEMBERS.get(value_type, "ullVal")
+            stats[name] = summarize([getattr(sample.sampleValue, member) * scale for sample in samples])
+        return stats
+
+
+def set_clock_offsets(gpu, core_offset, mem_offset):
+    """
+    Sets the core and memory clock offsets of a GPU in MHz
+    """
+    nv.nvmlDeviceSetGpcClkVfOffset(gpu, core_offset)
+    nv.nvmlDeviceSetMemClkVfOffset(gpu, mem_offset * 2)  # Multiply memoffset by 2 so it's equivalent to offset in GWE and Windows
+
+
+def set_power_limit(gpu, power_limit):
+    """
+    Sets the power limit of a GPU in watts
+    """
+    nv.nvmlDeviceSetPowerManagementLimit(gpu, power_limit * 1000)
+
+
+def set_fan(gpu, fan, speed):
+    """
+    Puts a fan under manual control at speed percent, or back under automatic control if speed is None
+    """
+    if speed is None:
+        nv.nvmlDeviceSetFanControlPolicy(gpu, fan, nv.NVML_FAN_POLICY_TEMPERATURE_CONTINOUS_SW)
+        nv.nvmlDeviceSetDefaultFanSpeed_v2(gpu, fan)
+    else:
+        nv.nvmlDeviceSetFanControlPolicy(gpu, fan, nv.NVML_FAN_POLICY_MANUAL)
+        nv.nvmlDeviceSetFanSpeed_v2(gpu, fan, speed)
+
+
+def check_profile(profile):
+    """
+    Raises ValueError if a Profile doesn't make sense, returns it otherwise
+    """
+    if profile.fan_policy == 1 and not 101 > profile.fan_speed > 29:
+        raise ValueError("Invalid fan speed setting in profile!")
+    return profile
+
+
+def profile_from_sample(sample):
+    """
+    Turns the current settings in a Sample into a Profile
+    """
+    return Profile(int(sample.core_offset), int(sample.mem_offset), int(sample.power_limit), sample.fan_policy, sample.fan_speed)
+
+
+def profile_key(info):
+    """
+    Returns the key a GPU's profiles are stored under, its UUID so they follow the card if it changes slots
+    """
+    return info.uuid or f"GPU{info.index}"  # Only if the driver can't tell us the UUID
+
+
+class ProfileStore:
+    """
+    Every saved profile in one JSON file, by GPU and then by name. The file is read into memory once and only read
+    again when its modification time or size changes. Writes go to a temporary file that then replaces the store,
+    so a crash or a full disk never leaves a half written store behind.
+    """
+    LEGACY_PATTERN = re.compile(r"profile(\d+)_(\d+)\.bnt")  # The one profile per file format from before the store
+
+    def __init__(self, path):
+        self.path = path
+        self._profiles = {}  # {key: {name: Profile}}
+        self._stamp = None
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        """
+        Loads the store from disk if it changed since we last looked. Call with the lock held
+        """
+        try:
+            file_stat = os.stat(self.path)
+        except FileNotFoundError:
+            self._profiles = {}
+            self._stamp = None
+            return
+        stamp = (file_stat.st_mtime_ns, file_stat.st_size)
+        if stamp == self._stamp:
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+            self._profiles = {key: {name: Profile(**values) for name, values in gpu["profiles"].items()}
+                              for key, gpu in data.get("gpus", {}).items()}
+        except (KeyError, TypeError, AttributeError, ValueError) as e:
+            raise ValueError(f"The profile store {self.path} is damaged: {e}") from None
+        self._stamp = stamp
+
+    def _write(self, profiles):
+        """
+        Atomically replaces the store on disk with profiles. Call with the lock held
+        """
+        data = {"version": 1,
+                "gpus": {key: {"profiles": {name: profile._asdict() for name, profile in named.items()}}
+                         for key, named in profiles.items() if named}}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=directory, prefix=".profiles-", delete=False) as file:
+            os.fchmod(file.fileno(), replacement_mode(self.path))
+            json.dump(data, file, indent=2)
+            file.flush()
+            os.fsync(file.fileno())
+        try:
+            os.replace(file.name, self.path)
+        except OSError:
+            os.unlink(file.name)
+            raise
+        file_stat = os.stat(self.path)
+        self._profiles = profiles
+        self._stamp = (file_stat.st_mtime_ns, file_stat.st_size)
+
+    def names(self, key):
+        """
+        Returns the names of the profiles saved for a GPU, numbers first in numeric order then the rest alphabetically
+        """
+        with self._lock:
+            self._refresh()
+            names = list(self._profiles.get(key, {}))
+        return sorted(names, key=lambda name: (not name.isdigit(), int(name) if name.isdigit() else 0, name))
+
+    def get(self, key, name):
+        """
+        Returns a saved Profile, raises KeyError if there is no such profile for that GPU
+        """
+        with self._lock:
+            self._refresh()
+            return self._profiles.get(key, {})[name]
+
+    def save(self, key, name, profile):
+        """
+        Saves a Profile under a name for a GPU, replacing any profile that already has that name
+        """
+        check_profile(profile)
+        with self._lock:
+            self._refresh()
+            profiles = {gpu_key: dict(named) for gpu_key, named in self._profiles.items()}
+            profiles.setdefault(key, {})[name] = profile
+            self._write(profiles)
+
+    def delete(self, key, name):
+        """
+        Deletes a saved profile, returns False if there was no such profile
+        """
+        with self._lock:
+            self._refresh()
+            if name not in self._profiles.get(key, {}):
+                return False
+            profiles = {gpu_key: dict(named) for gpu_key, named in self._profiles.items()}
+            del profiles[key][name]
+            self._write(profiles)
+            return True
+
+    def import_legacy(self, directory, key_for_index):
+        """
+        Imports the old profile{n}_{gpu}.bnt files from directory the first time the store is used, profile n becomes
+        profile "n". key_for_index returns the key for a GPU index. The old files are left alone. Returns how many
+        profiles were imported
+        """
+        if os.path.exists(self.path):
+            return 0
+        legacy = []
+        for file_name in sorted(os.listdir(directory)):
+            match = self.LEGACY_PATTERN.fullmatch(file_name)
+            if match:
+                legacy.append((match.group(1), int(match.group(2)), os.path.join(directory, file_name)))
+        if not legacy:
+            return 0
+        profiles = {}
+        for name, index, path in legacy:
+            try:
+                with open(path, "r", encoding="utf-8") as file:
+                    profile = check_profile(Profile(*(int(file.readline()) for _ in Profile._fields)))
+                profiles.setdefault(key_for_index(index), {})[name] = profile
+            except (OSError, ValueError, nv.NVMLError):
+                continue  # Unreadable, nonsensical or for a GPU that isn't there anymore
+        with self._lock:
+            self._write(profiles)
+        return sum(len(named) for named in profiles.values())
+
+
+def read_fans(gpu, num_fans):
+    """
+    Returns a (policy, speed) tuple for every fan of a GPU
+    """
+    fans = []
+    for i in range(0, num_fans):
+        fans.append((read_fan_policy(gpu, i), nv.nvmlDeviceGetFanSpeed_v2(gpu, i)))
+    return fans
+
+
+def apply_profile(gpu, num_fans, profile):
+    """
+    Applies a Profile to a GPU with num_fans fans as one transaction. The current settings are read first and only the
+    ones that differ from the profile are written. If a write fails, everything written so far is put back the way it
+    was before the error is raised, so a GPU never ends up with half a profile. Returns how many settings were changed
+    """
+    core_offset, mem_offset = read_clock_offsets(gpu)
+    power_limit = nv.nvmlDeviceGetPowerManagementLimit(gpu)
+    fans = read_fans(gpu, num_fans)
+    changes = []  # (apply, undo) pairs
+    if int(core_offset) != profile.core_offset:
+        changes.append((lambda: nv.nvmlDeviceSetGpcClkVfOffset(gpu, profile.core_offset),
+                        lambda: nv.nvmlDeviceSetGpcClkVfOffset(gpu, int(core_offset))))
+    if int(mem_offset) != profile.mem_offset:
+        changes.append((lambda: nv.nvmlDeviceSetMemClkVfOffset(gpu, profile.mem_offset * 2),
+                        lambda: nv.nvmlDeviceSetMemClkVfOffset(gpu, int(mem_offset * 2))))
+    if power_limit // 1000 != profile.power_limit:  # Profiles keep whole watts, see profile_from_sample
+        changes.append((lambda: set_power_limit(gpu, profile.power_limit),
+                        lambda: nv.nvmlDeviceSetPowerManagementLimit(gpu, power_limit)))
+    for i, (fan_policy, fan_speed) in enumerate(fans):
+        if profile.fan_policy == 1:
+            if fan_policy == nv.NVML_FAN_POLICY_MANUAL and fan_speed == profile.fan_speed:
+                continue
+        elif fan_policy != nv.NVML_FAN_POLICY_MANUAL:
+            continue
+        old_speed = fan_speed if fan_policy == nv.NVML_FAN_POLICY_MANUAL else None
+        changes.append((lambda i=i: set_fan(gpu, i, profile.fan_speed if profile.fan_policy == 1 else None),
+                        lambda i=i, old_speed=old_speed: set_fan(gpu, i, old_speed)))
+    applied = []
+    try:
+        for apply, undo in changes:
+            applied.append(undo)  # Undo the failing one too, setting a fan is two writes and the first may have landed
+            apply()
+    except nv.NVMLError:
+        for undo in reversed(applied):
+            try:
+                undo()
+            except nv.NVMLError:
+                pass  # Keep restoring the rest, one stuck setting is better than all of them
+        raise
+    return len(changes)
+
+
+class FanCurveController(threading.Thread):
+    """
+    Software fan curve for one GPU. Reads the temperature at a fixed interval and runs the fans at the speed the curve
+    asks for. Hysteresis keeps the fans from hunting while the temperature hovers around a curve point, the ramp limit
+    keeps them from jumping, and the driver is only written to when the speed actually changes.
+    Stopping, or exiting for any reason Python still gets to clean up after, hands the fans back to automatic control.
+    """
+    def __init__(self, index, gpu, num_fans, curve, interval, hysteresis=3, ramp=10):
+        super().__init__(name=f"bnt-fan-curve-{index}", daemon=True)
+        self.index = index
+        self.gpu = gpu
+        self.num_fans = num_fans
+        self.curve = curve  # Sorted list of (temperature, speed) points
+        self.interval = interval
+        self.hysteresis = hysteresis  # In °C
+        self.ramp = ramp  # Most the speed may change by in a second, in percent
+        self.temperature = None
+        self.target = None
+        self.speed = None  # What the fans were last set to
+        self.error = None
+        self._effective = None
+        self._current = None
+        self._manual = False
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        atexit.register(self.release)
+
+    def curve_speed(self, temperature):
+        """
+        Returns the fan speed the curve gives for a temperature, linear between the points and flat past the ends
+        """
+        if temperature <= self.curve[0][0]:
+            return self.curve[0][1]
+        for (low_temp, low_speed), (high_temp, high_speed) in zip(self.curve, self.curve[1:]):
+            if temperature <= high_temp:
+                return low_speed + (high_speed - low_speed) * (temperature - low_temp) / (high_temp - low_temp)
+        return self.curve[-1][1]
+
+    def step(self, temperature, elapsed):
+        """
+        Feeds in a temperature reading taken elapsed seconds after the last one, returns the fan speed to run at
+        """
+        #  Follow rises right away but only follow drops once they are larger than the hysteresis
+        if self._effective is None or temperature > self._effective:
+            self._effective = temperature
+        elif temperature < self._effective - self.hysteresis:
+            self._effective = temperature + self.hysteresis
+        self.target = self.curve_speed(self._effective)
+        if self._current is None:
+            self._current = self.target
+        else:
+            limit = self.ramp * elapsed
+            self._current += max(-limit, min(limit, self.target - self._current))
+        return round(self._current)
+
+    def _apply(self, speed):
+        """
+        Sets every fan to speed, the first time also takes them over from the driver
+        """
+        with self._lock:
+            if self._stop_event.is_set():
+                return
+            for i in range(0, self.num_fans):
+                if self._manual:
+                    nv.nvmlDeviceSetFanSpeed_v2(self.gpu, i, speed)
+                else:
+                    set_fan(self.gpu, i, speed)
+            self._manual = True
+            self.speed = speed
+
+    def run(self):
+        try:
+            self._current = nv.nvmlDeviceGetFanSpeed_v2(self.gpu, 0)  # Ramp from wherever the fans are now
+        except nv.NVMLError:
+            pass
+        last_reading = time.monotonic()
+        while True:
+            try:
+                temperature = nv.nvmlDeviceGetTemperature(self.gpu, 0)
+                now = time.monotonic()
+                speed = self.step(temperature, now - last_reading)
+                last_reading = now
+                self.temperature = temperature
+                if speed != self.speed:
+                    self._apply(speed)
+                self.error = None
+            except nv.NVMLError as e:
+                self.error = e
+            if self._stop_event.wait(self.interval):
+                break
+
+    def release(self):
+        """
+        Hands the fans back to the driver's automatic control, safe to call more than once
+        """
+        with self._lock:
+            self._stop_event.set()
+            if not self._manual:
+                return
+            for i in range(0, self.num_fans):
+                try:
+                    set_fan(self.gpu, i, None)
+                except nv.NVMLError:
+                    pass  # Keep going, every fan we do get back is one less stuck at a fixed speed
+            self._manual = False
+
+    def stop(self):
+        """
+        Stops the controller and restores automatic fan control
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(self.interval + 1)
+        self.release()
+
+
+def allocate_power(budget, devices, headroom=0.1):
+    """
+    Splits a node power budget in watts between GPUs. Takes a list of (min_limit, max_limit, usage, limit, utilization)
+    tuples in watts and percent, returns the new power limit for each GPU in the same order. Every GPU gets its
+    minimum, then what it's drawing plus some headroom, and whatever is left goes to the busiest GPUs first. A GPU that
+    is pinned against its current limit while busy can't show how much it would draw, so it asks for its current limit
+    plus the headroom and keeps growing from there step by step.
+    """
+    limits = [min_limit for min_limit, _, _, _, _ in devices]
+    remaining = budget - sum(limits)
+    if remaining <= 0:
+        return limits
+    wants = []
+    for min_limit, max_limit, usage, limit, utilization in devices:
+        if usage >= limit * 0.95 and utilization >= 50:
+            usage = limit
+        wants.append(min(max_limit, max(min_limit, usage * (1 + headroom) + 10)) - min_limit)
+    #  Cover what everyone wants, scaled down evenly if the budget doesn't stretch that far
+    scale = min(1.0, remaining / sum(wants)) if sum(wants) else 0
+    for i, want in enumerate(wants):
+        limits[i] += want * scale
+    remaining -= sum(wants) * scale
+    #  Hand out the rest by utilization until it's gone or everyone is at their maximum
+    while remaining > 0.5:
+        open_devices = [i for i, (_, max_limit, _, _, _) in enumerate(devices) if limits[i] < max_limit - 0.5]
+        if not open_devices:
+            break
+        weights = {i: devices[i][4] + 1 for i in open_devices}
+        total_weight = sum(weights.values())
+        handed_out = 0
+        for i in open_devices:
+            extra = min(remaining * weights[i] / total_weight, devices[i][1] - limits[i])
+            limits[i] += extra
+            handed_out += extra
+        remaining -= handed_out
+    return limits
+
+
+class PowerGovernor(threading.Thread):
+    """
+    Keeps the power limits of a set of GPUs within a total budget for the node, moving headroom from idle GPUs to busy
+    ones as the load shifts. Raised limits are only written when they move by more than the deadband, lowered ones
+    always are and before the raised ones, so the sum of the limits never goes over the budget, not even halfway through.
+    The original limits are restored when it stops.
+    """
+    def __init__(self, gpus, budget, interval, deadband=5):
+        super().__init__(name="bnt-power-governor", daemon=True)
+        self.gpus = gpus  # List of (index, handle) tuples
+        self.budget = budget
+        self.interval = interval
+        self.deadband = deadband
+        self.infos = {index: get_device_info(index, handle) for index, handle in gpus}
+        for info in self.infos.values():
+            if info.min_power_limit is None:
+                raise ValueError(f"GPU {info.index} doesn't report its power limit range so it can't be governed")
+        if budget < sum(info.min_power_limit for info in self.infos.values()):
+            raise ValueError(f"A budget of {budget} W is less than the {sum(info.min_power_limit for info in self.infos.values()):.0f} W the selected GPUs need at minimum")
+        self.original_limits = {index: nv.nvmlDeviceGetPowerManagementLimit(handle) for index, handle in gpus}
+        self.limits = {index: limit / 1000 for index, limit in self.original_limits.items()}
+        self.error = None
+        self.listeners = []  # Called as listener(limits, usage) on the governor thread whenever limits change
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._restored = False
+        atexit.register(self.restore)
+
+    def rebalance(self):
+        """
+        Measures every GPU and moves the power limits toward a new split of the budget. Returns True if anything changed
+        """
+        usage = {}
+        devices = []
+        for index, handle in self.gpus:
+            usage[index] = nv.nvmlDeviceGetPowerUsage(handle) / 1000
+            utilization = nv.nvmlDeviceGetUtilizationRates(handle).gpu
+            info = self.infos[index]
+            devices.append((info.min_power_limit, info.max_power_limit, usage[index], self.limits[index], utilization))
+        new_limits = allocate_power(self.budget, devices)
+        #  A GPU kept above its new share would eat into what the others were raised by, so only raises get the deadband
+        changes = [(index, handle, int(new_limit)) for (index, handle), new_limit in zip(self.gpus, new_limits)
+                   if int(new_limit) < self.limits[index] or new_limit - self.limits[index] >= self.deadband]
+        if not changes:
+            return False
+        with self._lock:
+            if self._stop_event.is_set():
+                return False
+            for index, handle, new_limit in sorted(changes, key=lambda change: change[2] - self.limits[change[0]]):
+                nv.nvmlDeviceSetPowerManagementLimit(handle, new_limit * 1000)
+                self.limits[index] = new_limit
+        for listener in self.listeners:
+            listener(dict(self.limits), usage)
+        return True
+
+    def run(self):
+        while True:
+            try:
+                self.rebalance()
+                self.error = None
+            except nv.NVMLError as e:
+                self.error = e
+            if self._stop_event.wait(self.interval):
+                break
+
+    def restore(self):
+        """
+        Puts back the power limits the GPUs had before the governor started, safe to call more than once
+        """
+        with self._lock:
+            self._stop_event.set()
+            if self._restored:
+                return
+            self._restored = True
+            #  Lower first here too so we don't overshoot the budget on the way back
+            for index, handle in sorted(self.gpus, key=lambda gpu: self.original_limits[gpu[0]] - self.limits[gpu[0]] * 1000):
+                try:
+                    nv.nvmlDeviceSetPowerManagementLimit(handle, self.original_limits[index])
+                except nv.NVMLError:
+                    pass
+
+    def stop(self):
+        """
+        Stops the governor and restores the original power limits
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(self.interval + 1)
+        self.restore()
+
+
+class AdaptiveInterval:
+    """
+    Works out how long to wait before the next sample of a GPU from how much its metrics moved since the last one.
+    Any metric moving by its threshold or more drops straight to the minimum interval, a quiet sample backs off
+    by half again up to the maximum. Keeps its state per GPU index so one can pace any number of GPUs.
+    """
+    BACKOFF = 1.5
+
+    def __init__(self, minimum, maximum, thresholds):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.thresholds = thresholds  # {Sample field: smallest change that counts as volatile}
+        self._previous = {}
+        self._intervals = {}
+
+    def interval(self, index):
+        """
+        Returns the interval a GPU is currently sampled at
+        """
+        return self._intervals.get(index, self.minimum)
+
+    def reset(self, index):
+        """
+        Forgets what was seen of a GPU, it starts over at the minimum interval
+        """
+        self._previous.pop(index, None)
+        self._intervals.pop(index, None)
+
+    def next(self, index, sample):
+        """
+        Feeds in a new sample of a GPU and returns the interval to wait before the next one
+        """
+        previous = self._previous.get(index)
+        self._previous[index] = sample
+        if previous is None or any(abs(getattr(sample, metric) - getattr(previous, metric)) >= threshold
+                                   for metric, threshold in self.thresholds.items()):
+            interval = self.minimum
+        else:
+            interval = min(self.maximum, self.interval(index) * self.BACKOFF)
+        self._intervals[index] = interval
+        return interval
+
+
+def make_adaptive():
+    """
+    Returns the AdaptiveInterval asked for on the command line, or None if sampling is at a fixed rate
+    """
+    if not args.adaptive:
+        return None
+    return AdaptiveInterval(args.min_refresh_rate / 1000, args.max_refresh_rate / 1000, args.adaptive_thresholds)
+
+
+def make_buffers():
+    """
+    Returns a SampleBuffers if --sample-buffers was given, else None
+    """
+    return SampleBuffers(args.refresh_rate / 1000) if args.sample_buffers else None
+
+
+class Sampler(threading.Thread):
+    """
+    Background thread that polls a GPU at a fixed cadence, or one an AdaptiveInterval picks, and publishes immutable
+    Sample snapshots. Readers only ever look at the latest snapshot so a slow driver call never blocks them.
+    """
+    def __init__(self, index, gpu, interval, adaptive=None, buffers=None):
+        super().__init__(name="bnt-sampler", daemon=True)
+        self.index = index
+        self.gpu = gpu
+        self.interval = interval
+        self.adaptive = adaptive
+        self.buffers = buffers
+        self.stats = {}  # {Sample field: BufferStats} from the driver's sample buffers, if a SampleBuffers was given
+        self.current_interval = adaptive.minimum if adaptive is not None else interval
+        self.latest = None
+        self.error = None
+        self.generation = 0
+        self.listeners = []  # Called as listener(index, sample) on the sampler thread for every new sample
+        self.samples = 0  # Running totals for --benchmark
+        self.sample_seconds = 0.0
+        self.sample_max = 0.0
+        self.nvml_calls = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._published = threading.Condition(self._lock)
+
+    def set_gpu(self, index, gpu):
+        """
+        Switches the sampler to a different GPU, dropping the snapshot of the old one
+        """
+        with self._lock:
+            self.index = index
+            self.gpu = gpu
+            self.latest = None
+            self.error = None
+            self.stats = {}
+            if self.adaptive is not None:
+                self.adaptive.reset(index)
+        self.poke()
+
+    def poke(self):
+        """
+        Asks the sampler to take a new sample right away, e.g. after a setting was changed
+        """
+        self._wake.set()
+
+    def stop(self):
+        """
+        Stops the sampler and waits briefly for it to finish an in-flight driver call
+        """
+        self._stop_event.set()
+        self._wake.set()
+        if self.is_alive():
+            self.join(timeout=2)
+
+    def wait_for_sample(self, timeout=None):
+        """
+        Blocks until a snapshot is available (or the timeout expires) and returns it
+        """
+        with self._published:
+            self._published.wait_for(lambda: self.latest is not None or self.error is not None, timeout)
+            return self.latest
+
+    def run(self):
+        next_deadline = time.monotonic()
+        while not self._stop_event.is_set():
+            with self._lock:  # Both at once, so a set_gpu in between can't pair one GPU's handle with another's index
+                index = self.index
+                gpu = self.gpu
+            started = time.perf_counter()
+            calls_before = nv.thread_calls()
+            try:
+                sample = read_sample(index, gpu)
+                stats = self.buffers.read(index, gpu) if self.buffers is not None else {}
+                error = None
+            except (nv.NVMLError_GpuIsLost, nv.NVMLError_Uninitialized) as e:
+                #  The driver was reset or the GPU fell off the bus, anything we cached about it may be stale now
+                invalidate_device_info(index)
+                sample = None
+                error = e
+            except nv.NVMLError as e:
+                sample = None
+                error = e
+            elapsed = time.perf_counter() - started
+            calls = nv.thread_calls() - calls_before
+            with self._published:
+                self.samples += 1
+                self.nvml_calls += calls
+                self.sample_seconds += elapsed
+                self.sample_max = max(self.sample_max, elapsed)
+                if gpu is self.gpu:  # Discard samples taken from a GPU we switched away from mid-call
+                    if sample is not None:
+                        self.latest = sample
+                        self.stats = dict(self.stats, **stats)  # Keep the last stats of buffers that had nothing new
+                    self.error = error
+                    self.generation += 1
+                    self._published.notify_all()
+                else:
+                    sample = None
+            if sample is not None:
+                for listener in self.listeners:
+                    listener(index, sample)
+            if self.adaptive is not None:
+                self.current_interval = self.adaptive.next(index, sample) if sample is not None else self.adaptive.interval(index)
+            #  Keep a fixed cadence based on deadlines rather than sleeping a full interval after each sample,
+            #  if we fell behind we skip the missed ticks instead of bursting to catch up
+            now = time.monotonic()
+            next_deadline += self.current_interval
+            next_deadline = max(next_deadline, now)
+            if self._wake.wait(next_deadline - now):
+                self._wake.clear()
+                next_deadline = time.monotonic()
+
+
+class HistoryRing:
+    """
+    Fixed size ring of readings backed by a typed array, so memory use stays the same no matter how long we run
+    """
+    def __init__(self, capacity, typecode="f"):
+        self.capacity = capacity
+        self.values = array(typecode, [0]) * capacity
+        self.head = 0  # Next slot to write
+        self.count = 0
+
+    def append(self, value):
+        """
+        Adds a reading, overwriting the oldest one once the ring is full
+        """
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def last(self, n):
+        """
+        Returns up to the n most recent readings, oldest first
+        """
+        n = min(n, self.count)
+        start = (self.head - n) % self.capacity
+        if start + n <= self.capacity:
+            return self.values[start:start + n]
+        return self.values[start:] + self.values[:self.head]
+
+
+#  Metrics kept in the history for each dashboard row, as (history name, function pulling the value out of a Sample)
+HISTORY_FIELDS = [("core_clock", lambda sample: sample.core_clock),
+                  ("mem_clock", lambda sample: sample.mem_clock),
+                  ("temperature", lambda sample: sample.temperature),
+                  ("fan_speed", lambda sample: sample.fan_speed),
+                  ("power_usage", lambda sample: sample.power_usage),
+                  ("vram", lambda sample: sample.mem_used / sample.mem_total * 100),
+                  ("gpu_util", lambda sample: sample.gpu_util),
+                  ("mem_util", lambda sample: sample.mem_util)]
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+
+class MetricHistory:
+    """
+    One HistoryRing per metric in HISTORY_FIELDS plus a ring of sample timestamps for a single GPU
+    """
+    def __init__(self, capacity):
+        self.timestamps = HistoryRing(capacity, "d")
+        self.rings = {name: HistoryRing(capacity) for name, _ in HISTORY_FIELDS}
+
+    def record(self, sample):
+        """
+        Appends the values of a Sample to every ring
+        """
+        self.timestamps.append(sample.timestamp)
+        for name, value_of in HISTORY_FIELDS:
+            self.rings[name].append(value_of(sample))
+
+
+def sparkline(values, low, high):
+    """
+    Turns a sequence of readings into a string of block characters scaled between low and high
+    """
+    span = (high - low) or 1
+    last_char = len(SPARK_CHARS) - 1
+    return "".join(SPARK_CHARS[min(last_char, max(0, int((value - low) / span * last_char + 0.5)))] for value in values)
+
+
+#  The (caution, warn) levels --reactive-color colors values by, and that the session summary measures time above
+COLOR_THRESHOLDS = {"core_clock": (70, 90), "mem_clock": (70, 90), "temperature": (65, 80), "power_usage": (70, 90),
+                    "vram": (70, 90), "gpu_util": (70, 90), "mem_util": (70, 90)}
+#  Metrics the monitor keeps statistics of, as (name, label, unit, value of a Sample, level compared to COLOR_THRESHOLDS)
+#  The level is the value as a percentage of its maximum where the colors work that way
+STAT_METRICS = [("core_clock", "Core clock", "Mhz", lambda sample, info: sample.core_clock, lambda sample, info: sample.core_clock / info.max_core_clock * 100),
+                ("mem_clock", "Mem clock", "Mhz", lambda sample, info: sample.mem_clock, lambda sample, info: sample.mem_clock / info.max_mem_clock * 100),
+                ("temperature", "Temperature", "°C", lambda sample, info: sample.temperature, lambda sample, info: sample.temperature),
+                ("power_usage", "Power", "W", lambda sample, info: sample.power_usage, lambda sample, info: sample.power_usage / sample.power_limit * 100),
+                ("vram", "VRAM usage", "%", lambda sample, info: sample.mem_used / sample.mem_total * 100, lambda sample, info: sample.mem_used / sample.mem_total * 100),
+                ("gpu_util", "GPU core usage", "%", lambda sample, info: sample.gpu_util, lambda sample, info: sample.gpu_util),
+                ("mem_util", "Mem controller", "%", lambda sample, info: sample.mem_util, lambda sample, info: sample.mem_util)]
+
+
+class P2Quantile:
+    """
+    Streaming estimate of one quantile with the P-square algorithm of Jain and Chlamtac. Keeps five markers and moves
+    them toward where the quantile should be as values come in, so it's O(1) time and memory per value forever
+    """
+    def __init__(self, quantile):
+        self.quantile = quantile
+        self._heights = []
+        self._positions = [1, 2, 3, 4, 5]
+        self._desired = [1, 1 + 2 * quantile, 1 + 4 * quantile, 3 + 2 * quantile, 5]
+        self._increments = [0, quantile / 2, quantile, (1 + quantile) / 2, 1]
+
+    def add(self, value):
+        """
+        Feeds in one value
+        """
+        heights = self._heights
+        if len(heights) < 5:
+            bisect.insort(heights, value)
+            return
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = bisect.bisect_right(heights, value) - 1
+        positions = self._positions
+        for i in range(cell + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self._desired[i] += self._increments[i]
+        for i in range(1, 4):
+            offset = self._desired[i] - positions[i]
+            if (offset >= 1 and positions[i + 1] - positions[i] > 1) or (offset <= -1 and positions[i - 1] - positions[i] < -1):
+                step = 1 if offset > 0 else -1
+                #  Piecewise parabolic prediction, falling back to linear if it would leave the neighbors' range
+                height = heights[i] + step / (positions[i + 1] - positions[i - 1]) * (
+                    (positions[i] - positions[i - 1] + step) * (heights[i + 1] - heights[i]) / (positions[i + 1] - positions[i]) +
+                    (positions[i + 1] - positions[i] - step) * (heights[i] - heights[i - 1]) / (positions[i] - positions[i - 1]))
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = heights[i] + step * (heights[i + step] - heights[i]) / (positions[i + step] - positions[i])
+                heights[i] = height
+                positions[i] += step
+
+    def value(self):
+        """
+        Returns the current estimate, None before the first value
+        """
+        if not self._heights:
+            return None
+        if len(self._heights) < 5:  # Too few values for the markers yet, go by nearest rank
+            return self._heights[max(0, math.ceil(len(self._heights) * self.quantile) - 1)]
+        return self._heights[2]
+
+
+class RollingStats:
+    """
+    Min, mean and max of one metric over the last `window` values and over the whole session, plus P-square p95/p99
+    estimates of the session. Every value costs amortized O(1) and memory stays bounded by the window
+    """
+    def __init__(self, window):
+        self.window = window
+        self.count = 0
+        self.session_min = None
+        self.session_max = None
+        self._session_sum = 0.0
+        self._values = deque()  # (sequence number, value) for the window
+        self._window_sum = 0.0
+        self._minimums = deque()  # Increasing values, the front is the window min
+        self._maximums = deque()  # Decreasing values, the front is the window max
+        self.p95 = P2Quantile(0.95)
+        self.p99 = P2Quantile(0.99)
+
+    def add(self, value):
+        """
+        Feeds in one value
+        """
+        entry = (self.count, value)
+        self.count += 1
+        self._session_sum += value
+        self.session_min = value if self.session_min is None else min(self.session_min, value)
+        self.session_max = value if self.session_max is None else max(self.session_max, value)
+        self.p95.add(value)
+        self.p99.add(value)
+        self._values.append(entry)
+        self._window_sum += value
+        if len(self._values) > self.window:
+            self._window_sum -= self._values.popleft()[1]
+        while self._minimums and self._minimums[-1][1] >= value:
+            self._minimums.pop()
+        self._minimums.append(entry)
+        while self._maximums and self._maximums[-1][1] <= value:
+            self._maximums.pop()
+        self._maximums.append(entry)
+        oldest = self.count - self.window
+        while self._minimums[0][0] < oldest:
+            self._minimums.popleft()
+        while self._maximums[0][0] < oldest:
+            self._maximums.popleft()
+
+    @property
+    def window_min(self):
+        """
+        Smallest value in the window, None before the first value
+        """
+        return self._minimums[0][1] if self._minimums else None
+
+    @property
+    def window_max(self):
+        """
+        Largest value in the window, None before the first value
+        """
+        return self._maximums[0][1] if self._maximums else None
+
+    @property
+    def window_mean(self):
+        """
+        Mean of the values in the window, None before the first value
+        """
+        return self._window_sum / len(self._values) if self._values else None
+
+    @property
+    def session_mean(self):
+        """
+        Mean of every value so far, None before the first value
+        """
+        return self._session_sum / self.count if self.count else None
+
+
+class SessionStats:
+    """
+    Statistics of every metric in STAT_METRICS for one GPU, how long each spent above its caution and warn levels,
+    how long the clocks were held back for each of the CLOCK_REASONS and how much energy the GPU used meanwhile
+    """
+    MAX_GAP = 60  # Seconds, longer gaps between samples (pauses, seeking a replay) aren't accounted for
+
+    def __init__(self, window):
+        self.stats = {name: RollingStats(window) for name, _, _, _, _ in STAT_METRICS}
+        self.above = {name: [0.0, 0.0] for name, _, _, _, _ in STAT_METRICS}  # Seconds above caution and above warn
+        self.reasons = {name: 0.0 for name, _, _ in CLOCK_REASONS}  # Seconds the clocks were held back for each reason
+        self.seconds = 0.0
+        self.energy = 0.0  # Joules, from the driver's energy counter
+        self.energy_seconds = 0.0  # Seconds the energy was counted over, older GPUs have no counter
+        self._last_monotonic = None
+        self._last_levels = None
+        self._last_reasons = 0
+        self._last_energy = 0
+
+    def record(self, sample, info):
+        """
+        Feeds in a Sample of the GPU along with its DeviceInfo
+        """
+        levels = {}
+        for name, _, _, value_of, level_of in STAT_METRICS:
+            self.stats[name].add(value_of(sample, info))
+            levels[name] = level_of(sample, info)
+        if self._last_monotonic is not None and 0 < sample.monotonic - self._last_monotonic <= self.MAX_GAP:
+            #  Whatever the last sample showed is what the GPU did until this one
+            elapsed = sample.monotonic - self._last_monotonic
+            self.seconds += elapsed
+            for name, level in self._last_levels.items():
+                caution, warn = COLOR_THRESHOLDS[name]
+                if level > caution:
+                    self.above[name][0] += elapsed
+                if level > warn:
+                    self.above[name][1] += elapsed
+            for name, _, reason in CLOCK_REASONS:
+                if self._last_reasons & reason:
+                    self.reasons[name] += elapsed
+            if self._last_energy and sample.energy >= self._last_energy:  # The counter starts over when the driver reloads
+                self.energy += (sample.energy - self._last_energy) / 1000
+                self.energy_seconds += elapsed
+        self._last_monotonic = sample.monotonic
+        self._last_levels = levels
+        self._last_reasons = sample.clock_reasons
+        self._last_energy = sample.energy
+
+    def limited_by(self):
+        """
+        Returns (label, seconds, percent of the session) for every clock reason seen, longest first
+        """
+        share = 100 / self.seconds if self.seconds else 0
+        return sorted(((label, self.reasons[name], self.reasons[name] * share) for name, label, _ in CLOCK_REASONS if self.reasons[name]),
+                      key=lambda reason: reason[1], reverse=True)
+
+    def describe_energy(self):
+        """
+        Returns a line of text for the energy used, None if the GPU has no energy counter
+        """
+        if not self.energy_seconds:
+            return None
+        return f"{self.energy / 3600:.2f} Wh over {format_duration(self.energy_seconds)} ({self.energy / self.energy_seconds:.1f} W average)"
+
+
+def format_duration(seconds):
+    """
+    Helper function to format a number of seconds like 1h 2m 3s
+    """
+    seconds = int(seconds)
+    hours, minutes = seconds // 3600, seconds // 60 % 60
+    return f"{hours}h {minutes}m {seconds % 60}s" if hours else f"{minutes}m {seconds % 60}s" if minutes else f"{seconds}s"
+
+
+def print_session_summary(sessions):
+    """
+    Prints the statistics of the whole session for every GPU the monitor sampled. Takes in {index: SessionStats}
+    """
+    for index, session in sorted(sessions.items()):
+        samples = session.stats["temperature"].count
+        if not samples:
+            continue
+        name = _device_info_cache[index].name if index in _device_info_cache else "Unknown"
+        print(f"{ANSI_MAGENTA}Session summary for GPU {index} - {name}: {format_duration(session.seconds)}, {samples} samples{NC}")
+        for metric, label, unit, _, _ in STAT_METRICS:
+            stats = session.stats[metric]
+            caution_seconds, warn_seconds = session.above[metric]
+            share = 100 / session.seconds if session.seconds else 0
+            print(f"  {label + ':':<16}min {stats.session_min:8.1f}  mean {stats.session_mean:8.1f}  max {stats.session_max:8.1f}  "
+                  f"p95 {stats.p95.value():8.1f}  p99 {stats.p99.value():8.1f} {unit:<4}| "
+                  f"{ANSI_YELLOW}above caution {format_duration(caution_seconds)} ({caution_seconds * share:.0f}%){NC}, "
+                  f"{ANSI_WARN}above warn {format_duration(warn_seconds)} ({warn_seconds * share:.0f}%){NC}")
+        limited = ", ".join(f"{label} {format_duration(seconds)} ({percent:.0f}%)" for label, seconds, percent in session.limited_by())
+        print(f"  {'Clocks limited:':<16}{limited or 'never'}")
+        energy = session.describe_energy()
+        if energy is not None:
+            print(f"  {'Energy:':<16}{energy}")
+
+
+class OverviewSampler(threading.Thread):
+    """
+    Samples every GPU concurrently on a thread pool for the overview screen. Each device keeps its own deadline and
+    at most one sample in flight, so a slow or wedged GPU only delays its own row and not the others. With an
+    AdaptiveInterval every GPU is paced on its own, so an idle one backs off while a busy one is sampled fast.
+    """
+    def __init__(self, handles, interval, adaptive=None, buffers=None):
+        super().__init__(name="bnt-overview", daemon=True)
+        self.handles = handles  # List of (index, handle) tuples
+        self.interval = adaptive.minimum if adaptive is not None else interval
+        self.adaptive = adaptive
+        self.buffers = buffers
+        self.latest = {}
+        self.stats = {}  # {index: {Sample field: BufferStats}}
+        self.errors = {}
+        self.generation = 0
+        self.listeners = []  # Called as listener(index, sample) on a pool thread for every new sample
+        self.samples = 0  # Running totals for --benchmark
+        self.sample_seconds = 0.0
+        self.sample_max = 0.0
+        self.nvml_calls = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._pool = ThreadPoolExecutor(max_workers=len(handles), thread_name_prefix="bnt-overview")
+
+    def stalled(self, index):
+        """
+        Returns True if the sample for a GPU has been in flight for longer than one interval
+        """
+        with self._lock:
+            started = self._in_flight.get(index)
+        return started is not None and time.monotonic() - started > self.interval
+
+    def stop(self):
+        """
+        Stops scheduling new samples, anything stuck in the driver is left to finish on its own
+        """
+        self._stop_event.set()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def _sample_device(self, index, gpu):
+        try:
+            started = time.perf_counter()
+            calls_before = nv.thread_calls()
+            try:
+                sample = read_sample(index, gpu)
+                stats = self.buffers.read(index, gpu) if self.buffers is not None else {}
+                error = None
+            except nv.NVMLError as e:
+                sample = None
+                error = e
+            elapsed = time.perf_counter() - started
+            calls = nv.thread_calls() - calls_before
+            with self._lock:
+                if sample is not None and stats:
+                    all_stats = dict(self.stats)
+                    all_stats[index] = dict(all_stats.get(index, {}), **stats)
+                    self.stats = all_stats
+                self.samples += 1
+                self.nvml_calls += calls
+                self.sample_seconds += elapsed
+                self.sample_max = max(self.sample_max, elapsed)
+                if sample is not None:
+                    latest = dict(self.latest)  # Copy on write so readers can keep iterating the old snapshot
+                    latest[index] = sample
+                    self.latest = latest
+                errors = dict(self.errors)
+                errors[index] = error
+                self.errors = errors
+                if self.adaptive is not None and sample is not None:
+                    self.adaptive.next(index, sample)
+                #  Listeners run before the new generation is published, so whatever they keep is in step with it
+                if sample is not None:
+                    for listener in self.listeners:
+                        listener(index, sample)
+                self.generation += 1
+        finally:
+            #  Whatever went wrong, the GPU has to be free for the next tick or it would never be sampled again
+            with self._lock:
+                del self._in_flight[index]
+
+    def run(self):
+        next_deadline = {index: time.monotonic() for index, _ in self.handles}
+        while not self._stop_event.is_set():
+            now = time.monotonic()
+            for index, gpu in self.handles:
+                if now < next_deadline[index]:
+                    continue
+                with self._lock:
+                    busy = index in self._in_flight
+                    if not busy:
+                        self._in_flight[index] = now
+                if not busy:  # A GPU that is still busy with its last sample just skips this tick
+                    try:
+                        self._pool.submit(self._sample_device, index, gpu)
+                    except RuntimeError:  # Pool was shut down underneath us
+                        return
+                with self._lock:
+                    interval = self.adaptive.interval(index) if self.adaptive is not None else self.interval
+                next_deadline[index] = max(next_deadline[index] + interval, now)
+            self._stop_event.wait(max(0, min(next_deadline.values()) - time.monotonic()))
+
+
+def describe_event(event):
+    """
+    Returns a line of text for a GpuEvent
+    """
+    if event.kind == "clock":
+        return f"Clocks changed, core at {event.data} Mhz" if event.data is not None else "Clocks changed"
+    if event.kind == "power_source":
+        sources = {nv.NVML_POWER_SOURCE_AC: "AC", nv.NVML_POWER_SOURCE_BATTERY: "battery", getattr(nv, "NVML_POWER_SOURCE_UNDERSIZED", None): "an undersized supply"}
+        return f"Power source changed to {sources.get(event.data, 'unknown')}"
+    return f"Critical Xid {event.data} error!"
+
+
+class EventWatcher(threading.Thread):
+    """
+    Waits on an NVML event set for clock changes, power source changes and critical Xid errors on a set of GPUs and keeps
+    the most recent ones with when they happened. Runs next to the samplers, the driver wakes it up when something
+    happens so nothing is missed between two samples and it costs nothing while the GPUs are quiet.
+    """
+    WAIT_MS = 500  # How long one wait may block, which is also how long stopping can take
+
+    def __init__(self, handles, capacity=256):
+        super().__init__(name="bnt-events", daemon=True)
+        self.handles = handles  # List of (index, handle) tuples
+        self.counts = {index: {} for index, _ in handles}  # {index: {kind: count}}
+        self.generation = 0
+        self.error = None
+        self.listeners = []  # Called as listener(event) on the watcher thread for every new event
+        self._events = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def recent(self, index=None, n=None):
+        """
+        Returns the last n events, oldest first, of one GPU or of all of them if no index is given
+        """
+        with self._lock:
+            events = [event for event in self._events if index is None or event.index == index]
+        return events[-n:] if n else events
+
+    def _register(self, event_set):
+        """
+        Registers every GPU for the events it supports, returns how many GPUs could be registered
+        """
+        registered = 0
+        for _, handle in self.handles:
+            supported = _query_or_none(nv.nvmlDeviceGetSupportedEventTypes, handle) or 0
+            mask = 0
+            for event_type, _ in WATCHED_EVENTS:
+                if supported & event_type:
+                    mask |= event_type
+            if not mask:
+                continue
+            try:
+                nv.nvmlDeviceRegisterEvents(handle, mask, event_set)
+                registered += 1
+            except nv.NVMLError:
+                pass  # Still watch the others
+        return registered
+
+    def _event(self, data):
+        """
+        Turns what the driver woke us up with into a GpuEvent
+        """
+        timestamp = time.time()
+        monotonic = time.monotonic()
+        kind = dict(WATCHED_EVENTS).get(data.eventType, "unknown")
+        value = data.eventData
+        if kind == "clock":
+            value = _query_or_none(nv.nvmlDeviceGetClockInfo, data.device, nv.NVML_CLOCK_GRAPHICS)
+        elif kind == "power_source":
+            value = _query_or_none(nv.nvmlDeviceGetPowerSource, data.device)
+        index = _query_or_none(nv.nvmlDeviceGetIndex, data.device)
+        return GpuEvent(timestamp=timestamp, monotonic=monotonic, index=index, kind=kind, data=value)
+
+    def stop(self):
+        """
+        Stops the watcher, the event set is freed once the wait in progress returns
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(self.WAIT_MS / 1000 + 1)
+
+    def run(self):
+        wait = getattr(nv, "nvmlEventSetWait_v2", None) or nv.nvmlEventSetWait
+        try:
+            event_set = nv.nvmlEventSetCreate()
+        except nv.NVMLError as e:
+            self.error = e
+            return
+        try:
+            if not self._register(event_set):
+                self.error = "Events are not supported"
+                return
+            while not self._stop_event.is_set():
+                try:
+                    data = wait(event_set, self.WAIT_MS)
+                except nv.NVMLError_Timeout:
+                    continue
+                except nv.NVMLError as e:
+                    self.error = e
+                    self._stop_event.wait(1)  # Don't spin on a driver that keeps failing
+                    continue
+                event = self._event(data)
+                with self._lock:
+                    self._events.append(event)
+                    counts = dict(self.counts.get(event.index, {}))  # Copy on write so readers can keep the old one
+                    counts[event.kind] = counts.get(event.kind, 0) + 1
+                    all_counts = dict(self.counts)
+                    all_counts[event.index] = counts
+                    self.counts = all_counts
+                    self.generation += 1
+                    self.error = None
+                for listener in self.listeners:
+                    listener(event)
+        finally:
+            _query_or_none(nv.nvmlEventSetFree, event_set)
+
+
+#  Gauges exported by the metrics server as (metric name, help text, Sample field, scale)
+METRICS = [("bnt_gpu_temperature_celsius", "GPU core temperature", "temperature", 1),
+           ("bnt_gpu_fan_speed_percent", "Fan speed of the first fan", "fan_speed", 1),
+           ("bnt_gpu_fan_policy_manual", "1 if the fan control policy is manual", "fan_policy", 1),
+           ("bnt_gpu_power_usage_watts", "Power draw", "power_usage", 1),
+           ("bnt_gpu_power_limit_watts", "Current power limit", "power_limit", 1),
+           ("bnt_gpu_core_clock_mhz", "Graphics clock", "core_clock", 1),
+           ("bnt_gpu_mem_clock_mhz", "Memory clock", "mem_clock", 1),
+           ("bnt_gpu_core_offset_mhz", "Graphics clock offset", "core_offset", 1),
+           ("bnt_gpu_mem_offset_mhz", "Memory clock offset, same scale as GWE/Afterburner", "mem_offset", 1),
+           ("bnt_gpu_memory_used_bytes", "VRAM in use", "mem_used", 1),
+           ("bnt_gpu_memory_total_bytes", "Total VRAM", "mem_total", 1),
+           ("bnt_gpu_utilization_ratio", "GPU core utilization", "gpu_util", 0.01),
+           ("bnt_gpu_mem_controller_utilization_ratio", "Memory controller utilization", "mem_util", 0.01),
+           ("bnt_gpu_sample_timestamp_seconds", "Wall clock time the sample was taken", "timestamp", 1),
+           ("bnt_gpu_sample_nvml_calls", "NVML calls the last sample took", "nvml_calls", 1)]
+
+
+def _escape_label(value):
+    """
+    Helper function to escape a Prometheus label value
+    """
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class MetricsExporter:
+    """
+    Renders the latest overview snapshots as Prometheus text and caches the result per sampler generation,
+    so any number of scrapers share one set of NVML reads and one render. Event counts come from an optional EventWatcher
+    and the time spent in each clock reason from an optional {index: SessionStats} the overview sampler feeds
+    """
+    def __init__(self, overview, events=None, sessions=None):
+        self.overview = overview
+        self.events = events
+        self.sessions = sessions
+        self._cached_generation = None
+        self._cached_body = b""
+        self._lock = threading.Lock()
+
+    def body(self):
+        """
+        Returns the exposition text for the latest snapshots, rendering it only if something new was sampled
+        """
+        generation = (self.overview.generation, self.events.generation if self.events is not None else 0)
+        with self._lock:
+            if generation != self._cached_generation:
+                self._cached_generation = generation
+                self._cached_body = self.render().encode("utf-8")
+            return self._cached_body
+
+    def render(self):
+        """
+        Builds the exposition text from the latest snapshots
+        """
+        latest = self.overview.latest
+        errors = self.overview.errors
+        labels = {index: f'gpu="{index}",name="{_escape_label(get_device_info(index, handle).name)}"' for index, handle in self.overview.handles}
+        lines = ["# HELP bnt_gpu_up 1 if the last sample of the GPU succeeded", "# TYPE bnt_gpu_up gauge"]
+        for index, _ in self.overview.handles:
+            up = index in latest and errors.get(index) is None
+            lines.append(f"bnt_gpu_up{{{labels[index]}}} {int(up)}")
+        for name, help_text, field, scale in METRICS:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for index, _ in self.overview.handles:
+                if index in latest:
+                    value = getattr(latest[index], field)
+                    lines.append(f"{name}{{{labels[index]}}} {value * scale if scale != 1 else value}")
+        if self.overview.buffers is not None:
+            stats = self.overview.stats
+            buffered = {field for field, _, _ in SAMPLE_BUFFERS}
+            for name, help_text, field, scale in METRICS:
+                if field not in buffered:
+                    continue
+                lines.append(f"# HELP {name}_interval {help_text}, min/avg/max/p99 of the driver's own samples since the previous sample")
+                lines.append(f"# TYPE {name}_interval gauge")
+                for index, _ in self.overview.handles:
+                    if field in stats.get(index, {}):
+                        for stat_name in ("min", "avg", "max", "p99"):
+                            lines.append(f"{name}_interval{{{labels[index]},stat=\"{stat_name}\"}} {getattr(stats[index][field], stat_name) * scale}")
+        lines.append("# HELP bnt_gpu_clock_reason_active 1 if the driver holds the clocks back for this reason in the last sample")
+        lines.append("# TYPE bnt_gpu_clock_reason_active gauge")
+        for index, _ in self.overview.handles:
+            if index in latest:
+                for name, _, reason in CLOCK_REASONS:
+                    lines.append(f"bnt_gpu_clock_reason_active{{{labels[index]},reason=\"{name}\"}} {int(bool(latest[index].clock_reasons & reason))}")
+        if self.sessions is not None:
+            lines.append("# HELP bnt_gpu_clock_reason_seconds Time the driver held the clocks back for each reason since startup")
+            lines.append("# TYPE bnt_gpu_clock_reason_seconds counter")
+            for index, _ in self.overview.handles:
+                if index in self.sessions:
+                    for name, _, _ in CLOCK_REASONS:
+                        lines.append(f"bnt_gpu_clock_reason_seconds_total{{{labels[index]},reason=\"{name}\"}} {self.sessions[index].reasons[name]}")
+        lines.append("# HELP bnt_gpu_energy_joules Energy used since the driver was loaded")
+        lines.append("# TYPE bnt_gpu_energy_joules counter")
+        for index, _ in self.overview.handles:
+            if index in latest and latest[index].energy:
+                lines.append(f"bnt_gpu_energy_joules_total{{{labels[index]}}} {latest[index].energy / 1000}")
+        if self.overview.adaptive is not None:
+            lines.append("# HELP bnt_gpu_sample_interval_seconds How long --adaptive currently waits between samples of the GPU")
+            lines.append("# TYPE bnt_gpu_sample_interval_seconds gauge")
+            for index, _ in self.overview.handles:
+                lines.append(f"bnt_gpu_sample_interval_seconds{{{labels[index]}}} {self.overview.adaptive.interval(index)}")
+        if self.events is not None:
+            counts = self.events.counts
+            lines.append("# HELP bnt_gpu_events Clock change, power source change and critical Xid events seen since startup")
+            lines.append("# TYPE bnt_gpu_events counter")
+            for index, _ in self.overview.handles:
+                for _, kind in WATCHED_EVENTS:
+                    lines.append(f"bnt_gpu_events_total{{{labels[index]},kind=\"{kind}\"}} {counts.get(index, {}).get(kind, 0)}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Answers scrapes straight from the exporter cache, no NVML calls happen on this path
+    """
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Serves /metrics, everything else is a 404
+        """
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = self.server.exporter.body()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/openmetrics-text; version=1.0.0; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *log_args):  # pylint: disable=redefined-builtin
+        pass  # Scrapes every few seconds would flood the terminal
+
+
+def serve_metrics(address):
+    """
+    Runs the headless metrics server until interrupted. Takes in a (host, port) tuple
+    """
+    handles = [(i, nv.nvmlDeviceGetHandleByIndex(i)) for i in range(nv.nvmlDeviceGetCount())]
+    overview = OverviewSampler(handles, args.refresh_rate / 1000, make_adaptive(), make_buffers())
+    sessions = {}  # Only for the time spent in each clock reason, the exported gauges come from the latest samples
+    overview.listeners.append(lambda index, sample: sessions.setdefault(index, SessionStats(args.stats_window)).record(sample, get_device_info(index, dict(handles)[index])))
+    overview.start()
+    events = None
+    if not args.no_events:
+        events = EventWatcher(handles)
+        events.start()
+    server = ThreadingHTTPServer(address, MetricsHandler)
+    server.daemon_threads = True
+    server.exporter = MetricsExporter(overview, events, sessions)
+    print(f"{ANSI_MAGENTA}Blissful Nvidia Tool Metrics Mode{NC}")
+    cadence = f"every {args.min_refresh_rate}-{args.max_refresh_rate} ms depending on load" if args.adaptive else f"every {args.refresh_rate} ms"
+    print(f"Serving metrics for {len(handles)} GPU(s) on http://{address[0]}:{address[1]}/metrics, sampling {cadence}. Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        overview.stop()
+        if events is not None:
+            events.stop()
+
+
+class ControlDaemon:
+    """
+    Holds NVML open with every handle and device looked up once, and carries out the commands clients send over the
+    control socket. Writes to a GPU are serialized by a lock per device so two clients can't interleave their changes,
+    reads never take the lock and run concurrently.
+    """
+    def __init__(self):
+        self.handles = {i: nv.nvmlDeviceGetHandleByIndex(i) for i in range(nv.nvmlDeviceGetCount())}
+        self.infos = {i: get_device_info(i, handle) for i, handle in self.handles.items()}
+        self._write_locks = {i: threading.Lock() for i in self.handles}
+        for handle in self.handles.values():
+            try:
+                nv.nvmlDeviceSetPersistenceMode(handle, 1)
+            except nv.NVMLError:
+                pass  # Not root, writes will fail but reads still work
+        self.events = None
+        if not args.no_events:
+            self.events = EventWatcher(list(self.handles.items()))
+            self.events.start()
+        self.commands = {"ping": self.ping,
+                         "devices": self.devices,
+                         "get": self.get,
+                         "set_clocks": self.set_clocks,
+                         "set_power_limit": self.set_power_limit,
+                         "set_fans": self.set_fans,
+                         "set_profile": self.set_profile,
+                         "profiles": self.profiles,
+                         "save_profile": self.save_profile,
+                         "delete_profile": self.delete_profile,
+                         "events": self.events_since}
+
+    def _device(self, request):
+        """
+        Returns the (index, handle) a request is aimed at
+        """
+        index = int(request.get("gpu", 0))
+        if index not in self.handles:
+            raise ValueError(f"There is no GPU {index}")
+        return index, self.handles[index]
+
+    def execute(self, request):
+        """
+        Runs one request and returns the response for it, failures are reported in the response instead of raised
+        """
+        command = self.commands.get(request.get("command"))
+        if command is None:
+            return {"ok": False, "error": f"Unknown command {request.get('command')!r}"}
+        try:
+            return {"ok": True, "result": command(request)}
+        except (nv.NVMLError, ValueError, TypeError, KeyError, OSError) as e:
+            return {"ok": False, "error": str(e) or type(e).__name__}
+
+    def ping(self, _request):
+        """
+        Returns the version of the daemon, for clients checking it is there
+        """
+        return {"version": __VERSION__}
+
+    def devices(self, _request):
+        """
+        Returns the DeviceInfo of every GPU the daemon has open
+        """
+        return [info._asdict() for info in self.infos.values()]
+
+    def get(self, request):
+        """
+        Returns a fresh Sample of a GPU
+        """
+        index, handle = self._device(request)
+        return read_sample(index, handle)._asdict()
+
+    def set_clocks(self, request):
+        """
+        Sets the clock offsets of a GPU to request["core_offset"] and request["mem_offset"] in MHz
+        """
+        index, handle = self._device(request)
+        with self._write_locks[index]:
+            set_clock_offsets(handle, int(request["core_offset"]), int(request["mem_offset"]))
+        return {}
+
+    def set_power_limit(self, request):
+        """
+        Sets the power limit of a GPU to request["power_limit"] watts
+        """
+        index, handle = self._device(request)
+        with self._write_locks[index]:
+            set_power_limit(handle, int(request["power_limit"]))
+        return {}
+
+    def set_fans(self, request):
+        """
+        Sets every fan to request["speed"] percent, a speed of None restores automatic control
+        """
+        index, handle = self._device(request)
+        speed = request.get("speed")
+        if speed is not None and not 101 > int(speed) > 29:
+            raise ValueError(f"Fan speed must be between 30 and 100, got {speed}")
+        with self._write_locks[index]:
+            for i in range(0, self.infos[index].num_fans):
+                set_fan(handle, i, None if speed is None else int(speed))
+        return {"fans": self.infos[index].num_fans}
+
+    def set_profile(self, request):
+        """
+        Applies the profile named request["profile"] to a GPU, returns the profile and whether anything changed
+        """
+        index, handle = self._device(request)
+        try:
+            profile = check_profile(profiles.get(profile_key(self.infos[index]), str(request["profile"])))
+        except KeyError:
+            raise ValueError(f"There is no profile {request['profile']}") from None
+        with self._write_locks[index]:
+            changed = apply_profile(handle, self.infos[index].num_fans, profile)
+        return dict(profile._asdict(), changed=changed)
+
+    def profiles(self, request):
+        """
+        Returns every profile saved for a GPU by name
+        """
+        index, _ = self._device(request)
+        key = profile_key(self.infos[index])
+        return {name: profiles.get(key, name)._asdict() for name in profiles.names(key)}
+
+    def save_profile(self, request):
+        """
+        Saves the current settings of a GPU as the profile named request["profile"]
+        """
+        index, handle = self._device(request)
+        profile = profile_from_sample(read_sample(index, handle))
+        profiles.save(profile_key(self.infos[index]), str(request["profile"]), profile)
+        return profile._asdict()
+
+    def delete_profile(self, request):
+        """
+        Deletes the profile named request["profile"] of a GPU
+        """
+        index, _ = self._device(request)
+        if not profiles.delete(profile_key(self.infos[index]), str(request["profile"])):
+            raise ValueError(f"There is no profile {request['profile']}")
+        return {}
+
+    def events_since(self, request):
+        """
+        Returns the events of a GPU newer than request["since"] (a wall clock timestamp) and how many of each kind it had
+        """
+        index, _ = self._device(request)
+        if self.events is None:
+            raise ValueError("The daemon was started with --no-events")
+        since = float(request.get("since", 0))
+        return {"events": [event._asdict() for event in self.events.recent(index) if event.timestamp > since],
+                "counts": self.events.counts.get(index, {}),
+                "error": None if self.events.error is None else str(self.events.error)}
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks the control protocol on one connection: a JSON request per line in, a JSON response per line out
+    """
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("Requests must be JSON objects")
+                response = self.server.control.execute(request)
+            except ValueError as e:
+                response = {"ok": False, "error": f"Malformed request: {e}"}
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+def serve_control(path):
+    """
+    Runs the control daemon on a Unix socket at path until interrupted or terminated
+    """
+    if os.path.lexists(path):
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            print(f"{ANSI_WARN}{path} exists and is not a socket, refusing to replace it!{NC}")
+            sys.exit(8)
+        try:
+            send_commands(path, [{"command": "ping"}])
+            print(f"{ANSI_WARN}Another daemon is already listening on {path}!{NC}")
+            sys.exit(8)
+        except OSError:
+            os.unlink(path)  # Left behind by a daemon that didn't exit cleanly
+    control = ControlDaemon()
+    old_umask = os.umask(0o177)  # Only the user running the daemon gets to talk to it
+    try:
+        server = socketserver.ThreadingUnixStreamServer(path, ControlHandler)
+    finally:
+        os.umask(old_umask)
+    server.daemon_threads = True
+    server.control = control
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"{ANSI_MAGENTA}Blissful Nvidia Tool Daemon Mode{NC}")
+    print(f"Controlling {len(control.handles)} GPU(s) on {path}. Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+        if control.events is not None:
+            control.events.stop()
+
+
+def send_commands(path, requests, timeout=30):
+    """
+    Sends requests to the daemon listening on path over one connection and returns its responses in order.
+    Raises OSError if the daemon can't be reached
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.settimeout(timeout)
+        connection.connect(path)
+        connection.sendall(b"".join(json.dumps(request).encode("utf-8") + b"\n" for request in requests))
+        connection.shutdown(socket.SHUT_WR)
+        with connection.makefile("rb") as stream:
+            responses = [json.loads(line) for line in stream]
+    if len(responses) != len(requests):
+        raise ConnectionError("The daemon hung up before answering everything")
+    return responses
+
+
+def run_client(path, gpu_numbers):
+    """
+    Thin client for the daemon, turns the offline mode arguments into requests for every selected GPU and reports how
+    they went. Each GPU gets its own connection so the daemon works on them in parallel. Returns the exit code
+    """
+    requests = []
+    if args.set_max_fan:
+        requests.append(("Set fans to max speed", {"command": "set_fans", "speed": 100}))
+    elif args.set_auto_fan:
+        requests.append(("Restored fans to automatic control", {"command": "set_fans", "speed": None}))
+    elif args.set_custom_fan:
+        requests.append((f"Set fans to {args.set_custom_fan}%", {"command": "set_fans", "speed": args.set_custom_fan}))
+    if args.set_clocks:
+        requests.append((f"Set core clock offset to {args.set_clocks[0]} MHz and memory clock offset to {args.set_clocks[1]} MHz",
+                         {"command": "set_clocks", "core_offset": args.set_clocks[0], "mem_offset": args.set_clocks[1]}))
+    if args.set_power_limit:
+        requests.append((f"Power limit set to {args.set_power_limit} W", {"command": "set_power_limit", "power_limit": args.set_power_limit}))
+    if args.set_profile:
+        requests.append((f"Profile {args.set_profile} successfully applied", {"command": "set_profile", "profile": args.set_profile}))
+    if args.save_profile:
+        requests.append((f"Current settings saved as profile {args.save_profile}", {"command": "save_profile", "profile": args.save_profile}))
+    if args.delete_profile:
+        requests.append((f"Deleted profile {args.delete_profile}", {"command": "delete_profile", "profile": args.delete_profile}))
+    if args.list_profiles:
+        requests.append((None, {"command": "profiles"}))
+    if args.status or not requests:
+        requests.append((None, {"command": "get"}))
+    try:
+        if gpu_numbers is None:
+            gpu_numbers = [device["index"] for device in send_commands(path, [{"command": "devices"}])[0]["result"]]
+        with ThreadPoolExecutor(max_workers=len(gpu_numbers), thread_name_prefix="bnt-client") as pool:
+            all_responses = list(pool.map(lambda gpu_number: send_commands(path, [dict(request, gpu=gpu_number) for _, request in requests]), gpu_numbers))
+    except (OSError, ValueError) as e:
+        print(f"{ANSI_WARN}Could not talk to the daemon on {path}! {e}{NC}")
+        return 8
+    failed = False
+    for gpu_number, responses in zip(gpu_numbers, all_responses):
+        for (message, _), response in zip(requests, responses):
+            if not response["ok"]:
+                failed = True
+                print(f"{ANSI_WARN}GPU {gpu_number}: {response['error']}{NC}")
+            elif message is None:
+                print(json.dumps(response["result"]))
+            else:
+                print(f"{ANSI_GREEN}GPU {gpu_number}: {message}!{NC}")
+    return 1 if failed else 0
+
+
+#  Layout of one record in a recording, as (Sample field, struct type code). Records are fixed size and every field
+#  sits at the same offset in each of them, so a single column can be read straight out of the mapped file.
+RECORD_FIELDS = [("timestamp", "d"), ("monotonic", "d"), ("core_offset", "i"), ("mem_offset", "f"), ("fan_policy", "I"),
+                 ("fan_speed", "I"), ("temperature", "I"), ("power_usage", "f"), ("power_limit", "f"), ("gpu_util", "I"),
+                 ("mem_util", "I"), ("mem_used", "Q"), ("mem_total", "Q"), ("core_clock", "I"), ("mem_clock", "I"),
+                 ("nvml_calls", "I"), ("clock_reasons", "Q"), ("energy", "Q")]
+RECORDING_MAGIC = b"BNTREC\x00\x01"
+
+
+def _record_struct(fields):
+    """
+    Helper function to build the struct for a record, every record starts with the index of the GPU it came from
+    """
+    return struct.Struct("<I" + "".join(code for _, code in fields))
+
+
+class Recorder:
+    """
+    Appends every sample handed to it to a recording file as one fixed size record. The file starts with a small JSON
+    header describing the record layout and the GPUs, after that it is only ever appended to. Appending to an existing
+    recording needs the same layout and GPUs, and a record cut short by a crash is dropped first so the new ones line up.
+    """
+    def __init__(self, path, devices):
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            existing = Recording(path)
+            fields = existing.fields
+            uuids = [device.uuid for device in existing.devices]
+            whole_size = existing.whole_size()
+            existing.close()
+            if fields != RECORD_FIELDS:
+                raise ValueError(f"{path} was recorded with a different record layout, please record to a new file")
+            if uuids != [device.uuid for device in devices]:
+                raise ValueError(f"{path} was recorded from different GPUs, please record to a new file")
+            self._file = open(path, "ab")  # pylint: disable=consider-using-with
+            self._file.truncate(whole_size)
+        else:
+            header = json.dumps({"fields": RECORD_FIELDS, "devices": [device._asdict() for device in devices]}).encode("utf-8")
+            self._file = open(path, "wb")  # pylint: disable=consider-using-with
+            self._file.write(RECORDING_MAGIC + struct.pack("<I", len(header)) + header)
+        self._struct = _record_struct(RECORD_FIELDS)
+        self._lock = threading.Lock()
+
+    def record(self, index, sample):
+        """
+        Appends one sample taken from the GPU with the given index
+        """
+        with self._lock:
+            self._file.write(self._struct.pack(index, *(getattr(sample, name) for name, _ in RECORD_FIELDS)))
+            self._file.flush()  # A record should be on disk even if we get killed, that's the whole point
+
+    def close(self):
+        """
+        Closes the recording file
+        """
+        with self._lock:
+            self._file.close()
+
+
+class Recording:
+    """
+    Read only view of a recording. The file is memory mapped and records are decoded on demand, so seeking around
+    in a huge capture only touches the pages actually needed.
+    """
+    def __init__(self, path):
+        self._file = open(path, "rb")  # pylint: disable=consider-using-with
+        if os.fstat(self._file.fileno()).st_size < len(RECORDING_MAGIC) + 4:
+            self._file.close()
+            raise ValueError(f"{path} is not a Blissful Nvidia Tool recording")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(RECORDING_MAGIC)] != RECORDING_MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a Blissful Nvidia Tool recording")
+        header_length = struct.unpack_from("<I", self._map, len(RECORDING_MAGIC))[0]
+        header_start = len(RECORDING_MAGIC) + 4
+        header = json.loads(self._map[header_start:header_start + header_length].decode("utf-8"))
+        self.fields = list(map(tuple, header["fields"]))
+        self.devices = []
+        for device in header["devices"]:
+            if device.get("compute_capability") is not None:
+                device["compute_capability"] = tuple(device["compute_capability"])
+            self.devices.append(DeviceInfo(**{name: device.get(name) for name in DeviceInfo._fields}))
+        self._struct = _record_struct(self.fields)
+        self._data_offset = header_start + header_length
+        names = [name for name, _ in self.fields]
+        self._timestamp_offset = struct.calcsize("<I" + "".join(code for _, code in self.fields[:names.index("timestamp")]))
+
+    def __len__(self):
+        return (len(self._map) - self._data_offset) // self._struct.size
+
+    def whole_size(self):
+        """
+        Returns the size of the file up to the end of the last complete record
+        """
+        return self._data_offset + len(self) * self._struct.size
+
+    def read(self, position):
+        """
+        Decodes one record, returns a tuple of the GPU index and the Sample. Fields missing from older recordings are 0
+        """
+        values = self._struct.unpack_from(self._map, self._data_offset + position * self._struct.size)
+        recorded = dict.fromkeys(Sample._fields, 0)
+        recorded.update(zip((name for name, _ in self.fields), values[1:]))
+        return values[0], Sample(**{name: recorded[name] for name in Sample._fields})
+
+    def timestamp_at(self, position):
+        """
+        Reads only the timestamp column of a record
+        """
+        return struct.unpack_from("<d", self._map, self._data_offset + position * self._struct.size + self._timestamp_offset)[0]
+
+    def find(self, timestamp):
+        """
+        Returns the position of the first record taken at or after a timestamp, with a binary search over the file
+        """
+        return bisect.bisect_left(range(len(self)), timestamp, key=self.timestamp_at)
+
+    def close(self):
+        """
+        Unmaps and closes the recording
+        """
+        self._map.close()
+        self._file.close()
+
+
+class ReplaySampler(threading.Thread):
+    """
+    Stand in for Sampler that publishes samples from a recording instead of a GPU, at the pace they were recorded
+    scaled by a speed factor. Supports pausing and seeking.
+    """
+    MAX_GAP = 5  # Longest we wait between two records in seconds, so gaps between recording sessions don't stall playback
+
+    def __init__(self, recording, speed):
+        super().__init__(name="bnt-replay", daemon=True)
+        self.recording = recording
+        self.speed = speed
+        self.paused = False
+        self.position = 0
+        self.index = recording.read(0)[0]
+        self.gpu = None
+        self.latest = None
+        self.error = None
+        self.stats = {}  # Recordings don't keep the driver's sample buffers
+        self.generation = 0
+        self.listeners = []
+        self.samples = 0  # Running totals for --benchmark-stats, a record read is a sample that took no NVML calls
+        self.sample_seconds = 0.0
+        self.sample_max = 0.0
+        self.nvml_calls = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._published = threading.Condition(self._lock)
+
+    def seek(self, position):
+        """
+        Jumps to a record position, clamped to the recording
+        """
+        with self._lock:
+            self.position = max(0, min(len(self.recording) - 1, position))
+        self.poke()
+
+    def seek_seconds(self, delta):
+        """
+        Jumps forwards or backwards by a number of seconds of recorded time
+        """
+        self.seek(self.recording.find(self.recording.timestamp_at(self.position) + delta))
+
+    def toggle_pause(self):
+        """
+        Pauses the replay, or carries on from where it was paused
+        """
+        self.paused = not self.paused
+        self.poke()
+
+    def change_speed(self, factor):
+        """
+        Multiplies the replay speed by factor, keeping it between x1/16 and x1024
+        """
+        self.speed = max(1 / 16, min(self.speed * factor, 1024))
+        self.poke()
+
+    def poke(self):
+        """
+        Wakes the replay thread so it republishes right away
+        """
+        self._wake.set()
+
+    def set_gpu(self, index, gpu):
+        """
+        GPUs can't be switched in a replay, this only exists to match Sampler
+        """
+
+    def stop(self):
+        """
+        Stops the replay thread
+        """
+        self._stop_event.set()
+        self._wake.set()
+        if self.is_alive():
+            self.join(timeout=2)
+
+    def wait_for_sample(self, timeout=None):
+        """
+        Blocks until a snapshot is available (or the timeout expires) and returns it
+        """
+        with self._published:
+            self._published.wait_for(lambda: self.latest is not None, timeout)
+            return self.latest
+
+    def run(self):
+        while not self._stop_event.is_set():
+            with self._lock:
+                position = self.position
+            started = time.perf_counter()
+            index, sample = self.recording.read(position)
+            elapsed = time.perf_counter() - started
+            with self._published:
+                self.samples += 1
+                self.sample_seconds += elapsed
+                self.sample_max = max(self.sample_max, elapsed)
+                self.index = index
+                self.latest = sample
+                self.generation += 1
+                self._published.notify_all()
+            for listener in self.listeners:
+                listener(index, sample)
+            if self.paused or position + 1 >= len(self.recording):
+                delay = None  # Sit still until we're poked
+            else:
+                delay = min(self.MAX_GAP, max(0, self.recording.timestamp_at(position + 1) - sample.timestamp)) / self.speed
+            if self._wake.wait(delay):
+                self._wake.clear()
+                continue
+            with self._lock:
+                if self.position == position:
+                    self.position += 1
+
+
+ProcessInfo = namedtuple("ProcessInfo", ["pid", "name", "user", "cmdline", "type", "vram", "sm_util", "mem_util"])
+
+
+class ProcessTracker:
     """
-    Helper function to add a + sign to positive numbers and output them back
+    Keeps track of the processes running on the GPUs for the process monitor. What we know about a PID (name, user and
+    command line) is looked up once and cached until the process exits or its PID gets reused, and the per process
+    utilization is read incrementally so every refresh only asks the driver for what happened since the last one.
     """
-    return f"+{offset}" if offset > 0 else offset
+    def __init__(self):
+        self._details = {}  # {pid: (psutil.Process or None, name, user, cmdline)}
+        self._utilization = {}  # {index: {pid: (sm_util, mem_util)}}
+        self._last_seen = {}  # {index: driver timestamp in µs}
+        self._unsupported = set()
+
+    def _describe(self, pid):
+        """
+        Returns the cached (process, name, user, cmdline) of a PID, looking it up if it's new or was reused
+        """
+        cached = self._details.get(pid)
+        if cached is not None and (cached[0] is None or cached[0].is_running()):  # is_running() also catches reuse
+            return cached
+        try:
+            process = psutil.Process(pid)
+            with process.oneshot():
+                details = (process, process.name(), process.username(), " ".join(process.cmdline()))
+        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+            details = (None, f"[{pid}]", "?", "")  # Exited already or lives in another PID namespace
+        self._details[pid] = details
+        return details
+
+    def _read_utilization(self, index, gpu):
+        """
+        Updates the SM/memory utilization of the processes on a GPU with the samples the driver took since the last read
+        """
+        if index in self._unsupported:
+            return
+        try:
+            samples = nv.nvmlDeviceGetProcessUtilization(gpu, self._last_seen.get(index, 0))
+        except (nv.NVMLError_NotSupported, nv.NVMLError_FunctionNotFound):
+            self._unsupported.add(index)
+            return
+        except nv.NVMLError:
+            return  # NotFound means nothing new, keep showing what we had
+        latest = {}
+        for sample in samples:
+            if sample.pid not in latest or sample.timeStamp > latest[sample.pid].timeStamp:
+                latest[sample.pid] = sample
+        if latest:
+            self._last_seen[index] = max(sample.timeStamp for sample in latest.values())
+        self._utilization[index] = {pid: (sample.smUtil, sample.memUtil) for pid, sample in latest.items()}
+
+    def refresh(self, index, gpu):
+        """
+        Returns a ProcessInfo for every process running on a GPU, utilization is None if the driver can't tell.
+        Raises NVMLError if the processes can't be listed. Takes in the GPU index and handle
+        """
+        running = [("Graphics", process) for process in nv.nvmlDeviceGetGraphicsRunningProcesses_v3(gpu)]
+        running += [("Compute", process) for process in nv.nvmlDeviceGetComputeRunningProcesses_v3(gpu)]
+        self._read_utilization(index, gpu)
+        pids = {process.pid for _, process in running}
+        for pid in [pid for pid in self._details if pid not in pids]:
+            del self._details[pid]  # Exited, or at least not on the GPU anymore
+        utilization = self._utilization.get(index, {})
+        no_utilization = (None, None) if index in self._unsupported else (0, 0)
+        processes = []
+        for process_type, process in running:
+            _, name, user, cmdline = self._describe(process.pid)
+            processes.append(ProcessInfo(process.pid, name, user, cmdline, process_type, process.usedGpuMemory or 0,
+                                         *utilization.get(process.pid, no_utilization)))
+        return processes
+
+
+class ScreenBuffer:
+    """
+    Frame buffer in front of a curses window. Text is collected per frame and on flush only the pieces that changed since
+    the previous frame are written, so static labels go out once and the terminal only sees the cells that moved.
+    Also keeps an estimate of the bytes each frame costs on the wire, which is what matters over a slow SSH link.
+    Works without a window too, then it only does the bookkeeping.
+    """
+    MOVE_COST = 6  # Rough size of a cursor movement escape sequence
+    ATTR_COST = 10  # Rough size of switching colors/attributes
+
+    def __init__(self, window=None):
+        self.window = window
+        self.current = {}
+        self.previous = {}
+        self.last_frame_bytes = 0
+        self.total_bytes = 0
+        self.frames = 0
+
+    def addstr(self, y, x, text, attr=0):
+        """
+        Puts text at a position for this frame, same arguments as curses addstr
+        """
+        self.current[(y, x)] = (str(text), attr)
+
+    def invalidate(self):
+        """
+        Forgets what is on screen, for when something drew to the window behind our back. The next flush redraws it all
+        """
+        self.previous = {}
+        if self.window is not None:
+            self.window.erase()
+
+    def _cost(self, old_text, new_text, attr_changed):
+        """
+        Estimates the terminal bytes needed to turn old_text into new_text in place
+        """
+        if old_text is None or attr_changed:
+            return self.MOVE_COST + self.ATTR_COST + len(new_text.encode("utf-8"))
+        cost = 0
+        in_run = False
+        for i, char in enumerate(new_text):
+            if i < len(old_text) and old_text[i] == char:
+                in_run = False
+                continue
+            if not in_run:
+                cost += self.MOVE_COST
+                in_run = True
+            cost += len(char.encode("utf-8"))
+        return cost
+
+    def _blank(self, y, start, end, covered):
+        """
+        Blanks the columns start to end of row y that no entry of this frame covers, returns what that cost
+        """
+        cost = 0
+        x = start
+        while x < end:
+            if x in covered.get(y, ()):
+                x += 1
+                continue
+            run_start = x
+            while x < end and x not in covered.get(y, ()):
+                x += 1
+            cost += self.MOVE_COST + x - run_start
+            if self.window is not None:
+                self.window.addstr(y, run_start, " " * (x - run_start))
+        return cost
+
+    def flush(self):
+        """
+        Writes the differences between this frame and the last one and pushes them to the terminal in one update
+        """
+        frame_bytes = 0
+        #  Columns something is drawn at this frame, blanking leftovers must not wipe an entry that overlaps them
+        covered = {}
+        for (y, x), (text, _) in self.current.items():
+            covered.setdefault(y, set()).update(range(x, x + len(text)))
+        for (y, x), (old_text, _) in self.previous.items():
+            if (y, x) not in self.current:  # Blank out whatever isn't drawn anymore
+                frame_bytes += self._blank(y, x, x + len(old_text), covered)
+        for position, (text, attr) in self.current.items():
+            old = self.previous.get(position)
+            if old == (text, attr):
+                continue
+            frame_bytes += self._cost(old[0] if old is not None else None, text, old is not None and old[1] != attr)
+            if self.window is not None:
+                self.window.addstr(position[0], position[1], text, attr)
+            if old is not None and len(old[0]) > len(text):  # Leftovers of a longer old value
+                frame_bytes += self._blank(position[0], position[1] + len(text), position[1] + len(old[0]), covered)
+        self.previous = self.current
+        self.current = {}
+        self.last_frame_bytes = frame_bytes
+        self.total_bytes += frame_bytes
+        self.frames += 1
+        if self.window is not None:
+            self.window.noutrefresh()
+            curses.doupdate()
+
+
+BENCHMARK_OPERATIONS = [("--set-clocks", ["--set-clocks", "-100", "500"]),
+                        ("--set-power-limit", ["--set-power-limit", "200"]),
+                        ("--set-custom-fan", ["--set-custom-fan", "60"]),
+                        ("--set-max-fan", ["--set-max-fan"]),
+                        ("--set-auto-fan", ["--set-auto-fan"]),
+                        ("--set-profile", ["--set-profile", "1"])]
+
+
+def _benchmark_monitor(gpu_count, refresh_rate, screen_name, duration, latency):
+    """
+    Runs the monitor against simulated GPUs on a pseudo terminal for a while and returns what it cost per frame.
+    Terminal bytes are counted on our end of the pty so they are exactly what an SSH session would have to carry.
+    """
+    with tempfile.TemporaryDirectory(prefix="bnt-benchmark-") as temp_dir:
+        stats_path = os.path.join(temp_dir, "stats.json")
+        command = [sys.executable, os.path.abspath(__file__), "--simulate", str(gpu_count), "--simulate-latency", str(latency),
+                   "--refresh-rate", str(refresh_rate), "--benchmark-duration", str(duration), "--benchmark-stats", stats_path]
+        if screen_name == "overview":
+            command.append("--overview")
+        env = dict(os.environ, TERM="xterm-256color", LINES="50", COLUMNS="120")
+        master, slave = pty.openpty()
+        process = subprocess.Popen(command, stdin=slave, stdout=slave, stderr=slave, env=env, start_new_session=True)
+        os.close(slave)
+        terminal_bytes = 0
+        while True:
+            try:
+                data = os.read(master, 65536)
+            except OSError:  # EIO once the child is gone and the pty is closed
+                break
+            if not data:
+                break
+            terminal_bytes += len(data)
+        os.close(master)
+        try:
+            process.wait(timeout=duration + 15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        if not os.path.exists(stats_path):
+            return {"gpus": gpu_count, "refresh_rate": refresh_rate, "screen": screen_name, "error": f"monitor exited with {process.returncode} before reporting"}
+        with open(stats_path, "r", encoding="utf-8") as file:
+            stats = json.load(file)
+    frames = max(stats["frames"], 1)
+    samples = max(stats["samples"], 1)
+    return {"gpus": gpu_count,
+            "refresh_rate": refresh_rate,
+            "screen": screen_name,
+            "frames": stats["frames"],
+            "samples": stats["samples"],
+            "nvml_calls_per_sample": round(stats["nvml_calls"] / samples, 2),
+            "nvml_calls_per_second": round(stats["nvml_calls"] / duration, 1),
+            "sample_ms_mean": round(stats["sample_seconds"] / samples * 1000, 3),
+            "sample_ms_max": round(stats["sample_max"] * 1000, 3),
+            "render_ms_mean": round(stats["render_seconds"] / frames * 1000, 3),
+            "render_ms_max": round(stats["render_max"] * 1000, 3),
+            "estimated_bytes_per_frame": round(stats["estimated_bytes"] / frames, 1),
+            "terminal_bytes": terminal_bytes,
+            "terminal_bytes_per_second": round(terminal_bytes / duration, 1)}
+
+
+def _benchmark_offline(gpu_count, name, operation, runs, latency):
+    """
+    Times one offline operation end to end, from starting the interpreter to it exiting, against simulated GPUs
+    """
+    with tempfile.TemporaryDirectory(prefix="bnt-benchmark-") as temp_dir:
+        simulated = SimulatedNvml(gpu_count)
+        ProfileStore(os.path.join(temp_dir, "profiles.json")).save(simulated.nvmlDeviceGetUUID(simulated.nvmlDeviceGetHandleByIndex(0)),
+                                                                   "1", Profile(-100, 500, 200, 1, 60))
+        stats_path = os.path.join(temp_dir, "stats.json")
+        command = [sys.executable, os.path.abspath(__file__), "--simulate", str(gpu_count), "--simulate-latency", str(latency),
+                   "--profile-dir", temp_dir, "--benchmark-stats", stats_path] + operation
+        wall_times = []
+        in_process_times = []
+        nvml_calls = None
+        returncode = 0
+        for _ in range(runs):
+            started = time.perf_counter()
+            process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+            wall_times.append(time.perf_counter() - started)
+            returncode = returncode or process.returncode
+            if os.path.exists(stats_path):
+                with open(stats_path, "r", encoding="utf-8") as file:
+                    stats = json.load(file)
+                in_process_times.append(stats["seconds"])
+                nvml_calls = stats["nvml_calls"]
+    result = {"operation": name,
+              "arguments": operation,
+              "runs": runs,
+              "wall_ms_median": round(statistics.median(wall_times) * 1000, 2),
+              "wall_ms_min": round(min(wall_times) * 1000, 2),
+              "wall_ms_max": round(max(wall_times) * 1000, 2),
+              "nvml_calls": nvml_calls}
+    if in_process_times:
+        result["in_process_ms_median"] = round(statistics.median(in_process_times) * 1000, 3)
+    if returncode:
+        result["error"] = f"exited with {returncode}"
+    return result
+
+
+def run_benchmark(gpu_counts, refresh_rates, duration, runs, latency, output):
+    """
+    Benchmarks the monitor at every GPU count and refresh rate on both the monitor and overview screens, then times
+    each offline operation. Everything runs against simulated GPUs in child processes and the results go out as JSON.
+    """
+    results = {"version": __VERSION__,
+               "python": sys.version.split()[0],
+               "duration": duration,
+               "simulate_latency": latency,
+               "monitor": [],
+               "offline": []}
+    for gpu_count in gpu_counts:
+        for refresh_rate in refresh_rates:
+            for screen_name in ["monitor", "overview"]:
+                print(f"Benchmarking the {screen_name} with {gpu_count} GPUs at {refresh_rate} ms...", file=sys.stderr)
+                results["monitor"].append(_benchmark_monitor(gpu_count, refresh_rate, screen_name, duration, latency))
+    for name, operation in BENCHMARK_OPERATIONS:
+        print(f"Benchmarking {name}...", file=sys.stderr)
+        results["offline"].append(_benchmark_offline(max(gpu_counts), name, operation, runs, latency))
+    if output:
+        with open(output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+            file.write("\n")
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
 
 
 def draw_dashboard(stdscr):
@@ -76,8 +3355,26 @@ def draw_dashboard(stdscr):
         """
         Simple function to show the header
         """
-        stdscr.addstr(0, 0, "                    Blissful Nvidia Tool", MAGENTA)
-        stdscr.addstr(1, 0, "------------------------------------------------------------")
+        screen.addstr(0, 0, "                    Blissful Nvidia Tool", MAGENTA)
+        screen.addstr(1, 0, "------------------------------------------------------------")
+
+    def draw_waiting():
+        """
+        Draws the monitor with placeholders while there is no good sample of the GPU yet, and why if sampling failed
+        """
+        header()
+        screen.addstr(3, 2, "GPU: ", YELLOW)
+        screen.addstr(3, 22, f"{sampler.index} - {info.name}", GREEN)
+        for row, label in enumerate(["Core Clock Freq: ", "Mem Clock Freq: ", "Temp/Fan: ", "Power: ", "VRAM Usage: ",
+                                     "GPU Core Usage: ", "Mem Controller: ", "Clock Reasons: "], start=4):
+            screen.addstr(row, 2, label, YELLOW)
+            screen.addstr(row, 22, "--", GRAY)
+        screen.addstr(12, 2, "Press \"h\" for help or \"q\" to quit!")
+        if sampler.error is not None:
+            screen.addstr(input_start, 0, f"Sampling failed, waiting for a good reading: {sampler.error}", RED)
+        else:
+            screen.addstr(input_start, 0, "Waiting for the first sample...", GRAY)
+        screen.flush()
 
     def load_profile(profile_number):
         """
@@ -85,41 +3382,23 @@ def draw_dashboard(stdscr):
         """
         stdscr.addstr(input_start, 0, f"Loading profile {profile_number} for GPU {args.gpu_number}!")
         try:
-            with open(os.path.join(source_dir, f"profile{profile_number}_{args.gpu_number}.bnt"), "r", encoding="utf-8") as file:
-                new_core_offset = int(file.readline())
-                new_mem_offset = int(file.readline())
-                new_power_limit = int(file.readline())
-                new_fan_policy = int(file.readline())
-                new_fan_speed = int(file.readline())
-                stdscr.addstr(input_start + 1, 0, f"Setting core clock offset to {add_sign(new_core_offset)} Mhz...")
-                nv.nvmlDeviceSetGpcClkVfOffset(gpu, new_core_offset)
-                stdscr.addstr(input_start + 2, 0, f"Setting mem clock offset to {add_sign(new_mem_offset)} Mhz...")
-                nv.nvmlDeviceSetMemClkVfOffset(gpu, new_mem_offset * 2)
-                stdscr.addstr(input_start + 3, 0, f"Setting core power limit to {new_power_limit}...")
-                nv.nvmlDeviceSetPowerManagementLimit(gpu, new_power_limit * 1000)
-                if new_fan_policy == 1:
-                    if 101 > new_fan_speed > 29:
-                        stdscr.addstr(input_start + 4, 0, f"Setting fan policy to manual and fan speed to {new_fan_speed}%...")
-                        num_fans = nv.nvmlDeviceGetNumFans(gpu)
-                        for i in range(0, num_fans):
-                            nv.nvmlDeviceSetFanControlPolicy(gpu, i, nv.NVML_FAN_POLICY_MANUAL)
-                            nv.nvmlDeviceSetFanSpeed_v2(gpu, i, new_fan_speed)
-                    else:
-                        raise ValueError("Invalid fan speed setting in profile!")
-                else:
-                    stdscr.addstr(input_start + 4, 0, "Setting fan policy to automatic control...")
-                    num_fans = nv.nvmlDeviceGetNumFans(gpu)
-                    for i in range(0, num_fans):
-                        nv.nvmlDeviceSetFanControlPolicy(gpu, i, nv.NVML_FAN_POLICY_TEMPERATURE_CONTINOUS_SW)
-                        nv.nvmlDeviceSetDefaultFanSpeed_v2(gpu, i)
+            profile = check_profile(profiles.get(profile_key(info), str(profile_number)))
+            stdscr.addstr(input_start + 1, 0, f"Setting core clock offset to {add_sign(profile.core_offset)} Mhz...")
+            stdscr.addstr(input_start + 2, 0, f"Setting mem clock offset to {add_sign(profile.mem_offset)} Mhz...")
+            stdscr.addstr(input_start + 3, 0, f"Setting core power limit to {profile.power_limit}...")
+            if profile.fan_policy == 1:
+                stdscr.addstr(input_start + 4, 0, f"Setting fan policy to manual and fan speed to {profile.fan_speed}%...")
+            else:
+                stdscr.addstr(input_start + 4, 0, "Setting fan policy to automatic control...")
+            apply_profile(gpu, info.num_fans, profile)
             return profile_number
         except ValueError as e:
             stdscr.addstr(input_start + 1, 0, f"Some kind of value error prevented the profile loading: {e}")
             return 66
         except nv.NVMLError as e:
-            stdscr.addstr(input_start + 1, 0, f"Some kind of NVML error prevented the profile loading: {e}")
+            stdscr.addstr(input_start + 1, 0, f"Some kind of NVML error prevented the profile loading: {e}. The previous settings were restored.")
             return 66
-        except FileNotFoundError:
+        except KeyError:
             stdscr.addstr(input_start + 1, 0, "Profile was not found!")
             return 66
 
@@ -128,27 +3407,112 @@ def draw_dashboard(stdscr):
         Saves current settings to the specified profile number.
         """
         stdscr.addstr(input_start, 0, f"Current settings will be saved as profile {profile_number} for GPU {args.gpu_number}!")
-        with open(os.path.join(source_dir, f"profile{profile_number}_{args.gpu_number}.bnt"), "w", encoding="utf-8") as file:
-            file.write(str(int(current_core_offset)) + "\n")
-            file.write(str(int(current_mem_offset)) + "\n")
-            file.write(str(int(current_power_limit)) + "\n")
-            file.write(str(fan_policy.value) + "\n")
-            file.write(str(fan_speed) + "\n")
-        profile_exists[profile_number] = True
+        try:
+            profiles.save(profile_key(info), str(profile_number), profile_from_sample(sample))
+            profile_exists[profile_number] = True
+        except (OSError, ValueError) as e:
+            stdscr.addstr(input_start + 1, 0, f"Couldn't save the profile: {e}")
 
     def delete_profile(profile_number):
         """
         Simply deletes the specified profile
         """
-        profile_path = os.path.join(source_dir, f"profile{profile_number}_{args.gpu_number}.bnt")
-        if os.path.exists(profile_path):
-            os.remove(profile_path)
+        if profiles.delete(profile_key(info), str(profile_number)):
             stdscr.addstr(input_start, 0, f"Deleted profile {profile_number} for GPU {args.gpu_number}!")
             profile_exists[profile_number] = False
         else:
             stdscr.addstr(input_start, 0, f"Nope, profile {profile_number} doesn't exist so we can't delete it, silly!")
+
+    def refresh_profile_slots():
+        """
+        Marks which of the profile slots 1-4 have a profile saved for the current GPU
+        """
+        names = profiles.names(profile_key(get_device_info(args.gpu_number, gpu)))
+        for i in range(1, 5):
+            profile_exists[i] = str(i) in names
+
+    def draw_overview():
+        """
+        Draws the overview screen, one compact row per GPU from the latest overview snapshots
+        """
+        header()
+        screen.addstr(2, 0, "Overview of all GPUs:", BLUE)
+        for x, title in [(2, "#"), (5, "Name"), (28, "Core"), (40, "Mem"), (52, "Temp/Fan"), (65, "Power"), (82, "VRAM"), (90, "Util")]:
+            screen.addstr(3, x, title, YELLOW)
+        latest = overview.latest
+        for row, (index, handle) in enumerate(overview.handles):
+            y = 4 + row
+            row_info = get_device_info(index, handle)
+            row_sample = latest.get(index)
+            if index == args.gpu_number:
+                screen.addstr(y, 0, ">", MAGENTA)
+            screen.addstr(y, 2, f"{index}", GREEN)
+            screen.addstr(y, 5, row_info.name[:22], GREEN)
+            if row_sample is None:
+                screen.addstr(y, 28, "Waiting for first sample...", GRAY)
+            else:
+                row_colors = [WHITE] * 6
+                if args.reactive_color:
+                    row_colors = [set_color(row_sample.core_clock / row_info.max_core_clock * 100, *COLOR_THRESHOLDS["core_clock"]),
+                                  set_color(row_sample.mem_clock / row_info.max_mem_clock * 100, *COLOR_THRESHOLDS["mem_clock"]),
+                                  set_color(row_sample.temperature, *COLOR_THRESHOLDS["temperature"]),
+                                  set_color(row_sample.power_usage / row_sample.power_limit * 100, *COLOR_THRESHOLDS["power_usage"]),
+                                  set_color(row_sample.mem_used / row_sample.mem_total * 100, *COLOR_THRESHOLDS["vram"]),
+                                  set_color(row_sample.gpu_util, *COLOR_THRESHOLDS["gpu_util"])]
+                screen.addstr(y, 28, f"{row_sample.core_clock} Mhz", row_colors[0])
+                screen.addstr(y, 40, f"{row_sample.mem_clock} Mhz", row_colors[1])
+                screen.addstr(y, 52, f"{row_sample.temperature}°C | {row_sample.fan_speed}%", row_colors[2])
+                screen.addstr(y, 65, f"{row_sample.power_usage:.0f} / {row_sample.power_limit:.0f} W", row_colors[3])
+                screen.addstr(y, 82, f"{row_sample.mem_used / row_sample.mem_total * 100:.0f}%", row_colors[4])
+                screen.addstr(y, 90, f"{row_sample.gpu_util}%", row_colors[5])
+            if overview.stalled(index):
+                screen.addstr(y, 96, "(stalled)", RED)
+            elif overview.errors.get(index) is not None:
+                screen.addstr(y, 96, "(error)", RED)
+            elif events is not None and events.counts.get(index, {}).get("xid"):
+                screen.addstr(y, 96, f"({events.counts[index]['xid']} Xid)", RED)
+        screen.addstr(5 + len(overview.handles), 2, "Press \"o\" to return to the monitor, \"h\" for help or \"q\" to quit!")
+        screen.flush()
+
+    def write_benchmark_stats(render_seconds, render_max):
+        """
+        Writes what this run of the monitor cost to the --benchmark-stats file for the --benchmark parent to collect
+        """
+        samplers = [sampler] + ([overview] if overview is not None else [])
+        samples = sum(s.samples for s in samplers)
+        stats = {"frames": screen.frames,
+                 "samples": samples,
+                 "nvml_calls": sum(s.nvml_calls for s in samplers),
+                 "sample_seconds": sum(s.sample_seconds for s in samplers),
+                 "sample_max": max(s.sample_max for s in samplers),
+                 "render_seconds": render_seconds,
+                 "render_max": render_max,
+                 "estimated_bytes": screen.total_bytes}
+        with open(args.benchmark_stats, "w", encoding="utf-8") as file:
+            json.dump(stats, file)
+
+    def shutdown():
+        """
+        Stops everything running in the background, releases NVML and exits
+        """
+        sampler.stop()
+        if overview is not None:
+            overview.stop()
+        if events is not None:
+            events.stop()
+        for controller in fan_controllers.values():
+            controller.stop()
+        if governor is not None:
+            governor.stop()
+        if recorder is not None:
+            recorder.close()
+        if recording is None:
+            nv.nvmlShutdown()
+        sys.exit(1)
+
     global gpu
     stdscr.clear()
+    screen = ScreenBuffer(stdscr)
     curses.curs_set(0)    # Hide cursor
     curses.echo()
     if curses.has_colors():
@@ -198,128 +3562,240 @@ def draw_dashboard(stdscr):
                 stdscr.refresh()
                 time.sleep(1)
             sys.exit()
-        for i in range(1, 5):
-            if os.path.exists(os.path.join(source_dir, f"profile{i}_{args.gpu_number}.bnt")):
-                profile_exists[i] = True
-    num_gpus = nv.nvmlDeviceGetCount()
-    gpu_name = nv.nvmlDeviceGetName(gpu)
-    default_power_limit = nv.nvmlDeviceGetPowerManagementDefaultLimit(gpu) / 1000
+        refresh_profile_slots()
+    input_start = 14
+    if recording is not None:
+        num_gpus = 1  # GPUs can't be switched in a replay
+        sampler = ReplaySampler(recording, args.replay_speed)
+        if args.replay_start:
+            sampler.seek(recording.find(recording.timestamp_at(0) + args.replay_start))
+    else:
+        num_gpus = nv.nvmlDeviceGetCount()
+        sampler = Sampler(args.gpu_number, gpu, args.refresh_rate / 1000, make_adaptive(), make_buffers())
+    histories = {}
+    sampler.listeners.append(lambda index, new_sample: histories.setdefault(index, MetricHistory(args.history_length)).record(new_sample))
+    sampler.listeners.append(lambda index, new_sample: session_stats.setdefault(index, SessionStats(args.stats_window)).record(new_sample, get_device_info(index, sampler.gpu)))
+    if recorder is not None:
+        sampler.listeners.append(recorder.record)
+    sampler.start()
+    sample = sampler.wait_for_sample()
+    info = get_device_info(sampler.index, sampler.gpu)
+    drawn_generation = -1
+    processes = ProcessTracker()
+    process_sort = "VRAM"
+    process_scroll = 0
+    events = None
+    drawn_events = 0
+    if recording is None and not args.no_events:
+        events = EventWatcher([(i, nv.nvmlDeviceGetHandleByIndex(i)) for i in range(num_gpus)])
+        events.start()
+    overview = None
+    if args.overview and recording is None:
+        overview = OverviewSampler([(i, nv.nvmlDeviceGetHandleByIndex(i)) for i in range(num_gpus)], args.refresh_rate / 1000, make_adaptive(), make_buffers())
+        overview.start()
+    overview_drawn_at = 0
+    render_seconds = 0.0
+    render_max = 0.0
+    benchmark_deadline = time.monotonic() + args.benchmark_duration
     stdscr.nodelay(True)
     while True:
-        stdscr.clear()
-        current_core_offset = nv.nvmlDeviceGetGpcClkVfOffset(gpu)
-        current_mem_offset = nv.nvmlDeviceGetMemClkVfOffset(gpu) / 2
-        #  If the offset is negative, pynvml may return a value that is munged by truncated overflow
-        #  Since offsets will never legitimately be this large, this should be a safe fix.
-        if current_core_offset > 100000:
-            current_core_offset = current_core_offset - 4294966
-        if current_mem_offset > 100000:
-            current_mem_offset = current_mem_offset - 4294966
-        core_offset_sign = add_sign(current_core_offset)
-        mem_offset_sign = add_sign(current_mem_offset)
-        fan_policy = ctypes.c_uint()
-        nv.nvmlDeviceGetFanControlPolicy_v2(gpu, 0, ctypes.byref(fan_policy))
-        fan_policy_str = "Manual" if fan_policy.value == 1 else "Auto"
-        fan_speed = nv.nvmlDeviceGetFanSpeed(gpu)
-        current_temperature = nv.nvmlDeviceGetTemperature(gpu, 0)
-        current_power_usage = nv.nvmlDeviceGetPowerUsage(gpu) / 1000  # Convert mW to W
-        utilization = nv.nvmlDeviceGetUtilizationRates(gpu)
-        mem_info = nv.nvmlDeviceGetMemoryInfo(gpu)
-        core_clock = nv.nvmlDeviceGetClockInfo(gpu, nv.NVML_CLOCK_GRAPHICS)
-        core_clock_str = f"{core_clock} Mhz ({core_offset_sign} Mhz)" if current_core_offset != 0 else f"{core_clock} Mhz"
-        max_core_clock = nv.nvmlDeviceGetMaxClockInfo(gpu, nv.NVML_CLOCK_GRAPHICS)
-        max_mem_clock = nv.nvmlDeviceGetMaxClockInfo(gpu, nv.NVML_CLOCK_MEM)
-        mem_clock = nv.nvmlDeviceGetClockInfo(gpu, nv.NVML_CLOCK_MEM)
-        mem_clock_str = f"{mem_clock} Mhz ({mem_offset_sign} Mhz)" if current_mem_offset != 0 else f"{mem_clock} Mhz"
-        current_power_limit = nv.nvmlDeviceGetPowerManagementLimit(gpu) / 1000
-        current_power_offset = current_power_limit - default_power_limit
-        power_offset_str = add_sign(current_power_offset)
-        current_power_percentage = (current_power_usage / current_power_limit) * 100
-        current_clock_percentage = (core_clock / max_core_clock) * 100
-        current_mem_clock_percentage = (mem_clock / max_mem_clock) * 100
-        current_vram_percentage = (mem_info.used / mem_info.total) * 100
-        if args.reactive_color:
-            temp_color = set_color(current_temperature, 65, 80)
-            power_color = set_color(current_power_percentage, 70, 90)
-            clock_color = set_color(current_clock_percentage, 70, 90)
-            mem_clock_color = set_color(current_mem_clock_percentage, 70, 90)
-            util_color = set_color(utilization.gpu, 70, 90)
-            mem_util_color = set_color(utilization.memory, 70, 90)
-            vram_color = set_color(current_vram_percentage, 70, 90)
-        header()
-        if args.interactive:
-            for i in range(1, 5):
-                if USE_COLOR:
-                    profile_color = YELLOW if active_profile == i else BLUE if profile_exists[i] else GRAY
+        if args.benchmark_stats and time.monotonic() >= benchmark_deadline:
+            write_benchmark_stats(render_seconds, render_max)
+            shutdown()
+        # Only redraw when the sampler has published something new, input is polled in between
+        frames_before = screen.frames
+        render_started = time.perf_counter()
+        if overview is not None:
+            #  Also redraw on a timer so a GPU that stops answering gets flagged even though nothing new was published
+            if overview.generation != drawn_generation or time.monotonic() - overview_drawn_at >= overview.interval:
+                drawn_generation = overview.generation
+                overview_drawn_at = time.monotonic()
+                draw_overview()
+        elif sample is None and sampler.latest is None:
+            #  Not one good sample yet, keep showing why until the sampler gets one
+            if sampler.generation != drawn_generation:
+                drawn_generation = sampler.generation
+                draw_waiting()
+        elif sampler.generation != drawn_generation or (events is not None and events.generation != drawn_events):
+            drawn_generation = sampler.generation
+            drawn_events = events.generation if events is not None else 0
+            sample = sampler.latest if sampler.latest is not None else sample
+            current_core_offset = sample.core_offset
+            current_mem_offset = sample.mem_offset
+            core_offset_sign = add_sign(current_core_offset)
+            mem_offset_sign = add_sign(current_mem_offset)
+            fan_policy_str = "Manual" if sample.fan_policy == 1 else "Auto"
+            if sampler.index in fan_controllers:
+                fan_policy_str = "Curve" if fan_controllers[sampler.index].error is None else "Curve, failing"
+            fan_str = f"{sample.fan_speed}% ({fan_policy_str})"
+            if recording is None and not capabilities.available(profile_key(get_device_info(sampler.index, sampler.gpu)), "fan_speed"):
+                fan_str = "No fan reading"
+            core_clock_str = f"{sample.core_clock} Mhz ({core_offset_sign} Mhz)" if current_core_offset != 0 else f"{sample.core_clock} Mhz"
+            mem_clock_str = f"{sample.mem_clock} Mhz ({mem_offset_sign} Mhz)" if current_mem_offset != 0 else f"{sample.mem_clock} Mhz"
+            info = get_device_info(sampler.index, sampler.gpu)
+            current_power_offset = sample.power_limit - info.default_power_limit
+            power_offset_str = add_sign(current_power_offset)
+            power_label = "Power: "
+            if governor is not None and sampler.index in governor.limits:
+                power_label = "Power (governed): " if governor.error is None else "Power (gov. err): "
+            current_power_percentage = (sample.power_usage / sample.power_limit) * 100
+            current_clock_percentage = (sample.core_clock / info.max_core_clock) * 100
+            current_mem_clock_percentage = (sample.mem_clock / info.max_mem_clock) * 100
+            current_vram_percentage = (sample.mem_used / sample.mem_total) * 100
+            if args.reactive_color:
+                temp_color = set_color(sample.temperature, *COLOR_THRESHOLDS["temperature"])
+                power_color = set_color(current_power_percentage, *COLOR_THRESHOLDS["power_usage"])
+                clock_color = set_color(current_clock_percentage, *COLOR_THRESHOLDS["core_clock"])
+                mem_clock_color = set_color(current_mem_clock_percentage, *COLOR_THRESHOLDS["mem_clock"])
+                util_color = set_color(sample.gpu_util, *COLOR_THRESHOLDS["gpu_util"])
+                mem_util_color = set_color(sample.mem_util, *COLOR_THRESHOLDS["mem_util"])
+                vram_color = set_color(current_vram_percentage, *COLOR_THRESHOLDS["vram"])
+            header()
+            if args.interactive:
+                for i in range(1, 5):
+                    if USE_COLOR:
+                        profile_color = YELLOW if active_profile == i else BLUE if profile_exists[i] else GRAY
+                    else:
+                        profile_color = curses.A_BOLD if active_profile == i else curses.A_NORMAL if profile_exists[i] else None
+                    if profile_color is not None:
+                        screen.addstr(2, 23 + (4 * (i - 1)), f"{i}", profile_color)
+            screen.addstr(3, 2, "GPU: ", YELLOW)
+            screen.addstr(4, 2, "Core Clock Freq: ", YELLOW)
+            screen.addstr(5, 2, "Mem Clock Freq: ", YELLOW)
+            screen.addstr(6, 2, "Temp/Fan: ", YELLOW)
+            screen.addstr(7, 2, power_label, YELLOW)
+            screen.addstr(8, 2, "VRAM Usage: ", YELLOW)
+            screen.addstr(9, 2, "GPU Core Usage: ", YELLOW)
+            screen.addstr(10, 2, "Mem Controller: ", YELLOW)
+            screen.addstr(11, 2, "Clock Reasons: ", YELLOW)
+            screen.addstr(3, 22, f"{sampler.index} - {info.name}", GREEN)
+            screen.addstr(4, 22, f"{core_clock_str}", clock_color)
+            screen.addstr(5, 22, f"{mem_clock_str}", mem_clock_color)
+            screen.addstr(6, 22, f"{sample.temperature}°C | {fan_str}", temp_color)
+            screen.addstr(7, 22, f"{sample.power_usage:.2f} / {sample.power_limit:.2f} W ({power_offset_str} W)", power_color)
+            screen.addstr(8, 22, f"{sample.mem_used / (1024**2):.2f} / {sample.mem_total / (1024**2):.2f} MB", vram_color)
+            screen.addstr(9, 22, f"{sample.gpu_util}%", util_color)
+            screen.addstr(10, 22, f"{sample.mem_util}%", mem_util_color)
+            reasons = active_clock_reasons(sample.clock_reasons)
+            reasons_color = RED if set(reasons) - {"idle", "power_cap", "sync_boost"} else YELLOW if "power_cap" in reasons else GRAY
+            screen.addstr(11, 22, ", ".join(label for name, label, _ in CLOCK_REASONS if name in reasons) or "None", reasons_color)
+            if sampler.stats and stdscr.getmaxyx()[1] > STATS_COLUMN + 32:
+                screen.addstr(3, STATS_COLUMN, "min / avg / max / p99", YELLOW)
+                for row, name, unit in [(4, "core_clock", ""), (5, "mem_clock", ""), (7, "power_usage", " W"), (9, "gpu_util", "%"), (10, "mem_util", "%")]:
+                    stats = sampler.stats.get(name)
+                    if stats is not None:
+                        screen.addstr(row, STATS_COLUMN, f"{stats.min:.0f} / {stats.avg:.0f} / {stats.max:.0f} / {stats.p99:.0f}{unit}", GRAY)
+            session = session_stats.get(sampler.index)
+            rolling_column = STATS_COLUMN + 34 if sampler.stats else STATS_COLUMN  # Next to the --sample-buffers stats
+            if session is not None and stdscr.getmaxyx()[1] > rolling_column + 40:
+                screen.addstr(3, rolling_column, f"min / mean / max (last {args.stats_window}) | p95 / p99", YELLOW)
+                for row, name in [(4, "core_clock"), (5, "mem_clock"), (6, "temperature"), (7, "power_usage"), (8, "vram"), (9, "gpu_util"), (10, "mem_util")]:
+                    stats = session.stats[name]
+                    screen.addstr(row, rolling_column, f"{stats.window_min:.0f} / {stats.window_mean:.0f} / {stats.window_max:.0f} | {stats.p95.value():.0f} / {stats.p99.value():.0f}", GRAY)
+            history = histories.get(sampler.index)
+            if history is not None and stdscr.getmaxyx()[1] > SPARK_COLUMN + SPARK_WIDTH:
+                for row, name, low, high in [(4, "core_clock", 0, info.max_core_clock), (5, "mem_clock", 0, info.max_mem_clock),
+                                             (6, "temperature", 20, 100), (7, "power_usage", 0, sample.power_limit),
+                                             (8, "vram", 0, 100), (9, "gpu_util", 0, 100), (10, "mem_util", 0, 100)]:
+                    screen.addstr(row, SPARK_COLUMN, sparkline(history.rings[name].last(SPARK_WIDTH), low, high), GRAY)
+            if recording is not None:
+                replay_state = "Paused" if sampler.paused else f"x{sampler.speed:g}"
+                replay_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(sample.timestamp))
+                screen.addstr(2, 0, f"Replay {replay_time} ({replay_state}) {sampler.position + 1}/{len(recording)}", MAGENTA)
+                screen.addstr(13, 2, "Space pause, +/- speed, <-/-> seek 10s, [/] seek 10min", GRAY)
+            screen.addstr(12, 2, "Press \"h\" for help or \"q\" to quit!")
+            if sampler.error is not None:
+                screen.addstr(input_start, 0, f"Sampling failed, showing last good reading: {sampler.error}", RED)
+            if events is not None and stdscr.getmaxyx()[0] > input_start + 10:
+                #  Below the rows the interactive prompts use
+                counts = events.counts.get(sampler.index, {})
+                screen.addstr(input_start + 6, 2, "Events: ", YELLOW)
+                if events.error is not None and not events.is_alive():
+                    screen.addstr(input_start + 6, 22, f"Unavailable ({events.error})", GRAY)
                 else:
-                    profile_color = curses.A_BOLD if active_profile == i else curses.A_NORMAL if profile_exists[i] else None
-                if profile_color is not None:
-                    stdscr.addstr(2, 23 + (4 * (i - 1)), f"{i}", profile_color)
-        stdscr.addstr(3, 2, "GPU: ", YELLOW)
-        stdscr.addstr(4, 2, "Core Clock Freq: ", YELLOW)
-        stdscr.addstr(5, 2, "Mem Clock Freq: ", YELLOW)
-        stdscr.addstr(6, 2, "Temp/Fan: ", YELLOW)
-        stdscr.addstr(7, 2, "Power: ", YELLOW)
-        stdscr.addstr(8, 2, "VRAM Usage: ", YELLOW)
-        stdscr.addstr(9, 2, "GPU Core Usage: ", YELLOW)
-        stdscr.addstr(10, 2, "Mem Controller: ", YELLOW)
-        stdscr.addstr(3, 22, f"{args.gpu_number} - {gpu_name}", GREEN)
-        stdscr.addstr(4, 22, f"{core_clock_str}", clock_color)
-        stdscr.addstr(5, 22, f"{mem_clock_str}", mem_clock_color)
-        stdscr.addstr(6, 22, f"{current_temperature}°C | {fan_speed}% ({fan_policy_str})", temp_color)
-        stdscr.addstr(7, 22, f"{current_power_usage:.2f} / {current_power_limit:.2f} W ({power_offset_str} W)", power_color)
-        stdscr.addstr(8, 22, f"{mem_info.used / (1024**2):.2f} / {mem_info.total / (1024**2):.2f} MB", vram_color)
-        stdscr.addstr(9, 22, f"{utilization.gpu}%", util_color)
-        stdscr.addstr(10, 22, f"{utilization.memory}%", mem_util_color)
-        stdscr.addstr(12, 2, "Press \"h\" for help or \"q\" to quit!")
-        input_start = 14
-        stdscr.refresh()
-        stdscr.timeout(args.refresh_rate)
+                    screen.addstr(input_start + 6, 22, f"{counts.get('clock', 0)} clock | {counts.get('power_source', 0)} power source | {counts.get('xid', 0)} Xid",
+                                  RED if counts.get("xid") else WHITE)
+                for row, event in enumerate(reversed(events.recent(sampler.index, 3))):
+                    event_color = RED if event.kind == "xid" else YELLOW if event.kind == "power_source" else GRAY
+                    screen.addstr(input_start + 7 + row, 4, f"{time.strftime('%H:%M:%S', time.localtime(event.timestamp))} {describe_event(event)}", event_color)
+            if session is not None and stdscr.getmaxyx()[0] > input_start + 13:
+                #  Below the events, how long the clocks were held back for each reason and the energy used this session
+                screen.addstr(input_start + 11, 2, "Limited By: ", YELLOW)
+                limited = " | ".join(f"{label} {format_duration(seconds)} ({percent:.0f}%)" for label, seconds, percent in session.limited_by())
+                screen.addstr(input_start + 11, 22, limited or "Nothing so far", WHITE if limited else GRAY)
+                screen.addstr(input_start + 12, 2, "Energy: ", YELLOW)
+                energy = session.describe_energy()
+                screen.addstr(input_start + 12, 22, energy or "Unavailable", WHITE if energy else GRAY)
+            screen.flush()
+        if screen.frames != frames_before:
+            render_time = time.perf_counter() - render_started
+            render_seconds += render_time
+            render_max = max(render_max, render_time)
+        stdscr.timeout(min(args.refresh_rate, INPUT_POLL_MS))
         key = stdscr.getch()
         if key == ord("q"):
-            nv.nvmlShutdown()
-            sys.exit(1)
+            shutdown()
+        elif recording is not None and key in [ord(" "), ord("+"), ord("-"), curses.KEY_LEFT, curses.KEY_RIGHT, ord("["), ord("]")]:
+            if key == ord(" "):
+                sampler.toggle_pause()
+            elif key in [ord("+"), ord("-")]:
+                sampler.change_speed(2 if key == ord("+") else 1 / 2)
+            else:
+                sampler.seek_seconds({curses.KEY_LEFT: -10, curses.KEY_RIGHT: 10, ord("["): -600, ord("]"): 600}[key])
+            drawn_generation = -1
+        elif recording is not None and key in [ord("i"), ord("o")]:
+            pass  # These need a live GPU
+        elif key == ord("o"):
+            if overview is None:
+                overview = OverviewSampler([(i, nv.nvmlDeviceGetHandleByIndex(i)) for i in range(num_gpus)], args.refresh_rate / 1000, make_adaptive(), make_buffers())
+                overview.start()
+            else:
+                overview.stop()
+                overview = None
+            drawn_generation = -1
         elif key == ord("h"):
             stdscr.nodelay(False)
-            stdscr.clear()
             header()
-            stdscr.addstr(3, 0, "Blissful Legend:", BLUE)
-            stdscr.addstr(5, 2, "h", YELLOW)
-            stdscr.addstr(5, 6, "- show this help screen.")
-            stdscr.addstr(6, 2, "i", YELLOW)
-            stdscr.addstr(6, 6, "- switch to process monitor with extra info")
+            screen.addstr(3, 0, "Blissful Legend:", BLUE)
+            screen.addstr(5, 2, "h", YELLOW)
+            screen.addstr(5, 6, "- show this help screen.")
+            screen.addstr(6, 2, "i", YELLOW)
+            screen.addstr(6, 6, "- switch to process monitor with extra info")
+            screen.addstr(7, 2, "o", YELLOW)
+            screen.addstr(7, 6, "- switch to overview of all GPUs")
             if args.interactive:  # Only show interactive help if we are in interactive mode
-                stdscr.addstr(7, 2, "c", YELLOW)
-                stdscr.addstr(8, 2, "m", YELLOW)
-                stdscr.addstr(9, 2, "p", YELLOW)
-                stdscr.addstr(10, 2, "f", YELLOW)
-                stdscr.addstr(11, 2, "a", YELLOW)
+                screen.addstr(8, 2, "c", YELLOW)
+                screen.addstr(9, 2, "m", YELLOW)
+                screen.addstr(10, 2, "p", YELLOW)
+                screen.addstr(11, 2, "f", YELLOW)
+                screen.addstr(12, 2, "a", YELLOW)
                 if num_gpus > 1:  # Only show the multi gpu help if more than one is available
-                    stdscr.addstr(12, 2, "<->", YELLOW)
-                    stdscr.addstr(12, 6, "- switch between available GPUs")
+                    screen.addstr(13, 2, "<->", YELLOW)
+                    screen.addstr(13, 6, "- switch between available GPUs")
                     help_offset = 1
                 else:
                     help_offset = 0
-                stdscr.addstr(12 + help_offset, 2, "1", YELLOW)
-                stdscr.addstr(13 + help_offset, 2, "F1", YELLOW)
-                stdscr.addstr(14 + help_offset, 2, "!", YELLOW)
-                stdscr.addstr(7, 6, "- set new core clock offset")
-                stdscr.addstr(8, 6, "- set new mem clock offset")
-                stdscr.addstr(9, 6, "- set new power limit")
-                stdscr.addstr(10, 6, "- set manual fan percentage")
-                stdscr.addstr(10, 33, "(CAUTION: This sets your fan control policy to manual meaning it WON'T adapt to temperature!)", YELLOW)
-                stdscr.addstr(11, 6, "- set fan control back to auto")
-                stdscr.addstr(12 + help_offset, 6, "- load profile")
-                stdscr.addstr(12 + help_offset, 20, "(also 2, 3, 4)", YELLOW)
-                stdscr.addstr(13 + help_offset, 6, "- save profile")
-                stdscr.addstr(13 + help_offset, 20, "(also F2, F3, F4)", YELLOW)
-                stdscr.addstr(14 + help_offset, 6, "- delete profile")
-                stdscr.addstr(14 + help_offset, 22, "(also @, #, $ e.g. SHIFT + profile number)", YELLOW)
-                stdscr.addstr(16 + help_offset, 0, "Press a key to return to the monitor!")
+                screen.addstr(13 + help_offset, 2, "1", YELLOW)
+                screen.addstr(14 + help_offset, 2, "F1", YELLOW)
+                screen.addstr(15 + help_offset, 2, "!", YELLOW)
+                screen.addstr(8, 6, "- set new core clock offset")
+                screen.addstr(9, 6, "- set new mem clock offset")
+                screen.addstr(10, 6, "- set new power limit")
+                screen.addstr(11, 6, "- set manual fan percentage")
+                screen.addstr(11, 33, "(CAUTION: This sets your fan control policy to manual meaning it WON'T adapt to temperature!)", YELLOW)
+                screen.addstr(12, 6, "- set fan control back to auto")
+                screen.addstr(13 + help_offset, 6, "- load profile")
+                screen.addstr(13 + help_offset, 20, "(also 2, 3, 4)", YELLOW)
+                screen.addstr(14 + help_offset, 6, "- save profile")
+                screen.addstr(14 + help_offset, 20, "(also F2, F3, F4)", YELLOW)
+                screen.addstr(15 + help_offset, 6, "- delete profile")
+                screen.addstr(15 + help_offset, 22, "(also @, #, $ e.g. SHIFT + profile number)", YELLOW)
+                screen.addstr(17 + help_offset, 0, "Press a key to return to the monitor!")
             else:
-                stdscr.addstr(8, 0, "Press a key to return to the monitor!")
-            stdscr.refresh()
+                screen.addstr(9, 0, "Press a key to return to the monitor!")
+            screen.flush()
             stdscr.getch()
+            drawn_generation = -1
             stdscr.nodelay(True)
         elif key == ord("i"):
             key = ""
@@ -327,22 +3803,10 @@ def draw_dashboard(stdscr):
                 nvml_version = nv.nvmlSystemGetNVMLVersion()
             except nv.NVMLError:
                 nvml_version = "Unknown"
-            try:
-                max_gen = nv.nvmlDeviceGetMaxPcieLinkGeneration(gpu)
-                max_width = nv.nvmlDeviceGetMaxPcieLinkWidth(gpu)
-            except nv.NVMLError:
-                max_gen = "?"
-                max_width = "?"
-            try:
-                bar_size = nv.nvmlDeviceGetBAR1MemoryInfo(gpu)
-                bar_size = str((bar_size.bar1Total / 1024) / 1024) + " MB"
-            except nv.NVMLError:
-                bar_size = "Unknown"
-            try:
-                compute_version_major, compute_version_minor = nv.nvmlDeviceGetCudaComputeCapability(gpu)
-            except nv.NVMLError:
-                compute_version_major = "?"
-                compute_version_minor = "?"
+            max_gen = info.max_pcie_gen if info.max_pcie_gen is not None else "?"
+            max_width = info.max_pcie_width if info.max_pcie_width is not None else "?"
+            bar_size = f"{(info.bar1_total / 1024) / 1024} MB" if info.bar1_total is not None else "Unknown"
+            compute_version_major, compute_version_minor = info.compute_capability if info.compute_capability is not None else ("?", "?")
             try:
                 cuda_version = nv.nvmlSystemGetCudaDriverVersion_v2()
                 cuda_version_major = cuda_version // 1000
@@ -354,12 +3818,8 @@ def draw_dashboard(stdscr):
                 driver_version = nv.nvmlSystemGetDriverVersion()
             except nv.NVMLError:
                 driver_version = "Unknown"
-            try:
-                mem_bus_width = nv.nvmlDeviceGetMemoryBusWidth(gpu)
-            except nv.NVMLError:
-                mem_bus_width = "Unknown"
+            mem_bus_width = info.mem_bus_width if info.mem_bus_width is not None else "Unknown"
             while not key == ord("i"):
-                stdscr.clear()
                 try:
                     link_gen = nv.nvmlDeviceGetCurrPcieLinkGeneration(gpu)
                     link_width = nv.nvmlDeviceGetCurrPcieLinkWidth(gpu)
@@ -367,51 +3827,73 @@ def draw_dashboard(stdscr):
                     link_gen = "?"
                     link_width = "?"
                 try:
-                    compute_running_processes = nv.nvmlDeviceGetComputeRunningProcesses_v3(gpu)
-                    for process in compute_running_processes:
-                        setattr(process, "type", "Compute")
-                    graphics_running_processes = nv.nvmlDeviceGetGraphicsRunningProcesses_v3(gpu)
-                    for process in graphics_running_processes:
-                        setattr(process, "type", "Graphics")
-                    running_processes = graphics_running_processes + compute_running_processes
-                    running_processes = sorted(running_processes, key=lambda x: x.usedGpuMemory, reverse=True)
+                    running_processes = processes.refresh(args.gpu_number, gpu)
+                    if process_sort == "SM":
+                        running_processes.sort(key=lambda process: (process.sm_util or 0, process.vram), reverse=True)
+                    else:
+                        running_processes.sort(key=lambda process: process.vram, reverse=True)
                 except nv.NVMLError:
                     running_processes = "Unknown"
                 header()
-                stdscr.addstr(3, 0, "Extra info/Process Monitor:", BLUE)
-                stdscr.addstr(5, 2, "Device Name:", YELLOW)
-                stdscr.addstr(6, 2, "Driver/NVML Version:", YELLOW)
-                stdscr.addstr(7, 2, "Compute:", YELLOW)
-                stdscr.addstr(8, 2, "BAR1 Size:", YELLOW)
-                stdscr.addstr(9, 2, "PCI Express:", YELLOW)
-                stdscr.addstr(10, 2, "Memory bus:", YELLOW)
-                stdscr.addstr(11, 2, "Top Processes by VRAM:", YELLOW)
-                stdscr.addstr(5, 26, f"{gpu_name}", GREEN)
-                stdscr.addstr(6, 26, f"{driver_version} / {nvml_version}")
-                stdscr.addstr(7, 26, f"CC: {compute_version_major}.{compute_version_minor} | CUDA: {cuda_version_major}.{cuda_version_minor}")
-                stdscr.addstr(8, 26, f"{bar_size}")
-                stdscr.addstr(9, 26, f"Gen {link_gen}@{link_width}x / Gen {max_gen}@{max_width}x")
-                stdscr.addstr(10, 26, f"{mem_bus_width} bit")
+                screen.addstr(3, 0, "Extra info/Process Monitor:", BLUE)
+                screen.addstr(5, 2, "Device Name:", YELLOW)
+                screen.addstr(6, 2, "Driver/NVML Version:", YELLOW)
+                screen.addstr(7, 2, "Compute:", YELLOW)
+                screen.addstr(8, 2, "BAR1 Size:", YELLOW)
+                screen.addstr(9, 2, "PCI Express:", YELLOW)
+                screen.addstr(10, 2, "Memory bus:", YELLOW)
+                screen.addstr(11, 2, "Sampler:", YELLOW)
+                screen.addstr(12, 2, f"Processes by {process_sort}:", YELLOW)
+                screen.addstr(5, 26, f"{info.name}", GREEN)
+                screen.addstr(6, 26, f"{driver_version} / {nvml_version}")
+                screen.addstr(7, 26, f"CC: {compute_version_major}.{compute_version_minor} | CUDA: {cuda_version_major}.{cuda_version_minor}")
+                screen.addstr(8, 26, f"{bar_size}")
+                screen.addstr(9, 26, f"Gen {link_gen}@{link_width}x / Gen {max_gen}@{max_width}x")
+                screen.addstr(10, 26, f"{mem_bus_width} bit")
+                if sampler.latest is not None:
+                    batching = "batched" if _field_batch_supported.get(args.gpu_number) else "unbatched"
+                    frame_average = screen.total_bytes // max(1, screen.frames)
+                    cadence = f"every {sampler.current_interval * 1000:.0f} ms (adaptive) | " if sampler.adaptive is not None else ""
+                    skipped = capabilities.skipped(profile_key(info))
+                    skipping = f" | skipping {', '.join(skipped)}" if skipped else ""
+                    screen.addstr(11, 26, f"{cadence}{sampler.latest.nvml_calls} NVML calls/sample ({batching}) | ~{screen.last_frame_bytes} B/frame (avg ~{frame_average} B){skipping}")
                 if running_processes != "Unknown":
-                    list_length = min(5, len(running_processes))
-                    if list_length == 0:
-                        stdscr.addstr(13, 4, "0 -   None")
-                        stdscr.addstr(15, 0, "Press \"i\" key to return to the monitor or \"q\" to quit!")
+                    screen.addstr(12, 26, f"{len(running_processes)} running | \"s\" sorts by {'VRAM' if process_sort == 'SM' else 'SM'}, up/down scrolls", GRAY)
+                    max_y, max_x = stdscr.getmaxyx()
+                    list_length = max(1, min(len(running_processes), max_y - 17))  # Leave room for the footer
+                    process_scroll = max(0, min(process_scroll, len(running_processes) - list_length))
+                    if not running_processes:
+                        screen.addstr(14, 4, "0 -   None")
+                        screen.addstr(16, 0, "Press \"i\" key to return to the monitor or \"q\" to quit!")
                     else:
-                        for i in range(0, list_length):
-                            number_color = curses.color_pair(i + 1) if USE_COLOR else WHITE
-                            stdscr.addstr(13 + i, 4, f"{i + 1}", number_color)
-                            stdscr.addstr(13 + i, 5, f" -   {psutil.Process(running_processes[i].pid).name()} -- ({(running_processes[i].usedGpuMemory / (1024**2)):.2f} MB) ({running_processes[i].type}) ")
-                        stdscr.addstr(14 + list_length, 0, "Press \"i\" key to return to the monitor or \"q\" to quit!")
+                        for x, title in [(4, "#"), (9, "PID"), (18, "Name"), (36, "User"), (48, "VRAM"), (61, "SM"), (67, "Mem"), (73, "Type"), (83, "Command")]:
+                            screen.addstr(13, x, title, YELLOW)
+                        for row, i in enumerate(range(process_scroll, process_scroll + list_length)):
+                            process = running_processes[i]
+                            number_color = curses.color_pair(i % 7 + 1) if USE_COLOR else WHITE
+                            sm_util = f"{process.sm_util}%" if process.sm_util is not None else "?"
+                            mem_util = f"{process.mem_util}%" if process.mem_util is not None else "?"
+                            screen.addstr(14 + row, 4, f"{i + 1}", number_color)
+                            screen.addstr(14 + row, 9, f"{process.pid:<8} {process.name[:17]:<17} {process.user[:11]:<11} {process.vram / (1024**2):>9.2f} MB {sm_util:>4}  {mem_util:>4}  {process.type:<9} {process.cmdline[:max(0, max_x - 84)]}")
+                        if process_scroll + list_length < len(running_processes):
+                            screen.addstr(14 + list_length, 4, f"... {len(running_processes) - process_scroll - list_length} more", GRAY)
+                        screen.addstr(15 + list_length, 0, "Press \"i\" key to return to the monitor or \"q\" to quit!")
                 else:
-                    stdscr.addstr(13, 4, "Unable to retrieve running processes!")
-                    stdscr.addstr(15, 0, "Press \"i\" key to return to the monitor or \"q\" to quit!")
+                    screen.addstr(14, 4, "Unable to retrieve running processes!")
+                    screen.addstr(16, 0, "Press \"i\" key to return to the monitor or \"q\" to quit!")
                 stdscr.timeout(args.refresh_rate)
-                stdscr.refresh()
+                screen.flush()
                 key = stdscr.getch()
                 if key == ord("q"):
-                    nv.nvmlShutdown()
-                    sys.exit(1)
+                    shutdown()
+                elif key == ord("s"):
+                    process_sort = "VRAM" if process_sort == "SM" else "SM"
+                    process_scroll = 0
+                elif key == curses.KEY_DOWN:
+                    process_scroll += 1
+                elif key == curses.KEY_UP:
+                    process_scroll = max(0, process_scroll - 1)
+            drawn_generation = -1
         elif args.interactive and key in [curses.KEY_F1, curses.KEY_F2, curses.KEY_F3, curses.KEY_F4, curses.KEY_RIGHT, curses.KEY_LEFT, ord("1"), ord("2"), ord("3"), ord("4"), ord("!"), ord("@"), ord("#"), ord("$"), ord("c"), ord("m"), ord("p"), ord("f"), ord("a")]:
             current_profile = active_profile
             active_profile = 0
@@ -424,12 +3906,11 @@ def draw_dashboard(stdscr):
                     else:
                         args.gpu_number = 0
                     gpu = nv.nvmlDeviceGetHandleByIndex(args.gpu_number)
-                    gpu_name = nv.nvmlDeviceGetName(gpu)
-                    default_power_limit = nv.nvmlDeviceGetPowerManagementDefaultLimit(gpu) / 1000
-                    for i in range(1, 5):
-                        profile_exists[i] = False
-                        if os.path.exists(os.path.join(source_dir, f"profile{i}_{args.gpu_number}.bnt")):
-                            profile_exists[i] = True
+                    invalidate_device_info(args.gpu_number)
+                    info = get_device_info(args.gpu_number, gpu)
+                    sampler.set_gpu(args.gpu_number, gpu)
+                    sampler.wait_for_sample(timeout=1)
+                    refresh_profile_slots()
                     active_profile = last_active_profile[args.gpu_number]
                 except nv.NVMLError as e:
                     stdscr.addstr(input_start, 0, f"An NVMLError prevented the operation: {e}")
@@ -442,12 +3923,11 @@ def draw_dashboard(stdscr):
                     else:
                         args.gpu_number = num_gpus - 1
                     gpu = nv.nvmlDeviceGetHandleByIndex(args.gpu_number)
-                    gpu_name = nv.nvmlDeviceGetName(gpu)
-                    default_power_limit = nv.nvmlDeviceGetPowerManagementDefaultLimit(gpu) / 1000
-                    for i in range(1, 5):
-                        profile_exists[i] = False
-                        if os.path.exists(os.path.join(source_dir, f"profile{i}_{args.gpu_number}.bnt")):
-                            profile_exists[i] = True
+                    invalidate_device_info(args.gpu_number)
+                    info = get_device_info(args.gpu_number, gpu)
+                    sampler.set_gpu(args.gpu_number, gpu)
+                    sampler.wait_for_sample(timeout=1)
+                    refresh_profile_slots()
                     active_profile = last_active_profile[args.gpu_number]
                 except nv.NVMLError as e:
                     stdscr.addstr(input_start, 0, f"An NVMLError prevented the operation: {e}")
@@ -542,7 +4022,7 @@ def draw_dashboard(stdscr):
                     new_fan_speed = int(new_fan_speed)
                     stdscr.addstr(input_start + 1, 0, f"Setting fan speed to {new_fan_speed}%...")
                     if 101 > new_fan_speed > 29:
-                        num_fans = nv.nvmlDeviceGetNumFans(gpu)
+                        num_fans = info.num_fans
                         for i in range(0, num_fans):
                             nv.nvmlDeviceSetFanControlPolicy(gpu, i, nv.NVML_FAN_POLICY_MANUAL)
                             nv.nvmlDeviceSetFanSpeed_v2(gpu, i, new_fan_speed)
@@ -559,7 +4039,7 @@ def draw_dashboard(stdscr):
             elif key == ord("a"):
                 try:
                     stdscr.addstr(input_start, 0, "Setting fans to automatic control...")
-                    num_fans = nv.nvmlDeviceGetNumFans(gpu)
+                    num_fans = info.num_fans
                     for i in range(0, num_fans):
                         nv.nvmlDeviceSetFanControlPolicy(gpu, i, nv.NVML_FAN_POLICY_TEMPERATURE_CONTINOUS_SW)
                         nv.nvmlDeviceSetDefaultFanSpeed_v2(gpu, i)
@@ -567,8 +4047,11 @@ def draw_dashboard(stdscr):
                     stdscr.addstr(input_start + 1, 0, f"Failed to set fan speed: {str(e)}")
                     delay = 2
             stdscr.refresh()
+            sampler.poke()  # Pick up whatever we just changed without waiting for the next tick
             time.sleep(1 + delay)
             delay = 0
+            drawn_generation = -1
+            screen.invalidate()
             stdscr.nodelay(True)
             while key:  # Eat all the keys from the keyboard buffer to clear it for the next frame
                 key = stdscr.getch()
@@ -576,142 +4059,664 @@ def draw_dashboard(stdscr):
                     break
 
 
-# Execution begins here
-source_dir = os.path.dirname(os.path.abspath(__file__))
-args = parser.parse_args()
-try:
-    nv.nvmlInit()
-except nv.NVMLError as e:
-    print(f"Could not initialize NVML! The library reported: {e}")
-    sys.exit(8)
-USE_COLOR = not args.no_color and (os.getenv("TERM") != "dumb" and os.getenv("TERM") is not None)
-ANSI_WARN = "\033[0;33;40m" if USE_COLOR else ""
-ANSI_YELLOW = "\033[0;33m" if USE_COLOR else ""
-ANSI_MAGENTA = "\033[0;35m" if USE_COLOR else ""
-ANSI_GREEN = "\033[0;32m" if USE_COLOR else ""
-NC = "\033[0m" if USE_COLOR else ""
-try:
-    gpu = nv.nvmlDeviceGetHandleByIndex(args.gpu_number)
-except nv.NVMLError as e:
-    print(f"Could not initialize for GPU {args.gpu_number}! The library reported: {e}")
-    sys.exit(8)
-
-# If this check is true we run in offline mode, else we run in online mode
-if args.set_clocks or args.set_power_limit or args.set_max_fan or args.set_auto_fan or args.set_custom_fan or args.set_profile:
-    print(f"{ANSI_MAGENTA}Blissful Nvidia Tool Offline Mode{NC}")
-    print("_________________________________________")
-    print(f"{ANSI_YELLOW}User accepts ALL risks of overclocking/altering power limits/fan settings!{NC}")
-    print("Additionally, root permission is needed for these changes and they will fail to apply without it.")
-    print()
-    print("Enabling persistence...")
+def run_offline(index, gpu, log=print):
+    """
+    Carries out the offline mode operations from the command line on one GPU. Takes in the GPU index and handle and
+    a print-like function to report progress with. Returns how many operations failed
+    """
+    failures = 0
+    log("Enabling persistence...")
     try:
         nv.nvmlDeviceSetPersistenceMode(gpu, 1)
     except nv.NVMLError as e:
-        print(f"{ANSI_WARN}Some kind of NVML error prevented applying the requested change: {e}{NC}")
-    print()
+        log(f"{ANSI_WARN}Some kind of NVML error prevented applying the requested change: {e}{NC}")
+    log()
+    try:
+        info = get_device_info(index, gpu)
+    except nv.NVMLError as e:
+        failures += 1
+        log(f"{ANSI_WARN}Could not read the details of GPU {index}! The library reported: {e}{NC}")
+        return failures
     if args.set_max_fan:
-        num_fans = nv.nvmlDeviceGetNumFans(gpu)
-        print(f"Found {num_fans} fans!")
-        print("Attempting to set fans to max speed...")
+        num_fans = info.num_fans
+        log(f"Found {num_fans} fans!")
+        log("Attempting to set fans to max speed...")
         for i in range(0, num_fans):
             try:
-                nv.nvmlDeviceSetFanControlPolicy(gpu, i, nv.NVML_FAN_POLICY_MANUAL)
-                nv.nvmlDeviceSetFanSpeed_v2(gpu, i, 100)
-                print(f"{ANSI_GREEN}Fan {i} set to max speed!{NC}")
+                set_fan(gpu, i, 100)
+                log(f"{ANSI_GREEN}Fan {i} set to max speed!{NC}")
             except nv.NVMLError as e:
-                print(f"{ANSI_WARN}Some kind of NVML error prevented applying the requested change: {e}{NC}")
-        print()
+                failures += 1
+                log(f"{ANSI_WARN}Some kind of NVML error prevented applying the requested change: {e}{NC}")
+        log()
     elif args.set_auto_fan:
-        num_fans = nv.nvmlDeviceGetNumFans(gpu)
-        print(f"Found {num_fans} fans!")
-        print("Attempting to restore fans to automatic control...")
+        num_fans = info.num_fans
+        log(f"Found {num_fans} fans!")
+        log("Attempting to restore fans to automatic control...")
         for i in range(0, num_fans):
             try:
-                nv.nvmlDeviceSetFanControlPolicy(gpu, i, nv.NVML_FAN_POLICY_TEMPERATURE_CONTINOUS_SW)
-                nv.nvmlDeviceSetDefaultFanSpeed_v2(gpu, i)
-                print(f"{ANSI_GREEN}Fan {i} restored to automatic control!{NC}")
+                set_fan(gpu, i, None)
+                log(f"{ANSI_GREEN}Fan {i} restored to automatic control!{NC}")
             except nv.NVMLError as e:
-                print(f"{ANSI_WARN}Some kind of NVML error prevented applying the requested change: {e}{NC}")
-        print()
+                failures += 1
+                log(f"{ANSI_WARN}Some kind of NVML error prevented applying the requested change: {e}{NC}")
+        log()
     elif args.set_custom_fan:
         new_speed = args.set_custom_fan
         if 101 > new_speed > 29:
-            num_fans = nv.nvmlDeviceGetNumFans(gpu)
-            print(f"Found {num_fans} fans!")
-            print(f"Attempting to set fans to {new_speed}%...")
+            num_fans = info.num_fans
+            log(f"Found {num_fans} fans!")
+            log(f"Attempting to set fans to {new_speed}%...")
             for i in range(0, num_fans):
                 try:
-                    nv.nvmlDeviceSetFanControlPolicy(gpu, i, nv.NVML_FAN_POLICY_MANUAL)
-                    nv.nvmlDeviceSetFanSpeed_v2(gpu, i, new_speed)
-                    print(f"{ANSI_GREEN}Fan {i} set to {new_speed}%! {ANSI_YELLOW}Fan control policy is now MANUAL!{NC}")
+                    set_fan(gpu, i, new_speed)
+                    log(f"{ANSI_GREEN}Fan {i} set to {new_speed}%! {ANSI_YELLOW}Fan control policy is now MANUAL!{NC}")
                 except nv.NVMLError as e:
-                    print(f"{ANSI_WARN}Some kind of NVML error prevented applying the requested change: {e}{NC}")
-            print()
+                    failures += 1
+                    log(f"{ANSI_WARN}Some kind of NVML error prevented applying the requested change: {e}{NC}")
+            log()
         elif new_speed > 100:
-            print(f"{ANSI_WARN}Value {new_speed} invalid for fan control!{NC}")
+            failures += 1
+            log(f"{ANSI_WARN}Value {new_speed} invalid for fan control!{NC}")
         else:
-            print(f"{ANSI_WARN}Refusing to set fans below 30%! Sorry!{NC}")
-            print()
+            failures += 1
+            log(f"{ANSI_WARN}Refusing to set fans below 30%! Sorry!{NC}")
+            log()
     if args.set_clocks:
         core_offset, mem_offset = args.set_clocks
-        print(f"Attempting to set core clock offset to {core_offset} MHz and memory clock offset to {mem_offset} MHz...")
+        log(f"Attempting to set core clock offset to {core_offset} MHz and memory clock offset to {mem_offset} MHz...")
         try:
-            nv.nvmlDeviceSetGpcClkVfOffset(gpu, core_offset)
-            nv.nvmlDeviceSetMemClkVfOffset(gpu, mem_offset * 2)  # Multiply memoffset by 2 so it's equivalent to offset in GWE and Windows
-            print(f"{ANSI_GREEN}Set core clock offset to {core_offset} MHz and memory clock offset to {mem_offset} MHz!{NC}")
+            set_clock_offsets(gpu, core_offset, mem_offset)
+            log(f"{ANSI_GREEN}Set core clock offset to {core_offset} MHz and memory clock offset to {mem_offset} MHz!{NC}")
         except nv.NVMLError as e:
-            print(f"{ANSI_WARN}Some kind of NVML error prevented applying the requested change: {e}{NC}")
-        print()
+            failures += 1
+            log(f"{ANSI_WARN}Some kind of NVML error prevented applying the requested change: {e}{NC}")
+        log()
     if args.set_power_limit:
-        print(f"Attempting to set power limit to {args.set_power_limit} W...")
+        log(f"Attempting to set power limit to {args.set_power_limit} W...")
         try:
-            nv.nvmlDeviceSetPowerManagementLimit(gpu, args.set_power_limit * 1000)
-            print(f"{ANSI_GREEN}Power limit set to {args.set_power_limit} W!{NC}")
+            set_power_limit(gpu, args.set_power_limit)
+            log(f"{ANSI_GREEN}Power limit set to {args.set_power_limit} W!{NC}")
         except nv.NVMLError as e:
-            print(f"{ANSI_WARN}Some kind of NVML error prevented applying the requested change: {e}{NC}")
-        print()
+            failures += 1
+            log(f"{ANSI_WARN}Some kind of NVML error prevented applying the requested change: {e}{NC}")
+            if info.min_power_limit is not None:
+                log(f"{ANSI_WARN}GPU {index} accepts power limits from {info.min_power_limit:.0f} W to {info.max_power_limit:.0f} W.{NC}")
+        log()
     if args.set_profile:
         profile_number = args.set_profile
-        print(f"Loading profile {profile_number} for GPU {args.gpu_number}!")
+        log(f"Loading profile {profile_number} for GPU {index}!")
         try:
-            with open(os.path.join(source_dir, f"profile{profile_number}_{args.gpu_number}.bnt"), "r", encoding="utf-8") as file:
-                new_core_offset = int(file.readline())
-                new_mem_offset = int(file.readline())
-                new_power_limit = int(file.readline())
-                new_fan_policy = int(file.readline())
-                new_fan_speed = int(file.readline())
-                print(f"Setting core clock offset to {add_sign(new_core_offset)} Mhz...")
-                nv.nvmlDeviceSetGpcClkVfOffset(gpu, new_core_offset)
-                print(f"Setting mem clock offset to {add_sign(new_mem_offset)} Mhz...")
-                nv.nvmlDeviceSetMemClkVfOffset(gpu, new_mem_offset * 2)
-                print(f"Setting core power limit to {new_power_limit}...")
-                nv.nvmlDeviceSetPowerManagementLimit(gpu, new_power_limit * 1000)
-                if new_fan_policy == 1:
-                    if 101 > new_fan_speed > 29:
-                        print(f"Setting fan policy to manual and fan speed to {new_fan_speed}%...")
-                        num_fans = nv.nvmlDeviceGetNumFans(gpu)
-                        for i in range(0, num_fans):
-                            nv.nvmlDeviceSetFanControlPolicy(gpu, i, nv.NVML_FAN_POLICY_MANUAL)
-                            nv.nvmlDeviceSetFanSpeed_v2(gpu, i, new_fan_speed)
-                    else:
-                        raise ValueError("Invalid fan speed setting in profile!")
-                else:
-                    print("Setting fan policy to automatic control...")
-                    num_fans = nv.nvmlDeviceGetNumFans(gpu)
-                    for i in range(0, num_fans):
-                        nv.nvmlDeviceSetFanControlPolicy(gpu, i, nv.NVML_FAN_POLICY_TEMPERATURE_CONTINOUS_SW)
-                        nv.nvmlDeviceSetDefaultFanSpeed_v2(gpu, i)
-            print(f"{ANSI_GREEN}Profile {profile_number} successfully applied!{NC}")
+            profile = check_profile(profiles.get(profile_key(info), profile_number))
+            log(f"Setting core clock offset to {add_sign(profile.core_offset)} Mhz...")
+            log(f"Setting mem clock offset to {add_sign(profile.mem_offset)} Mhz...")
+            log(f"Setting core power limit to {profile.power_limit}...")
+            if profile.fan_policy == 1:
+                log(f"Setting fan policy to manual and fan speed to {profile.fan_speed}%...")
+            else:
+                log("Setting fan policy to automatic control...")
+            changed = apply_profile(gpu, info.num_fans, profile)
+            log(f"{ANSI_GREEN}Profile {profile_number} successfully applied! {changed} setting(s) needed changing.{NC}")
         except ValueError as e:
-            print(f"{ANSI_WARN}Some kind of value error prevented the profile loading: {e}{NC}")
+            failures += 1
+            log(f"{ANSI_WARN}Some kind of value error prevented the profile loading: {e}{NC}")
         except nv.NVMLError as e:
-            print(f"{ANSI_WARN}Some kind of NVML error prevented the profile loading: {e}{NC}")
-        except FileNotFoundError:
-            print("{ANSI_WARN}Profile was not found!{NC}")
+            failures += 1
+            log(f"{ANSI_WARN}Some kind of NVML error prevented the profile loading: {e}. The previous settings were restored.{NC}")
+        except KeyError:
+            failures += 1
+            log(f"{ANSI_WARN}Profile {profile_number} was not found for GPU {index}!{NC}")
+        log()
+    if args.save_profile:
+        log(f"Saving the current settings of GPU {index} as profile {args.save_profile}...")
+        try:
+            profiles.save(profile_key(info), args.save_profile, profile_from_sample(read_sample(index, gpu)))
+            log(f"{ANSI_GREEN}Profile {args.save_profile} saved!{NC}")
+        except (OSError, ValueError, nv.NVMLError) as e:
+            failures += 1
+            log(f"{ANSI_WARN}Couldn't save the profile: {e}{NC}")
+        log()
+    if args.delete_profile:
+        if profiles.delete(profile_key(info), args.delete_profile):
+            log(f"{ANSI_GREEN}Deleted profile {args.delete_profile} for GPU {index}!{NC}")
+        else:
+            failures += 1
+            log(f"{ANSI_WARN}Profile {args.delete_profile} was not found for GPU {index}!{NC}")
+        log()
+    if args.status:
+        try:
+            log(json.dumps(read_sample(index, gpu)._asdict()))
+        except nv.NVMLError as e:
+            failures += 1
+            log(f"{ANSI_WARN}Could not read the state of GPU {index}! The library reported: {e}{NC}")
+    return failures
+
+
+def run_offline_parallel(gpus):
+    """
+    Runs the offline mode operations on several GPUs at once, one thread per GPU, then prints what happened on each
+    followed by a summary with timings. Takes in a list of (index, handle) tuples, returns how many operations failed
+    """
+    def run_one(index, gpu):
+        lines = []
+        started = time.perf_counter()
+        failures = run_offline(index, gpu, lambda *parts: lines.append(" ".join(str(part) for part in parts)))
+        return lines, failures, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(gpus), thread_name_prefix="bnt-offline") as pool:
+        results = list(pool.map(lambda device: run_one(*device), gpus))
+    elapsed = time.perf_counter() - started
+    for (index, _), (lines, _, _) in zip(gpus, results):
+        print(f"{ANSI_MAGENTA}GPU {index}:{NC}")
+        for line in lines:
+            print(line)
+    print("Summary:")
+    for (index, _), (_, failures, seconds) in zip(gpus, results):
+        if failures:
+            print(f"{ANSI_WARN}GPU {index}: {failures} operation(s) FAILED in {seconds * 1000:.1f} ms{NC}")
+        else:
+            print(f"{ANSI_GREEN}GPU {index}: OK in {seconds * 1000:.1f} ms{NC}")
+    print(f"{len(gpus)} GPUs took {elapsed * 1000:.1f} ms, the slowest {max(seconds for _, _, seconds in results) * 1000:.1f} ms")
+    return sum(failures for _, failures, _ in results)
+
+
+def pareto_frontier(points):
+    """
+    Returns the points no other point beats on both throughput and power, ordered by power. Points are dicts with
+    "throughput" and "power" keys
+    """
+    frontier = []
+    for point in sorted(points, key=lambda point: (point["power"], -point["throughput"])):
+        if not frontier or point["throughput"] > frontier[-1]["throughput"]:
+            frontier.append(point)
+    return frontier
+
+
+def measure_workload(index, gpu, command, metric):
+    """
+    Runs the workload command once while sampling the GPU, returns (throughput, average power in W, seconds).
+    Throughput is the first group of the metric regex in the command's output, or runs per second without one.
+    Raises RuntimeError if the workload fails or the metric can't be found
+    """
+    power_readings = []
+    sampler = Sampler(index, gpu, 0.1)
+    sampler.listeners.append(lambda _, sample: power_readings.append(sample.power_usage))
+    sampler.start()
+    started = time.monotonic()
+    try:
+        result = subprocess.run(command, shell=True, capture_output=True, text=True, check=False)
+    finally:
+        elapsed = time.monotonic() - started
+        sampler.stop()
+    if result.returncode != 0:
+        raise RuntimeError(f"the workload exited with {result.returncode}")
+    if not power_readings:
+        raise RuntimeError("no power readings were taken during the workload")
+    if metric:
+        match = re.search(metric, result.stdout + result.stderr)
+        if match is None:
+            raise RuntimeError(f"the workload output didn't match {metric!r}")
+        throughput = float(match.group(1) if match.groups() else match.group(0))
+    else:
+        throughput = 1 / elapsed
+    return throughput, sum(power_readings) / len(power_readings), elapsed
+
+
+def run_tuning(index, gpu):
+    """
+    Sweeps a grid of clock offsets and power limits on one GPU, running the --tune workload at every point, and prints
+    the perf-per-watt frontier. The GPU's own clock offsets and power limit are put back afterward no matter what.
+    Returns the exit code
+    """
+    info = get_device_info(index, gpu)
+    try:
+        original = read_sample(index, gpu)
+        #  The raw values, so the GPU is put back exactly rather than to the nearest whole MHz and watt
+        original_core_offset, original_mem_offset = read_clock_offsets(gpu)
+        original_power_limit = nv.nvmlDeviceGetPowerManagementLimit(gpu)  # mW
+    except nv.NVMLError as e:
+        print(f"{ANSI_WARN}Could not read the current settings of GPU {index}! The library reported: {e}{NC}")
+        return 1
+    core_offsets = args.tune_core_offsets or [int(original.core_offset)]
+    mem_offsets = args.tune_mem_offsets or [int(original.mem_offset)]
+    power_limits = args.tune_power_limits or [int(original.power_limit)]
+    grid = [(core, mem, power) for core in core_offsets for mem in mem_offsets for power in power_limits]
+    print(f"{ANSI_MAGENTA}Blissful Nvidia Tool Tuning Mode{NC}")
+    print(f"{ANSI_YELLOW}User accepts ALL risks of overclocking/altering power limits! Unstable settings may crash the workload or worse.{NC}")
+    print(f"Sweeping {len(grid)} point(s) on GPU {index} - {info.name}, running {args.tune!r} {args.tune_runs} time(s) at each.")
+    print()
+    points = []
+    try:
+        for core, mem, power in grid:
+            point = {"core_offset": core, "mem_offset": mem, "power_limit": power}
+            try:
+                set_clock_offsets(gpu, core, mem)
+                set_power_limit(gpu, power)
+                runs = [measure_workload(index, gpu, args.tune, args.tune_metric) for _ in range(args.tune_runs)]
+            except (nv.NVMLError, RuntimeError) as e:
+                point["error"] = str(e)
+                print(f"{ANSI_WARN}{add_sign(core)} MHz core, {add_sign(mem)} MHz mem, {power} W: {e}{NC}")
+                points.append(point)
+                continue
+            point["throughput"] = statistics.median(throughput for throughput, _, _ in runs)
+            point["power"] = statistics.median(power_used for _, power_used, _ in runs)
+            point["seconds"] = statistics.median(seconds for _, _, seconds in runs)
+            point["per_watt"] = point["throughput"] / point["power"]
+            points.append(point)
+            print(f"{add_sign(core)} MHz core, {add_sign(mem)} MHz mem, {power} W: {point['throughput']:.4g} at {point['power']:.1f} W = {point['per_watt']:.4g}/W")
+    except KeyboardInterrupt:
+        print(f"{ANSI_WARN}Interrupted, reporting what we have.{NC}")
+    finally:
+        try:
+            nv.nvmlDeviceSetGpcClkVfOffset(gpu, original_core_offset)
+            nv.nvmlDeviceSetMemClkVfOffset(gpu, round(original_mem_offset * 2))
+            nv.nvmlDeviceSetPowerManagementLimit(gpu, original_power_limit)
+            print(f"{ANSI_GREEN}Restored the original clock offsets and power limit.{NC}")
+        except nv.NVMLError as e:
+            print(f"{ANSI_WARN}Could not restore the original settings! The library reported: {e}{NC}")
+    measured = [point for point in points if "error" not in point]
+    frontier = pareto_frontier(measured)
+    best = max(measured, key=lambda point: point["per_watt"]) if measured else None
+    print()
+    if best is None:
+        print(f"{ANSI_WARN}No point finished successfully!{NC}")
+    else:
+        print("Perf-per-watt frontier:")
+        for point in frontier:
+            marker = f" {ANSI_GREEN}<- best perf/W{NC}" if point is best else ""
+            print(f"  {add_sign(point['core_offset'])} MHz core, {add_sign(point['mem_offset'])} MHz mem, {point['power_limit']} W: "
+                  f"{point['throughput']:.4g} at {point['power']:.1f} W = {point['per_watt']:.4g}/W{marker}")
+        if args.tune_save_profile:
+            profile = Profile(best["core_offset"], best["mem_offset"], best["power_limit"], original.fan_policy, original.fan_speed)
+            try:
+                profiles.save(profile_key(info), args.tune_save_profile, profile)
+                print(f"{ANSI_GREEN}Saved the best point as profile {args.tune_save_profile}!{NC}")
+            except (OSError, ValueError) as e:
+                print(f"{ANSI_WARN}Couldn't save the profile: {e}{NC}")
+    if args.tune_output:
+        with open(args.tune_output, "w", encoding="utf-8") as file:
+            json.dump({"gpu": index, "command": args.tune, "points": points, "frontier": frontier, "best": best}, file, indent=2)
+            file.write("\n")
+    return 0 if best is not None else 1
+
+
+#  Fields --stream can print, in order. Every record also has the timestamp, monotonic clock and GPU index
+STREAM_FIELDS = ["core_offset", "mem_offset", "core_clock", "core_clock_percent", "mem_clock", "mem_clock_percent", "temperature",
+                 "fan_speed", "fan_policy", "power_usage", "power_limit", "power_percent", "power_offset", "mem_used", "mem_total",
+                 "vram_percent", "gpu_util", "mem_util", "clock_reasons", "energy"]
+
+
+def read_record(index, gpu, fields):
+    """
+    Reads the given STREAM_FIELDS of a GPU and returns them as a dict, making only the NVML queries those fields need.
+    Readings the GPU doesn't support are None and clock_reasons is a list of CLOCK_REASONS names.
+    Takes in the GPU index and handle and a list of field names
+    """
+    wanted = set(fields)
+    record = {"timestamp": time.time(), "monotonic": time.monotonic(), "gpu": index}
+    info = get_device_info(index, gpu)
+    key = profile_key(info)
+    values = {}
+    if wanted & {"core_offset", "mem_offset"}:
+        values["core_offset"], values["mem_offset"] = capabilities.call(key, "clock_offsets", read_clock_offsets, gpu, default=(None, None))
+    if wanted & {"core_clock", "core_clock_percent"}:
+        values["core_clock"] = nv.nvmlDeviceGetClockInfo(gpu, nv.NVML_CLOCK_GRAPHICS)
+        values["core_clock_percent"] = round(values["core_clock"] / info.max_core_clock * 100, 1)
+    if wanted & {"mem_clock", "mem_clock_percent"}:
+        values["mem_clock"] = nv.nvmlDeviceGetClockInfo(gpu, nv.NVML_CLOCK_MEM)
+        values["mem_clock_percent"] = round(values["mem_clock"] / info.max_mem_clock * 100, 1)
+    if "temperature" in wanted:
+        values["temperature"] = nv.nvmlDeviceGetTemperature(gpu, 0)
+    if "fan_speed" in wanted:
+        values["fan_speed"] = capabilities.call(key, "fan_speed", nv.nvmlDeviceGetFanSpeed, gpu)
+    if "fan_policy" in wanted:
+        values["fan_policy"] = capabilities.call(key, "fan_policy", read_fan_policy, gpu, 0)
+    if wanted & {"power_usage", "power_limit", "power_percent", "power_offset"}:
+        batched = read_batched_fields(index, gpu)
+        usage = (batched["power_usage"] if "power_usage" in batched else nv.nvmlDeviceGetPowerUsage(gpu)) / 1000
+        limit = (batched["power_limit"] if "power_limit" in batched else nv.nvmlDeviceGetPowerManagementLimit(gpu)) / 1000
+        values.update(power_usage=usage, power_limit=limit, power_percent=round(usage / limit * 100, 1),
+                      power_offset=limit - info.default_power_limit)
+    if wanted & {"mem_used", "mem_total", "vram_percent"}:
+        mem_info = nv.nvmlDeviceGetMemoryInfo(gpu)
+        values.update(mem_used=mem_info.used, mem_total=mem_info.total, vram_percent=round(mem_info.used / mem_info.total * 100, 1))
+    if wanted & {"gpu_util", "mem_util"}:
+        utilization = nv.nvmlDeviceGetUtilizationRates(gpu)
+        values.update(gpu_util=utilization.gpu, mem_util=utilization.memory)
+    if "clock_reasons" in wanted:
+        mask = capabilities.call(key, "clock_reasons", read_clock_reasons, gpu)
+        values["clock_reasons"] = None if mask is None else active_clock_reasons(mask)
+    if "energy" in wanted:
+        energy = capabilities.call(key, "energy", nv.nvmlDeviceGetTotalEnergyConsumption, gpu)
+        values["energy"] = None if energy is None else energy / 1000  # Joules since the driver loaded
+    record.update((field, values[field]) for field in fields)
+    return record
+
+
+def run_stream(gpus):
+    """
+    Streams a record per sample for each of the (index, handle) tuples in gpus as JSON lines or CSV until interrupted
+    or --stream-count is reached. Output is line buffered so whatever reads it sees every record right away.
+    Returns the exit code
+    """
+    if args.sample_buffers:
+        #  Every record is a single reading taken right then, there's no interval between samples to drain buffers over
+        print(f"{ANSI_WARN}--sample-buffers doesn't work with --stream!{NC}", file=sys.stderr)
+        return 2
+    fields = STREAM_FIELDS
+    if args.stream_fields:
+        fields = [field.strip() for field in args.stream_fields.split(",") if field.strip()]
+        unknown = [field for field in fields if field not in STREAM_FIELDS]
+        if unknown or not fields:
+            print(f"{ANSI_WARN}Unknown --stream-fields {', '.join(unknown)}! Pick from {', '.join(STREAM_FIELDS)}{NC}", file=sys.stderr)
+            return 2
+    try:
+        out = open(args.stream_output, "a", encoding="utf-8", buffering=1, newline="") if args.stream_output else sys.stdout
+    except OSError as e:
+        print(f"{ANSI_WARN}Could not open {args.stream_output}! {e}{NC}", file=sys.stderr)
+        return 8
+    if out is sys.stdout:
+        sys.stdout.reconfigure(line_buffering=True)
+    writer = None
+    if args.stream == "csv":
+        writer = csv.writer(out, lineterminator="\n")
+        if out is sys.stdout or out.tell() == 0:  # Don't repeat the header when appending to a file
+            writer.writerow(["timestamp", "monotonic", "gpu"] + fields)
+    interval = args.refresh_rate / 1000
+    next_deadline = time.monotonic()
+    count = 0
+    try:
+        while args.stream_count is None or count < args.stream_count:
+            for index, handle in gpus:
+                try:
+                    record = read_record(index, handle, fields)
+                except nv.NVMLError as e:
+                    if writer is None:
+                        out.write(json.dumps({"timestamp": time.time(), "monotonic": time.monotonic(), "gpu": index, "error": str(e)}) + "\n")
+                    else:
+                        print(f"GPU {index}: {e}", file=sys.stderr)
+                    continue
+                if writer is None:
+                    out.write(json.dumps(record) + "\n")
+                else:
+                    writer.writerow(["" if value is None else "|".join(value) if isinstance(value, list) else value for value in record.values()])
+            count += 1
+            #  Same fixed cadence as the sampler, ticks we fell behind on are skipped rather than made up
+            next_deadline = max(next_deadline + interval, time.monotonic())
+            time.sleep(max(0, next_deadline - time.monotonic()))
+    except KeyboardInterrupt:
+        pass
+    except BrokenPipeError:
+        #  Whatever we were piped into stopped reading, like head. Point stdout somewhere harmless so the
+        #  interpreter doesn't complain again when it flushes on exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+def print_power_limits(limits, usage):
+    """
+    Governor listener for headless mode, prints the new split of the power budget
+    """
+    split = ", ".join(f"GPU {index}: {limit:.0f} W ({usage[index]:.0f} W used)" for index, limit in limits.items())
+    print(f"{time.strftime('%H:%M:%S')} {split}")
+
+
+def print_event(event):
+    """
+    Event watcher listener for headless mode, prints the event as it comes in
+    """
+    color = ANSI_WARN if event.kind == "xid" else ""
+    print(f"{time.strftime('%H:%M:%S', time.localtime(event.timestamp))} {color}GPU {event.index}: {describe_event(event)}{NC if color else ''}", flush=True)
+
+
+def print_clock_reasons(last_reasons, index, sample):
+    """
+    Overview sampler listener for headless mode, prints why the clocks are held back whenever that changes. Idle comes
+    and goes with every workload so it only shows up in the summary. Takes in {index: names last printed} to update
+    """
+    names = [name for name in active_clock_reasons(sample.clock_reasons) if name != "idle"]
+    if names == last_reasons.get(index, []):
+        return
+    last_reasons[index] = names
+    labels = ", ".join(label for name, label, _ in CLOCK_REASONS if name in names)
+    color = ANSI_WARN if set(names) - {"power_cap", "sync_boost"} else ANSI_YELLOW if names else ""
+    text = f"Clocks limited by {labels}" if names else "Clocks no longer limited"
+    print(f"{time.strftime('%H:%M:%S', time.localtime(sample.timestamp))} {color}GPU {index}: {text}{NC if color else ''}", flush=True)
+
+
+def fold_buffer_stats(buffer_totals, seen, index, stats):
+    """
+    Overview sampler listener for headless mode with --sample-buffers, folds the driver's own samples into
+    {index: {Sample field: BufferStats}} for the whole session. The overview keeps the last BufferStats of a buffer
+    that had nothing new, so ones already folded in, tracked in {(index, Sample field): BufferStats}, are skipped
+    """
+    totals = buffer_totals.setdefault(index, {})
+    for field, new in stats.items():
+        if seen.get((index, field)) is new or not new.count:
+            continue
+        seen[(index, field)] = new
+        old = totals.get(field)
+        if old is None:
+            totals[field] = new
+        else:
+            count = old.count + new.count
+            totals[field] = BufferStats(count, min(old.min, new.min), (old.avg * old.count + new.avg * new.count) / count,
+                                        max(old.max, new.max), max(old.p99, new.p99))
+
+
+def print_buffer_summary(buffer_totals):
+    """
+    Prints what the driver's own samples saw over the whole session. Takes in {index: {Sample field: BufferStats}}
+    """
+    for index, totals in sorted(buffer_totals.items()):
+        if not totals:
+            continue
+        print(f"{ANSI_MAGENTA}Driver samples for GPU {index}:{NC}")
+        for metric, label, unit, _, _ in STAT_METRICS:
+            stats = totals.get(metric)
+            if stats is not None:
+                print(f"  {label + ':':<16}min {stats.min:8.1f}  mean {stats.avg:8.1f}  max {stats.max:8.1f}  "
+                      f"worst p99 {stats.p99:8.1f} {unit:<4}| {stats.count} samples")
+
+
+def run_headless():
+    """
+    Runs the fan curve controllers and the power governor without the monitor until interrupted, then hands the fans
+    and power limits back the way they were. Clock, power source and Xid events and the reasons the clocks are held
+    back are logged while it runs, with a summary of the time spent in each reason and the energy used at the end
+    """
+    print(f"{ANSI_MAGENTA}Blissful Nvidia Tool Headless Mode{NC}")
+    sessions = {}
+    last_reasons = {}
+    buffer_totals = {}
+    overview = OverviewSampler(gpus, args.refresh_rate / 1000, make_adaptive(), make_buffers())
+    overview.listeners.append(lambda index, sample: sessions.setdefault(index, SessionStats(args.stats_window)).record(sample, get_device_info(index, dict(gpus)[index])))
+    overview.listeners.append(lambda index, sample: print_clock_reasons(last_reasons, index, sample))
+    if overview.buffers is not None:
+        seen = {}
+        overview.listeners.append(lambda index, sample: fold_buffer_stats(buffer_totals, seen, index, overview.stats.get(index, {})))
+    overview.start()
+    print(f"Logging clock reasons of GPU(s) {', '.join(str(index) for index, _ in gpus)}.")
+    if overview.buffers is not None:
+        print("Draining the driver's sample buffers, their min/mean/max/p99 are in the summary.")
+    events = None
+    if not args.no_events:
+        events = EventWatcher(gpus)
+        events.listeners.append(print_event)
+        events.start()
+        print(f"Logging events of GPU(s) {', '.join(str(index) for index, _ in gpus)}.")
+    if fan_controllers:
+        curve = ", ".join(f"{temp}°C: {speed}%" for temp, speed in args.fan_curve)
+        print(f"Running the fan curve {curve} on GPU(s) {', '.join(str(index) for index in fan_controllers)}.")
+    if governor is not None:
+        print(f"Sharing a power budget of {governor.budget:.0f} W between GPU(s) {', '.join(str(index) for index, _ in governor.gpus)}.")
+        governor.listeners.append(print_power_limits)
+    print("Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(1)
+            if events is not None and events.error is not None and not events.is_alive():
+                print(f"{ANSI_WARN}Can't watch for events: {events.error}{NC}")
+                events = None
+    except KeyboardInterrupt:
+        pass
+    finally:
+        overview.stop()
+        if events is not None:
+            events.stop()
+        for controller in fan_controllers.values():
+            controller.stop()
+        if governor is not None:
+            governor.stop()
+        print_session_summary(sessions)
+        print_buffer_summary(buffer_totals)
+
+
+# Execution begins here
+args = parser.parse_args()
+gpu_numbers = args.gpu_number  # None means all of them, resolved once we know how many there are
+args.gpu_number = gpu_numbers[0] if gpu_numbers else 0  # The monitor shows the first one selected
+profile_dir = args.profile_dir or os.path.dirname(os.path.abspath(__file__))
+profiles = ProfileStore(os.path.join(profile_dir, "profiles.json"))
+capabilities = CapabilityMap(os.path.join(profile_dir, "capabilities.json") if args.cache_capabilities else None)
+if args.benchmark:
+    run_benchmark(args.benchmark_gpus, args.benchmark_refresh_rates, args.benchmark_duration, args.benchmark_runs, args.simulate_latency, args.benchmark_output)
+    sys.exit(0)
+if args.simulate:
+    nv = SimulatedNvml(args.simulate, args.simulate_latency / 1000, args.simulate_error_rate, filter(None, args.simulate_unsupported.split(",")))
+nv = CountingNvml(nv)
+USE_COLOR = not args.no_color and (os.getenv("TERM") != "dumb" and os.getenv("TERM") is not None)
+ANSI_WARN = "\033[0;33;40m" if USE_COLOR else ""
+ANSI_YELLOW = "\033[0;33m" if USE_COLOR else ""
+ANSI_MAGENTA = "\033[0;35m" if USE_COLOR else ""
+ANSI_GREEN = "\033[0;32m" if USE_COLOR else ""
+NC = "\033[0m" if USE_COLOR else ""
+recording = None
+recorder = None
+fan_controllers = {}
+governor = None
+session_stats = {}  # {index: SessionStats} the monitor keeps, summarized on exit
+if args.replay:
+    #  Replay mode, everything comes from the recording so we never touch the driver
+    import curses
+    try:
+        recording = Recording(args.replay)
+    except (OSError, ValueError) as e:
+        print(f"Could not open recording! {e}")
+        sys.exit(8)
+    if len(recording) == 0:
+        print(f"Recording {args.replay} doesn't contain any samples!")
+        sys.exit(8)
+    for recorded_info in recording.devices:
+        _device_info_cache[recorded_info.index] = recorded_info
+    args.interactive = False
+    gpu = None
+    try:
+        curses.wrapper(draw_dashboard)
+    finally:
+        if not args.benchmark_stats:
+            print_session_summary(session_stats)
+    sys.exit(0)
+if args.socket and not args.daemon:
+    #  Thin client mode, the daemon already has everything set up so we never touch the driver here
+    sys.exit(run_client(args.socket, gpu_numbers))
+try:
+    nv.nvmlInit()
+except nv.NVMLError as e:
+    print(f"Could not initialize NVML! The library reported: {e}")
+    sys.exit(8)
+capabilities.load(_decode(_query_or_none(nv.nvmlSystemGetDriverVersion)))
+if gpu_numbers is None:
+    gpu_numbers = list(range(nv.nvmlDeviceGetCount()))
+gpus = []
+for gpu_number in gpu_numbers:
+    try:
+        gpus.append((gpu_number, nv.nvmlDeviceGetHandleByIndex(gpu_number)))
+    except nv.NVMLError as e:
+        print(f"Could not initialize for GPU {gpu_number}! The library reported: {e}")
+        sys.exit(8)
+gpu = gpus[0][1]
+exit_code = 0
+if args.daemon or args.interactive or args.tune_save_profile or args.set_profile or args.save_profile or args.delete_profile or args.list_profiles:
+    try:
+        imported = profiles.import_legacy(profile_dir, lambda index: profile_key(get_device_info(index, nv.nvmlDeviceGetHandleByIndex(index))))
+        if imported:
+            print(f"Imported {imported} profile(s) from the old .bnt files into {profiles.path}", file=sys.stderr)
+        profiles.names("")  # Make sure it loads before anything depends on it
+    except (OSError, ValueError) as e:
+        print(f"Could not load the profile store {profiles.path}! {e}")
+        sys.exit(8)
+
+if args.fan_curve or args.power_budget or args.tune:
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # Exit cleanly so fans, power limits and clocks get put back
+if args.power_budget:
+    try:
+        governor = PowerGovernor(gpus, args.power_budget, args.refresh_rate / 1000)
+    except (ValueError, nv.NVMLError) as e:
+        print(f"{ANSI_WARN}Can't govern power: {e}{NC}")
+        sys.exit(8)
+    governor.start()
+if args.fan_curve:
+    for gpu_number, curve_gpu in gpus:
+        fan_controllers[gpu_number] = FanCurveController(gpu_number, curve_gpu, get_device_info(gpu_number, curve_gpu).num_fans, args.fan_curve,
+                                                         args.refresh_rate / 1000, args.fan_hysteresis, args.fan_ramp)
+        fan_controllers[gpu_number].start()
+
+# If this check is true we run in offline mode, else we run in online mode
+if args.serve_metrics:
+    serve_metrics(args.serve_metrics)
+elif args.daemon:
+    serve_control(args.socket or DEFAULT_SOCKET)
+elif args.tune:
+    exit_code = run_tuning(*gpus[0])
+elif args.set_clocks or args.set_power_limit or args.set_max_fan or args.set_auto_fan or args.set_custom_fan or args.set_profile or args.save_profile or args.delete_profile:
+    offline_started = time.perf_counter()
+    print(f"{ANSI_MAGENTA}Blissful Nvidia Tool Offline Mode{NC}")
+    print("_________________________________________")
+    print(f"{ANSI_YELLOW}User accepts ALL risks of overclocking/altering power limits/fan settings!{NC}")
+    print("Additionally, root permission is needed for these changes and they will fail to apply without it.")
+    print()
+    if len(gpus) == 1:
+        failed = run_offline(*gpus[0])
+    else:
+        failed = run_offline_parallel(gpus)
+    exit_code = 1 if failed else 0
+    if args.benchmark_stats:
+        with open(args.benchmark_stats, "w", encoding="utf-8") as file:
+            json.dump({"seconds": time.perf_counter() - offline_started, "nvml_calls": nv.thread_calls()}, file)
+elif args.status or args.list_profiles:
+    for gpu_number, status_gpu in gpus:
+        if args.list_profiles:
+            key = profile_key(get_device_info(gpu_number, status_gpu))
+            print(json.dumps({"gpu": gpu_number, "key": key, "profiles": {name: profiles.get(key, name)._asdict() for name in profiles.names(key)}}))
+        if args.status:
+            print(json.dumps(read_sample(gpu_number, status_gpu)._asdict()))
+elif args.stream:
+    exit_code = run_stream(gpus)
+elif args.headless:
+    run_headless()
 else:
     #  Interactive mode
-    import ctypes
     import curses
     import psutil
-    curses.wrapper(draw_dashboard)
+    if args.record:
+        try:
+            recorder = Recorder(args.record, [get_device_info(i, nv.nvmlDeviceGetHandleByIndex(i)) for i in range(nv.nvmlDeviceGetCount())])
+        except (OSError, ValueError) as e:
+            print(f"Could not open {args.record} for recording! {e}")
+            sys.exit(8)
+    try:
+        curses.wrapper(draw_dashboard)
+    finally:
+        if not args.benchmark_stats:
+            print_session_summary(session_stats)
+for controller in fan_controllers.values():
+    controller.stop()
+if governor is not None:
+    governor.stop()
 nv.nvmlShutdown()
+sys.exit(exit_code)